@@ -6,6 +6,8 @@ import shinyswatch
 from classes import Settings, Game
 from pathlib import Path
 from utils import ensure_dirs_exist, zip_files, unzip_files, is_openai_api_key_valid
+from llm_modules.client import get_llm_client
+from llm_modules.circuit_breaker import CircuitOpenError
 from resources_paths import DATA_PATH, GAMES_PATH, YAML_TEMPLATES_PATH, INIT_WORLDS_PATH
 import uuid
 import asyncio
@@ -21,6 +23,7 @@ from pages import (
 from operator import attrgetter
 import logging
 from ui_modules.generate_tabs import generate_world_tab, generate_npc_tab, render_world_tab, render_npc_tab
+from ui_modules.debounce import debounce
 from logging import debug
 from dotenv import load_dotenv
 from io import StringIO
@@ -71,16 +74,62 @@ def server(input: Inputs, output: Outputs, session: Session):
     progress_task_val = reactive.Value(None)
     world_tab_inputs = reactive.Value()
     npc_tabs_inputs: list[reactive.Value] = []
+    # World generation and update tasks of the session, cancelled when the session ends
+    session_tasks: set[asyncio.Task] = set()
+    # Games being created by the world generation tasks, to show their progress
+    creating_games: dict[asyncio.Task, Game] = {}
+
+    def track_task(task: asyncio.Task) -> asyncio.Task:
+        session_tasks.add(task)
+        task.add_done_callback(session_tasks.discard)
+        return task
+
+    @session.on_ended
+    def cancel_session_tasks():
+        for task in list(session_tasks):
+            task.cancel()
+
+    app_settings = Settings()
+    app_settings.load(path="./settings.yaml")
+
+    # Check the key only once the user has stopped typing
+    @debounce(app_settings.api_key_debounce)
+    @reactive.Calc
+    def api_key_input() -> str:
+        return input.API_key()
+
+    # Whether the circuit breaker of the key is open because the provider keeps failing
+    # in this or other sessions. Checked every 3 seconds, the value changes only when the state does
+    llm_breaker_open = reactive.Value(False)
+
+    @reactive.Effect
+    def watch_llm_breaker():
+        reactive.invalidate_later(3)
+        breaker = get_llm_client().get_breaker(str(os.environ.get("OPENAI_API_KEY")))
+        llm_breaker_open.set(breaker.is_open())
 
-    # Check if the API key is valid
+    # Check if the API key is valid. The results are cached by the shared LLM client,
+    # so the three outputs below and other sessions with the same key don't repeat the check
     @reactive.Calc
     async def check_api_key() -> bool:
-        env_stream = StringIO(f"OPENAI_API_KEY={input.API_key()}")
+        api_key = api_key_input()
+        env_stream = StringIO(f"OPENAI_API_KEY={api_key}")
         load_dotenv(stream=env_stream, override=True)
 
-        if Path("openai_key").exists() and not input.API_key():
+        if Path("openai_key").exists() and not api_key:
             load_dotenv("openai_key", override=True)
 
+        # The key is checked by the provider selected in the settings
+        app_settings.load(path="./settings.yaml")
+        get_llm_client().configure_from_settings(app_settings)
+
+        # Don't start a world generation that would fail anyway
+        if llm_breaker_open():
+            breaker = get_llm_client().get_breaker(str(os.environ.get("OPENAI_API_KEY")))
+            open_error = breaker.get_open_error()
+            if open_error is not None:
+                return open_error
+
         api_key_valid = await is_openai_api_key_valid(str(os.environ.get("OPENAI_API_KEY")))
 
         return api_key_valid
@@ -103,6 +152,13 @@ def server(input: Inputs, output: Outputs, session: Session):
                 elif error_code in ['insufficient_quota']:
                     header = 'Default API key limit is reached'
                     message = "I provide my own OpenAI API key by default. Due to high demand my API usage this month has reached the account's monthly budget. Either use your own API key or support me (the Developer) by buying the app so I could increase the limits"
+            elif isinstance(api_key_valid, CircuitOpenError):
+                if api_key_valid.code in ['insufficient_quota', 'billing_hard_limit_reached']:
+                    header = 'Default API key limit is reached'
+                    message = "I provide my own OpenAI API key by default. Due to high demand my API usage this month has reached the account's monthly budget. Either use your own API key or support me (the Developer) by buying the app so I could increase the limits"
+                elif api_key_valid.code not in ['invalid_api_key', 'account_deactivated']:
+                    header = 'OpenAI API is unavailable'
+                    message = f'OpenAI API keeps failing at the moment. Please try again in {api_key_valid.retry_in:.0f} seconds.'
 
             return create_page_missing_api_key(header, message)
     
@@ -152,6 +208,8 @@ def server(input: Inputs, output: Outputs, session: Session):
         if game_task.done():
             game = game_task.result()
             zip_path = Path("data") / f'{game.cur_world.name}.zip'
+            # Everything saved so far has to be in the files being zipped
+            await game.flush()
             zipped_file = await zip_files(game.game_path, zip_path)
 
             async with aiofiles.open(zip_path, 'rb') as f:
@@ -194,7 +252,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             game.settings = settings
             game.load_game()
 
-            game_task = asyncio.create_task(game.init_world())
+            game_task = track_task(asyncio.create_task(game.init_world()))
 
             return game_task
         else:
@@ -223,7 +281,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             }
 
             settings_data = {
-                "number_of_npcs": int(input.new_world_npc_num()),
+                "number_of_npcs": max(1, int(input.new_world_npc_num() or 1)),
             }
 
             if "text_to_image_generate_world" in input.images_to_generate():
@@ -238,7 +296,9 @@ def server(input: Inputs, output: Outputs, session: Session):
 
             game.settings_from_ui(settings_data)
 
-            game_task = asyncio.create_task(game.init_world(world_data))
+            game_task = track_task(asyncio.create_task(game.init_world(world_data)))
+            creating_games[game_task] = game
+            game_task.add_done_callback(lambda task: creating_games.pop(task, None))
 
             return game_task
 
@@ -306,6 +366,9 @@ def server(input: Inputs, output: Outputs, session: Session):
         else:
             reactive.invalidate_later(3)
             debug("invalidate_loading")
+            game = creating_games.get(game_task)
+            if game is not None and game.npcs_to_create:
+                return f"Creating NPCs: {game.npcs_created}/{game.npcs_to_create}..."
             return "World is initializing..."
 
     # Display the world name in the header through async def get_world_data(attribute)
@@ -382,6 +445,8 @@ def server(input: Inputs, output: Outputs, session: Session):
             for key in npc.attributes.keys():
                 npc.attributes[key] = int(npc_tabs_inputs[i]()[key]())
 
+        # The background saving of the previous tick must not overwrite the edited states
+        await game.wait_pending_saves()
         game.save_world()
         game.save_npcs()
 
@@ -394,10 +459,86 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     # Spawn the world update async task in the background
     async def progress_world(game: Game):
-        progress_task = asyncio.create_task(game.progress_world())
+        progress_task = track_task(asyncio.create_task(game.progress_world()))
         debug("calc progress task", progress_task)
         return progress_task
 
+    # Every second render the world and NPC states received so far while the world is updating
+    @output
+    @render.ui
+    async def updating_world_partial_states():
+        progress_task = progress_task_val.get()
+        if progress_task is None or progress_task.done():
+            return None
+
+        game_task = await generate_world()
+        game = game_task.result()
+        reactive.invalidate_later(1)
+
+        return ui.TagList(
+            *[
+                ui.div(ui.strong(name), ui.p(partial_state), class_="field-margin-left")
+                for name, partial_state in game.partial_states.items()
+            ]
+        )
+
+    # Render the current world and NPC states in their tabs
+    def update_game_tabs(game: Game):
+        img_url = game.cur_world_path / f"world_tick_{game.cur_world.current_tick}.jpg"
+
+        if not game.settings.text_to_image_generate_world or not img_url.exists():
+            img_url = www_dir / "img/img_placeholder.png"
+
+        world_tab_inputs.set(
+                render_world_tab("world_tab",
+                    img_path=img_url,
+                    world_state=game.cur_world.current_state_prompt,
+                    date=game.current_date_to_str(),
+                    time=game.current_time_to_str(),
+                    temperature=game.cur_world.attributes["temperature"]
+                    )
+                )
+
+        npcs = game.npcs
+        for i, npc in enumerate(reversed(npcs)):
+            img_url = game.cur_world_path / f"npcs/{npc.name}/npc_tick_{game.cur_world.current_tick}.jpg"
+
+            if not game.settings.text_to_image_generate_npcs or not img_url.exists():
+                img_url = www_dir / "img/img_placeholder.png"
+
+            npc_tabs_inputs[i].set(
+                render_npc_tab(npc.name.lower().replace(" ", "_"),
+                            img_path=img_url,
+                            npc_name=npc.name,
+                            npc_state=npc.current_state_prompt,
+                            npc_goal=npc.global_goal,
+                            npc_attributes=npc.attributes,
+                    )
+            )
+
+    # With tick pipelining the new states are shown before their images are generated.
+    # Every 3 seconds check if the images of the last tick are ready and show them
+    images_shown_tick = reactive.Value(None)
+
+    @reactive.Effect
+    def show_tick_images():
+        progress_task = progress_task_val.get()
+        if progress_task is None or not progress_task.done():
+            return
+
+        game: Game = progress_task.result()
+        tick_stages = game.last_tick_stages
+        if tick_stages is None or tick_stages.tick == images_shown_tick.get():
+            return
+
+        if not tick_stages.images.done():
+            reactive.invalidate_later(3)
+            return
+
+        with reactive.isolate():
+            update_game_tabs(game)
+        images_shown_tick.set(tick_stages.tick)
+
     # Every 3 seconds check if the game.progress_world() task stored in Reactive.Value `progress_task_val` is finished.
     # If not, continue checking every 3 seconds.
     # If it is finished, update the UI and switch to page_world_interact
@@ -413,37 +554,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             progress_task = None
             ui.update_navs("pages", selected="page_world_interact")
 
-            img_url = game.cur_world_path / f"world_tick_{game.cur_world.current_tick}.jpg"
-
-            if not game.settings.text_to_image_generate_world or not img_url.exists():
-                img_url = www_dir / "img/img_placeholder.png"
-
-            world_tab_inputs.set(
-                    render_world_tab("world_tab",
-                        img_path=img_url,
-                        world_state=game.cur_world.current_state_prompt,
-                        date=game.current_date_to_str(),
-                        time=game.current_time_to_str(),
-                        temperature=game.cur_world.attributes["temperature"]
-                        )
-                    )
-
-            npcs = game.npcs
-            for i, npc in enumerate(reversed(npcs)):
-                img_url = game.cur_world_path / f"npcs/{npc.name}/npc_tick_{game.cur_world.current_tick}.jpg"
-
-                if not game.settings.text_to_image_generate_npcs or not img_url.exists():
-                    img_url = www_dir / "img/img_placeholder.png"
-
-                npc_tabs_inputs[i].set(
-                    render_npc_tab(npc.name.lower().replace(" ", "_"),
-                                img_path=img_url,
-                                npc_name=npc.name,
-                                npc_state=npc.current_state_prompt,
-                                npc_goal=npc.global_goal,
-                                npc_attributes=npc.attributes,
-                        )
-                )
+            update_game_tabs(game)
             ui.update_navs("world_interact_tabs", selected="world_nav")
 
             return "World is updated"
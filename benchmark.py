@@ -0,0 +1,189 @@
+"""Offline benchmark of the game's LLM usage with the fake provider.
+
+Creates a throwaway game from the test world, progresses it for a number of ticks
+once for every NPC pack size and tick pipelining mode and prints the wall time,
+the mean time until the new states of a tick are shown and the tokens spent.
+
+With --shards, runs --worlds worlds in every given number of worker processes
+instead (see game_modules/world_shards.py) and prints the throughput of each.
+
+Usage: python benchmark.py --npcs 20 --ticks 3 --pack-sizes 1 5 10 --latency 0.5 --latency-jitter 2 --hedging
+       python benchmark.py --npcs 10 --ticks 5 --pack-sizes 5 --latency 1 --images --pipelining off on
+       python benchmark.py --npcs 4 --ticks 10 --latency 0.05 --worlds 64 --shards 1 2 4 8
+"""
+import argparse
+import asyncio
+import shutil
+import tempfile
+import time
+import uuid
+
+import yaml
+
+from classes import Game
+from game_modules.world_shards import ShardedWorldRunner
+from resources_paths import GAMES_PATH, INIT_WORLDS_PATH
+
+
+def make_game(args, pack_size: int, pipelining: bool) -> Game:
+    game = Game()
+    game.settings.llm_provider = "fake"
+    game.settings.fake_llm_latency = args.latency
+    game.settings.fake_llm_latency_jitter = args.latency_jitter
+    game.settings.fake_llm_seed = args.seed
+    game.settings.llm_cache_enabled = False
+    game.settings.text_to_image_model = "dall-e-3" if args.images else ""
+    game.settings.tick_pipelining = pipelining
+    game.settings.number_of_npcs = args.npcs
+    game.settings.npc_update_pack_size = pack_size
+    game.settings.llm_hedging_enabled = args.hedging
+    game.new_game(f"benchmark-{uuid.uuid4().hex[:8]}")
+
+    return game
+
+
+def print_usage(label: str, seconds: float, tick_seconds: float, usage: dict):
+    requests_num = sum(model_usage["requests"] for model_usage in usage.values())
+    prompt_tokens = sum(model_usage["prompt_tokens"] for model_usage in usage.values())
+    completion_tokens = sum(model_usage["completion_tokens"] for model_usage in usage.values())
+
+    print(
+        f"{label:<32} {seconds:>8.2f}s {tick_seconds:>9.2f}s {requests_num:>9} {prompt_tokens:>14} {completion_tokens:>18}"
+    )
+
+    return
+
+
+async def run(args):
+    with open(INIT_WORLDS_PATH / "test_world.yaml") as f:
+        world_data = yaml.safe_load(f)
+
+    print(
+        f"{'':<32} {'time':>9} {'per tick':>10} {'requests':>9} {'prompt tokens':>14} {'completion tokens':>18}"
+    )
+
+    for pack_size in args.pack_sizes:
+        for pipelining in args.pipelining:
+            game = make_game(args, pack_size, pipelining == "on")
+            try:
+                await game.init_world(world_data)
+
+                game.llm_client.reset_usage()
+                ticks_seconds = []
+                start = time.perf_counter()
+                for _ in range(args.ticks):
+                    tick_start = time.perf_counter()
+                    await game.progress_world()
+                    # Time until the new states can be shown
+                    ticks_seconds.append(time.perf_counter() - tick_start)
+                await game.wait_pending_ticks()
+                seconds = time.perf_counter() - start
+
+                print_usage(
+                    f"pack size {pack_size}, pipelining {pipelining}",
+                    seconds,
+                    sum(ticks_seconds) / len(ticks_seconds),
+                    game.llm_client.usage,
+                )
+                if args.hedging:
+                    print(f"{'':<32} hedging: {game.llm_client.hedger.stats()}")
+            finally:
+                shutil.rmtree(GAMES_PATH / game.game_name, ignore_errors=True)
+
+    return
+
+
+def write_shards_settings(args, settings_file):
+    """Settings of the sharded worlds, the workers load them from the file"""
+    with open("./settings.yaml") as f:
+        settings = yaml.safe_load(f)
+
+    settings.update(
+        {
+            "llm_provider": "fake",
+            "fake_llm_latency": args.latency,
+            "fake_llm_latency_jitter": args.latency_jitter,
+            "fake_llm_seed": args.seed,
+            "llm_cache_enabled": False,
+            "text_to_image_model": "dall-e-3" if args.images else "",
+            "number_of_npcs": args.npcs,
+            "npc_update_pack_size": args.pack_sizes[0],
+            "llm_hedging_enabled": args.hedging,
+            # The provider's budget shouldn't be what limits the throughput
+            "llm_max_concurrent_requests": {},
+            "llm_default_max_concurrent_requests": args.max_concurrent_requests,
+        }
+    )
+    yaml.safe_dump(settings, settings_file)
+    settings_file.flush()
+
+    return
+
+
+def run_shards(args):
+    with open(INIT_WORLDS_PATH / "test_world.yaml") as f:
+        world_data = yaml.safe_load(f)
+
+    print(
+        f"{'':<32} {'time':>9} {'ticks/min':>10} {'speedup':>8} {'requests':>9} {'budget calls':>13}"
+    )
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as settings_file:
+        write_shards_settings(args, settings_file)
+
+        first_ticks_per_minute = None
+        for shards in args.shards:
+            runner = ShardedWorldRunner(
+                shards=shards,
+                settings_path=settings_file.name,
+                max_active_worlds=args.worlds,
+                max_resident_worlds=args.worlds,
+                checkpoint_every=args.ticks,
+                generate_images=args.images,
+            )
+            games_names = [f"benchmark-{uuid.uuid4().hex[:8]}" for _ in range(args.worlds)]
+            for game_name in games_names:
+                runner.add_world(game_name, ticks=args.ticks, world_data=world_data)
+
+            try:
+                stats = runner.run()
+            finally:
+                for game_name in games_names:
+                    shutil.rmtree(GAMES_PATH / game_name, ignore_errors=True)
+
+            first_ticks_per_minute = first_ticks_per_minute or stats["ticks_per_minute"]
+            budget = stats["budget"].values()
+            print(
+                f"{f'{shards} shards, {args.worlds} worlds':<32} {stats['elapsed']:>8.2f}s "
+                f"{stats['ticks_per_minute']:>10.1f} {stats['ticks_per_minute'] / first_ticks_per_minute:>7.2f}x "
+                f"{sum(model_status['requests'] for model_status in budget):>9} "
+                f"{sum(model_status.get('slot_leases', 0) + model_status.get('rate_leases', 0) for model_status in budget):>13}"
+            )
+            if stats["failed"]:
+                print(f"{'':<32} {stats['failed']} worlds failed")
+
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the game with the fake LLM provider")
+    parser.add_argument("--npcs", type=int, default=20, help="number of NPCs in the world")
+    parser.add_argument("--ticks", type=int, default=3, help="number of ticks to progress")
+    parser.add_argument("--pack-sizes", type=int, nargs="+", default=[1, 5, 10], help="NPC pack sizes to compare")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each fake answer takes")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="random extra seconds added to each fake answer")
+    parser.add_argument("--hedging", action="store_true", help="hedge the requests slower than usual")
+    parser.add_argument("--images", action="store_true", help="generate the world and NPC images")
+    parser.add_argument("--pipelining", nargs="+", choices=["on", "off"], default=["on"], help="tick pipelining modes to compare")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the fake provider")
+    parser.add_argument("--shards", type=int, nargs="+", help="numbers of worker processes to compare, runs --worlds worlds in each")
+    parser.add_argument("--worlds", type=int, default=32, help="number of worlds run with --shards")
+    parser.add_argument(
+        "--max-concurrent-requests", type=int, default=256, help="requests in flight allowed per model with --shards"
+    )
+
+    args = parser.parse_args()
+    if args.shards:
+        run_shards(args)
+    else:
+        asyncio.run(run(args))
@@ -30,6 +30,8 @@ langchain = sitepackages / "langchain"
 www = os.path.abspath("www")
 data = os.path.abspath("data")
 ui_modules = os.path.abspath("ui_modules")
+llm_modules = os.path.abspath("llm_modules")
+game_modules = os.path.abspath("game_modules")
 
 data_files = [
     ("../app.py", "."),
@@ -45,6 +47,8 @@ data_files = [
     (data, "./data"),
     (www, "./www"),
     (ui_modules, "./ui_modules"),
+    (llm_modules, "./llm_modules"),
+    (game_modules, "./game_modules"),
 ]
 
 datas = data_files + sitepackages_list
@@ -1,17 +1,17 @@
 import asyncio
+import copy
 from dataclasses import dataclass, field
 from yamldataclassconfig.config import YamlDataClassConfig
 from pathlib import Path
 import numpy as np
 from utils import (
-    get_last_modified_file,
-    get_oldest_modified_file,
     bcolors,
     int_to_month,
     Input,
     save_yaml_from_data,
     request_openai,
     load_yaml_to_dataclass,
+    load_dict_to_dataclass,
     to_datetime,
     from_datetime,
     hour_to_iso,
@@ -22,7 +22,6 @@ from utils import (
     YamlDumperDoubleQuotes,
     dataclass_to_dict_copy,
     load_yaml,
-    get_previous_to_last_modified_file,
     is_year_leap,
     check_yaml_update_npc,
     check_yaml_new_npc,
@@ -30,8 +29,20 @@ from utils import (
     base64str_to_img,
     batch_image_generation,
     batch_completion,
+    BatchOutcome,
     # debug,
 )
+from llm_modules.client import get_llm_client, usage_scope
+from llm_modules.retry import RetryPolicy, RequestFailedError
+from llm_modules.scheduler import estimate_tokens
+from game_modules.social_graph import SocialGraph, get_social_candidates, symmetrize_social_connections
+from game_modules.attribute_store import AttributeStore
+from game_modules.yaml_storage import YamlStorage
+from game_modules.log_storage import LogStorage
+from game_modules.sqlite_storage import SqliteStorage
+from game_modules.storage_writer import StorageWriter
+from llm_modules.cache import get_response_cache
+from llm_modules.deadline import DeadlineExceededError, check_deadline, deadline_scope, run_with_deadline
 import validators
 from prompt_toolkit import prompt
 from prompts import (
@@ -40,6 +51,8 @@ from prompts import (
     create_social_connections,
     world_new_state,
     npc_new_state,
+    npc_new_states,
+    history_summaries,
     generate_npc_image
 )
 from typing import List, Union, Any
@@ -49,6 +62,7 @@ import random
 from resources_paths import DATA_PATH, GAMES_PATH, YAML_TEMPLATES_PATH, INIT_WORLDS_PATH
 import sys
 import os
+import time
 
 from logging import debug
 
@@ -73,6 +87,53 @@ class Settings(YamlDataClassConfig):
     world_attributes_names: list[str] = field(default_factory=list)
     world_time_names: list[str] = field(default_factory=list)
     world_history_steps: int = 0
+    llm_max_concurrent_requests: dict[str, int] = field(default_factory=dict)
+    llm_default_max_concurrent_requests: int = 8
+    llm_max_connections: int = 100
+    llm_retry_base_delay: float = 1.0
+    llm_retry_max_delay: float = 60.0
+    llm_request_deadline: float = 300.0
+    llm_cache_enabled: bool = False
+    llm_cache_max_size_mb: int = 512
+    llm_provider: str = "openai"
+    llm_recording_path: str = ""
+    fake_llm_latency: float = 0.0
+    fake_llm_latency_jitter: float = 0.0
+    fake_llm_error_rate: float = 0.0
+    fake_llm_seed: int = 0
+    llm_rate_limits: dict[str, dict[str, int]] = field(default_factory=dict)
+    llm_expected_completion_tokens: int = 400
+    llm_streaming: bool = False
+    llm_batch_retry_rounds: int = 1
+    npc_update_pack_size: int = 1
+    llm_context_tokens: int = 16000
+    api_key_valid_ttl: float = 600.0
+    api_key_invalid_ttl: float = 60.0
+    api_key_debounce: float = 1.0
+    tick_deadline: float = 0.0
+    init_world_deadline: float = 0.0
+    deadline_policy: str = "keep"
+    deadline_grace: float = 5.0
+    llm_hedging_enabled: bool = False
+    llm_hedge_quantile: float = 0.95
+    llm_hedge_max_extra_ratio: float = 0.1
+    llm_hedge_min_samples: int = 20
+    llm_breaker_enabled: bool = True
+    llm_breaker_error_rate: float = 0.5
+    llm_breaker_min_requests: int = 10
+    llm_breaker_window: float = 60.0
+    llm_breaker_open_seconds: float = 30.0
+    llm_breaker_half_open_probes: int = 1
+    tick_pipelining: bool = True
+    history_summary_every: int = 5
+    history_summary_max_words: int = 150
+    social_connections_candidates: int = 0
+    social_connections_candidates_mode: str = "similar"
+    social_connections_symmetric: bool = True
+    npc_creation_wave_size: int = 20
+    storage_backend: str = "yaml"
+    log_segment_max_mb: int = 16
+    log_fsync_every: int = 10
 
 
 @dataclass
@@ -84,6 +145,8 @@ class World(YamlDataClassConfig):
     tick_rate: int = 0  # how much time of tick_type passes in the world per tick
     current_tick: int = 0  # indicates how many ticks passed
     current_state_prompt: str = ""
+    history: list[dict] = field(default_factory=list)  # latest previous states, see world_history_steps
+    history_summary: str = ""  # summary of the states older than history
 
 
 @dataclass
@@ -93,6 +156,43 @@ class Npc(YamlDataClassConfig):
     attributes: dict[str, Any] = field(default_factory=dict)
     social_connections: list[str] = field(default_factory=list)
     current_state_prompt: str = ""
+    history: list[dict] = field(default_factory=list)  # latest previous states, see npc_history_steps
+    history_summary: str = ""  # summary of the states older than history
+
+
+@dataclass
+class TickStages:
+    """Completion futures of the stages of one world tick"""
+
+    tick: int
+    state: asyncio.Future  # the world and NPC states are updated in memory
+    saved: asyncio.Future  # the states are written to disk
+    images: asyncio.Future  # the world and NPC images are generated
+
+    @property
+    def futures(self) -> tuple[asyncio.Future, ...]:
+        return (self.state, self.saved, self.images)
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+    async def wait(self):
+        await asyncio.gather(*self.futures)
+
+        return
+
+
+@dataclass
+class TickStats:
+    """Timing and LLM usage of one tick run by `Game.advance`"""
+
+    tick: int
+    seconds: float
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    stale_npcs: int = 0
+    checkpoint: bool = False
 
 
 class Game:
@@ -118,11 +218,38 @@ class Game:
         self.cur_world: World = World()
         self.world_prompt: str = ""
         self.world_general_description: str = ""
+        # The world's state before the current one, for the world update prompt
+        self.previous_world_state_prompt: str = ""
 
         # Npcs
         self.npcs: List[Npc] = []
         self.global_goals: list = []
 
+        # LLM client shared with all the other games in the process
+        self.llm_client = get_llm_client()
+        self.retry_policy = RetryPolicy.from_settings(self.settings)
+        self.response_cache = None
+
+        # Text of the world and NPC states received so far during the current tick
+        self.partial_states: dict[str, str] = {}
+        # Stages of the ticks whose saving or images are still running in the background
+        self.tick_stages: dict[int, TickStages] = {}
+        self.last_tick_stages: TickStages | None = None
+
+        # Names of the NPCs whose state failed to update in the last tick
+        self.stale_npcs: set[str] = set()
+        # Connections and views of the NPCs for their prompts, see get_social_graph()
+        self.social_graph: SocialGraph | None = None
+        # Numeric attributes of all the NPCs, `Npc.attributes` are views of it
+        self.attribute_store: AttributeStore | None = None
+        # Progress of new_npcs(), shown while the world is created
+        self.npcs_to_create = 0
+        self.npcs_created = 0
+        # Where the states of the current world are saved, see get_storage()
+        self.storage: YamlStorage | LogStorage | SqliteStorage | None = None
+        # Runs the saves in a worker thread, see flush()
+        self.storage_writer = StorageWriter()
+
     def input_handler(self, user_input: Input):
         if user_input == Input.init_game:
             self.init_game()
@@ -171,23 +298,175 @@ class Game:
 
         return
 
-    async def progress_world(self):
+    def configure_llm_client(self):
+        self.llm_client.configure_from_settings(self.settings)
+        self.retry_policy = RetryPolicy.from_settings(self.settings)
+
+        if self.settings.llm_cache_enabled:
+            self.response_cache = get_response_cache(
+                DATA_PATH / "cache", self.settings.llm_cache_max_size_mb * 1024**2
+            )
+        else:
+            self.response_cache = None
+
+        return
+
+    def get_partial_state_callback(self, name: str, state_key: str):
+        def on_partial(fields: dict):
+            partial_state = fields.get(state_key)
+            if isinstance(partial_state, str):
+                self.partial_states[name] = partial_state
+
+        return on_partial
+
+    async def progress_world(self, save: bool = True, generate_images: bool = True):
+        """Run one tick. With `tick_pipelining` it returns as soon as the new world and
+        NPC states are in memory, their saving and images go on in the background
+        (see `last_tick_stages`) while the next tick can already start. Without `save`
+        the new states are kept only in memory"""
+        self.configure_llm_client()
+        self.partial_states = {}
+
+        # The next tick reads the states saved by the previous one
+        await self.wait_pending_saves()
+
+        tick_snapshot = (copy.deepcopy(self.cur_world), copy.deepcopy(self.npcs), self.previous_world_state_prompt)
+        deadline_exceeded = False
+
+        with deadline_scope(self.settings.tick_deadline):
+            try:
+                await run_with_deadline(self.run_tick(), grace=self.settings.deadline_grace)
+            except DeadlineExceededError:
+                if self.settings.deadline_policy == "discard":
+                    self.cur_world, self.npcs, self.previous_world_state_prompt = tick_snapshot
+                    debug(
+                        f"{bcolors.FAIL}The tick didn't finish in {self.settings.tick_deadline}s, it is discarded{bcolors.ENDC}"
+                    )
+                    return self
+
+                debug(
+                    f"{bcolors.WARNING}The tick didn't finish in {self.settings.tick_deadline}s, "
+                    f"keeping the states updated so far{bcolors.ENDC}"
+                )
+                deadline_exceeded = True
+
+            if not save:
+                return self
+
+            # Started inside the scope, the images are limited by the tick's deadline too
+            stages = self.start_tick_stages(
+                generate_images=bool(self.settings.text_to_image_model)
+                and generate_images
+                and not deadline_exceeded
+            )
+
+        if not self.settings.tick_pipelining:
+            await stages.wait()
+
+        return self
+
+    async def advance(
+        self, ticks: int, checkpoint_every: int = 1, generate_images: bool = False
+    ) -> List[TickStats]:
+        """Run `ticks` ticks without the UI. The states are saved (with their images if
+        `generate_images`) only every `checkpoint_every` ticks and after the last tick,
+        in between the in-memory states are authoritative"""
+        ticks_stats = []
+
+        for i in range(ticks):
+            checkpoint = i == ticks - 1 or (checkpoint_every > 0 and (i + 1) % checkpoint_every == 0)
+
+            start = time.perf_counter()
+            with usage_scope() as usage:
+                await self.progress_world(save=checkpoint, generate_images=generate_images)
+
+            tick_stats = TickStats(
+                tick=self.cur_world.current_tick,
+                seconds=time.perf_counter() - start,
+                requests=usage["requests"],
+                prompt_tokens=usage["prompt_tokens"],
+                completion_tokens=usage["completion_tokens"],
+                stale_npcs=len(self.stale_npcs),
+                checkpoint=checkpoint,
+            )
+            ticks_stats.append(tick_stats)
+
+            debug(
+                f"{bcolors.OKGREEN}Tick {tick_stats.tick} took {tick_stats.seconds:.2f}s, "
+                f"{tick_stats.requests} requests, {tick_stats.prompt_tokens + tick_stats.completion_tokens} tokens"
+                f"{' (saved)' if checkpoint else ''}{bcolors.ENDC}"
+            )
+
+        await self.wait_pending_ticks()
+
+        return ticks_stats
+
+    async def run_tick(self):
+        """Update the world and NPC states in memory. Every stage is started only if
+        the tick's deadline hasn't passed"""
         await self.tick_increment()
+
+        check_deadline()
         await self.update_world()
+
+        check_deadline()
         await self.update_npcs()
 
-        if self.settings.text_to_image_model:
-            await self.generate_images()
+        check_deadline()
+        await self.update_histories()
 
-        self.save_world()
-        self.save_npcs()
+        return
 
-        return self
+    def start_tick_stages(self, generate_images: bool = True) -> TickStages:
+        """Save the current states and generate their images in the background"""
+        tick = self.cur_world.current_tick
+        world = copy.deepcopy(self.cur_world)
+        npcs = copy.deepcopy(self.npcs)
+        loop = asyncio.get_running_loop()
+
+        state = loop.create_future()
+        state.set_result(self)
+
+        self.save_tick(world, npcs)
+        saved = self.storage_writer.flush()
+
+        if generate_images:
+            # The prompts are built now, before the next tick changes the states
+            images = asyncio.create_task(
+                self.generate_images_from_requests(*self.get_images_requests(world, npcs))
+            )
+        else:
+            images = loop.create_future()
+            images.set_result(None)
+
+        stages = TickStages(tick=tick, state=state, saved=saved, images=images)
+        self.tick_stages[tick] = stages
+        self.last_tick_stages = stages
+
+        def on_stage_done(_):
+            if stages.done():
+                self.tick_stages.pop(tick, None)
+        for future in stages.futures:
+            future.add_done_callback(on_stage_done)
+
+        return stages
+
+    async def wait_pending_saves(self):
+        await asyncio.gather(*[stages.saved for stages in list(self.tick_stages.values())])
+
+        return
+
+    async def wait_pending_ticks(self):
+        """Wait until the saving and images of every tick are finished"""
+        await asyncio.gather(*[stages.wait() for stages in list(self.tick_stages.values())])
+
+        return
 
     async def update_world(self):
         world_new_state_request = world_new_state.format(
             init_state=self.world_general_description,
-            previous_state=get_previous_to_last_modified_file(self.cur_world_path),
+            history_summary=self.cur_world.history_summary,
+            previous_state=self.get_history_text(self.cur_world) or self.previous_world_state_prompt,
             current_state=self.cur_world.current_state_prompt,
             attributes=self.cur_world.attributes,
             date=self.current_date_to_str(),
@@ -204,8 +483,18 @@ class Game:
             response_processors=[yaml_from_str],
             verbose=self.settings.openai_verbose,
             api_key=os.environ.get("OPENAI_API_KEY"),
+            client=self.llm_client,
+            retry_policy=self.retry_policy,
+            cache=self.response_cache,
+            stream=self.settings.llm_streaming,
+            on_partial=self.get_partial_state_callback(self.cur_world.name, "world_new_state"),
         )
 
+        if new_world_state is None:
+            raise RequestFailedError("All tries of the world update failed")
+
+        self.remember_state(self.cur_world, self.settings.world_history_steps)
+        self.previous_world_state_prompt = self.cur_world.current_state_prompt
         self.cur_world.current_state_prompt = new_world_state["world_new_state"]
 
 
@@ -217,41 +506,376 @@ class Game:
         return
 
     async def update_npcs(self):
-        update_npc_prompts = []
+        self.refresh_social_graph()
+        attribute_store = self.get_attribute_store()
 
-        for npc in self.npcs:
-            update_npc_prompts.append(self.get_update_npc_prompt(npc))
+        if self.settings.npc_update_pack_size > 1 and len(self.npcs) > 1:
+            npcs_outcomes = await self.update_npcs_packed()
+        else:
+            npcs_outcomes = await self.update_npcs_separately(self.npcs)
+
+        # Commit the NPCs that were updated, the failed ones keep their previous state
+        attributes_deltas = attribute_store.new_deltas()
+        for i, (npc, npc_outcome) in enumerate(zip(self.npcs, npcs_outcomes)):
+            if not npc_outcome.ok:
+                self.stale_npcs.add(npc.name)
+                debug(
+                    f"{bcolors.FAIL}NPC {npc.name} wasn't updated: {npc_outcome.error!r}{bcolors.ENDC}"
+                )
+                continue
 
-        openai_kwargs = {
+            self.stale_npcs.discard(npc.name)
+            npc_new_data = npc_outcome.value
+            self.remember_state(npc, self.settings.npc_history_steps)
+            npc.current_state_prompt = npc_new_data["npc_new_state"]
+            attribute_store.set_deltas(attributes_deltas, i, npc_new_data["attributes"])
+
+        # The attributes of all the NPCs change at once, by at most max_attribute_delta
+        attribute_store.add_deltas(attributes_deltas, self.settings.max_attribute_delta)
+
+        # The updated NPCs are committed, the caller decides whether to keep them
+        if any(isinstance(npc_outcome.error, DeadlineExceededError) for npc_outcome in npcs_outcomes):
+            raise DeadlineExceededError("The deadline is exceeded before all NPCs were updated")
+
+        return
+
+    def remember_state(self, state_owner: World | Npc, history_steps: int):
+        """Push the current state to the history before it's replaced. The states older
+        than the last `history_steps` stay there until they are folded into the summary"""
+        if history_steps <= 0 or not state_owner.current_state_prompt:
+            return
+
+        state_owner.history.append(
+            {"tick": self.cur_world.current_tick - 1, "state": state_owner.current_state_prompt}
+        )
+        # If the summaries keep failing (or are off) the oldest states are dropped
+        max_history_len = history_steps + 2 * max(0, self.settings.history_summary_every)
+        del state_owner.history[:-max_history_len]
+
+        return
+
+    def get_history_text(self, state_owner: World | Npc) -> str:
+        return "\n".join(
+            f"tick {previous_state['tick']}: {previous_state['state']}"
+            for previous_state in state_owner.history
+        )
+
+    async def update_histories(self):
+        """Every `history_summary_every` ticks fold the states older than the last
+        `world_history_steps`/`npc_history_steps` into the world's and NPCs' history
+        summaries, so the prompts don't grow with the number of ticks"""
+        summary_every = self.settings.history_summary_every
+        if summary_every <= 0 or self.cur_world.current_tick % summary_every:
+            return
+
+        state_owners = [
+            (state_owner, history_steps)
+            for state_owner, history_steps in [(self.cur_world, self.settings.world_history_steps)]
+            + [(npc, self.settings.npc_history_steps) for npc in self.npcs]
+            if history_steps > 0 and len(state_owner.history) > history_steps
+        ]
+        if not state_owners:
+            return
+
+        histories_packs = self.get_histories_packs(state_owners)
+        debug(
+            f"{bcolors.OKCYAN}Summarizing {len(state_owners)} histories in {len(histories_packs)} requests...{bcolors.ENDC}"
+        )
+        await asyncio.gather(
+            *[self.update_histories_pack(histories_pack) for histories_pack in histories_packs]
+        )
+
+        return
+
+    def get_history_to_fold(self, state_owner: World | Npc, history_steps: int) -> dict:
+        return {
+            "name": state_owner.name,
+            "history_summary": state_owner.history_summary,
+            "old_states": [previous_state["state"] for previous_state in state_owner.history[:-history_steps]],
+        }
+
+    def get_histories_packs(self, state_owners: list[tuple]) -> list[list[tuple]]:
+        """Split the histories to summarize into packs whose prompt and answer fit into `llm_context_tokens`"""
+        base_tokens = estimate_tokens(self.get_history_summaries_prompt([]))
+        summary_tokens = self.settings.history_summary_max_words * 2
+
+        histories_packs = []
+        histories_pack = []
+        pack_tokens = base_tokens
+
+        for state_owner, history_steps in state_owners:
+            history_tokens = (
+                estimate_tokens(yaml.dump(self.get_history_to_fold(state_owner, history_steps), sort_keys=False))
+                + summary_tokens
+            )
+            if histories_pack and pack_tokens + history_tokens > self.settings.llm_context_tokens:
+                histories_packs.append(histories_pack)
+                histories_pack = []
+                pack_tokens = base_tokens
+
+            histories_pack.append((state_owner, history_steps))
+            pack_tokens += history_tokens
+
+        if histories_pack:
+            histories_packs.append(histories_pack)
+
+        return histories_packs
+
+    def get_history_summaries_prompt(self, histories: list[dict]) -> str:
+        return history_summaries.format(
+            world_general_description=self.world_general_description,
+            histories=yaml.dump(histories, sort_keys=False, Dumper=YamlDumperDoubleQuotes),
+            max_summary_words=self.settings.history_summary_max_words,
+        )
+
+    async def update_histories_pack(self, histories_pack: list[tuple]):
+        """Summarize the pack in one request. The histories missing from the answer
+        are kept as they are and summarized next time"""
+        prompt = self.get_history_summaries_prompt(
+            [
+                self.get_history_to_fold(state_owner, history_steps)
+                for state_owner, history_steps in histories_pack
+            ]
+        )
+
+        try:
+            response = await request_openai(
+                model=self.settings.LLM_model,
+                prompt=prompt,
+                tries_num=self.settings.llm_request_tries_num,
+                response_processors=[yaml_from_str],
+                verbose=self.settings.openai_verbose,
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                client=self.llm_client,
+                retry_policy=self.retry_policy,
+                cache=self.response_cache,
+            )
+        except Exception as e:
+            debug(f"{bcolors.FAIL}Histories weren't summarized: {e!r}{bcolors.ENDC}")
+            return
+
+        summaries = {}
+        if isinstance(response, dict):
+            for summary in response.get("history_summaries") or []:
+                if isinstance(summary, dict) and isinstance(summary.get("history_summary"), str):
+                    summaries[summary.get("name")] = summary["history_summary"]
+
+        for state_owner, history_steps in histories_pack:
+            if state_owner.name not in summaries:
+                debug(f"{bcolors.WARNING}History of {state_owner.name} wasn't summarized{bcolors.ENDC}")
+                continue
+
+            state_owner.history_summary = summaries[state_owner.name]
+            del state_owner.history[:-history_steps]
+
+        return
+
+    def get_attribute_store(self) -> AttributeStore:
+        """The store of the NPCs' attributes, rebuilt if the NPCs or their attributes were
+        replaced, e.g. by loading or by discarding a tick"""
+        if self.attribute_store is None or not self.attribute_store.is_bound(self.npcs):
+            self.attribute_store = AttributeStore(self.npcs, self.settings.npc_attributes_names)
+
+        return self.attribute_store
+
+    def get_npcs_attributes_stats(self) -> dict[str, dict[str, float]]:
+        return self.get_attribute_store().get_stats()
+
+    def get_update_npc_openai_kwargs(self) -> dict:
+        return {
             "model": self.settings.LLM_model,
             "tries_num": self.settings.llm_request_tries_num,
             "response_processors": [yaml_from_str, check_yaml_update_npc],
             "verbose": self.settings.openai_verbose,
             "api_key": os.environ.get("OPENAI_API_KEY"),
+            "client": self.llm_client,
+            "retry_policy": self.retry_policy,
+            "cache": self.response_cache,
+            "stream": self.settings.llm_streaming,
         }
 
-        npcs_new_data = await batch_completion(update_npc_prompts, openai_kwargs=openai_kwargs)
+    async def update_npcs_separately(self, npcs: List[Npc]) -> List[BatchOutcome]:
+        """One request per NPC"""
+        update_npc_prompts = []
 
-        for npc, npc_new_data in zip(self.npcs, npcs_new_data):
-            npc.current_state_prompt = npc_new_data["npc_new_state"]
+        for npc in npcs:
+            update_npc_prompts.append(self.get_update_npc_prompt(npc))
+
+        on_partials = [
+            self.get_partial_state_callback(npc.name, "npc_new_state") for npc in npcs
+        ]
+
+        npcs_outcomes = await batch_completion(
+            update_npc_prompts,
+            openai_kwargs=self.get_update_npc_openai_kwargs(),
+            on_partials=on_partials,
+            retry_rounds=self.settings.llm_batch_retry_rounds,
+        )
+
+        return npcs_outcomes
+
+    async def update_npcs_packed(self) -> List[BatchOutcome]:
+        """Several NPCs per request, sharing the world part of the prompt"""
+        npcs_packs = self.get_npcs_packs()
+        debug(
+            f"{bcolors.OKCYAN}Updating {len(self.npcs)} NPCs in {len(npcs_packs)} packed requests...{bcolors.ENDC}"
+        )
+
+        packs_outcomes = await asyncio.gather(
+            *[self.update_npcs_pack(npcs_pack) for npcs_pack in npcs_packs]
+        )
+
+        npcs_outcomes = {}
+        for pack_outcomes in packs_outcomes:
+            npcs_outcomes.update(pack_outcomes)
+
+        return [npcs_outcomes[npc.name] for npc in self.npcs]
+
+    def get_npcs_packs(self) -> List[List[Npc]]:
+        """Split NPCs into packs of at most `npc_update_pack_size` NPCs whose prompt
+        and expected answer fit into `llm_context_tokens`"""
+        max_pack_size = self.settings.npc_update_pack_size
+        base_tokens = estimate_tokens(self.get_update_npcs_pack_prompt([]))
+
+        npcs_packs = []
+        npcs_pack = []
+        pack_tokens = base_tokens
+
+        for npc in self.npcs:
+            # The NPC itself, the NPCs it is connected with and its answer
+            npc_tokens = (
+                estimate_tokens(yaml.dump(dataclass_to_dict_copy(npc), sort_keys=False))
+                + estimate_tokens(yaml.dump(self.get_connected_npcs_views([npc]), sort_keys=False))
+                + self.settings.llm_expected_completion_tokens
+            )
+
+            if npcs_pack and (
+                len(npcs_pack) >= max_pack_size
+                or pack_tokens + npc_tokens > self.settings.llm_context_tokens
+            ):
+                npcs_packs.append(npcs_pack)
+                npcs_pack = []
+                pack_tokens = base_tokens
+
+            npcs_pack.append(npc)
+            pack_tokens += npc_tokens
+
+        if npcs_pack:
+            npcs_packs.append(npcs_pack)
+
+        return npcs_packs
+
+    def get_social_graph(self) -> SocialGraph:
+        if self.social_graph is None:
+            self.social_graph = SocialGraph(self.npcs)
 
-            for attribute_key in npc.attributes.keys():
-                new_attribute_value = npc_new_data["attributes"].get(attribute_key, 0)
-                npc.attributes[attribute_key] += new_attribute_value
+        return self.social_graph
+
+    def refresh_social_graph(self):
+        """Rebuild the social graph if the NPCs, their states or connections have changed,
+        e.g. by the previous tick or by the user"""
+        if self.social_graph is None or not self.social_graph.is_current(self.npcs):
+            self.social_graph = SocialGraph(self.npcs)
 
         return
 
+    def get_connected_npcs_views(self, npcs: List[Npc]) -> List[dict]:
+        """Name and current state of the NPCs socially connected with any of `npcs`"""
+        return self.get_social_graph().get_connected_views(npcs)
+
+    def get_update_npcs_pack_prompt(self, npcs_pack: List[Npc]) -> str:
+        current_npcs = [dataclass_to_dict_copy(npc) for npc in npcs_pack]
+
+        npc_new_states_request = npc_new_states.format(
+            world_general_description=self.world_general_description,
+            world_current_state=self.cur_world.current_state_prompt,
+            world_attributes=self.cur_world.attributes,
+            date=self.current_date_to_str(),
+            current_npcs=yaml.dump(
+                current_npcs, sort_keys=False, Dumper=YamlDumperDoubleQuotes
+            ),
+            other_npcs=yaml.dump(
+                self.get_connected_npcs_views(npcs_pack), sort_keys=False, Dumper=YamlDumperDoubleQuotes
+            ),
+            tick_rate=self.cur_world.tick_rate,
+            tick_type=self.cur_world.tick_type,
+            max_attribute_delta=self.settings.max_attribute_delta,
+        )
+
+        return npc_new_states_request
+
+    async def update_npcs_pack(self, npcs_pack: List[Npc]) -> dict[str, BatchOutcome]:
+        """Update the pack in one request. NPCs missing from a malformed answer are
+        updated again split in halves, a single NPC goes through the regular prompt"""
+        if len(npcs_pack) == 1:
+            npcs_outcomes = await self.update_npcs_separately(npcs_pack)
+            return {npcs_pack[0].name: npcs_outcomes[0]}
+
+        prompt = self.get_update_npcs_pack_prompt(npcs_pack)
+        openai_kwargs = self.get_update_npc_openai_kwargs()
+        openai_kwargs.update({"response_processors": [], "stream": False, "hedge": True})
+
+        try:
+            response = await request_openai(prompt=prompt, **openai_kwargs)
+        except Exception as e:
+            return {
+                npc.name: BatchOutcome(index=i, prompt=prompt, error=e, attempts=1)
+                for i, npc in enumerate(npcs_pack)
+            }
+
+        if response is None:
+            error = RequestFailedError("All tries of the packed request failed")
+            return {
+                npc.name: BatchOutcome(index=i, prompt=prompt, error=error, attempts=1)
+                for i, npc in enumerate(npcs_pack)
+            }
+
+        try:
+            npcs_new_data = yaml_from_str(response)
+        except yaml.YAMLError:
+            npcs_new_data = None
+
+        npcs_names = [npc.name for npc in npcs_pack]
+        npcs_outcomes = {}
+        for npc_new_data in npcs_new_data if isinstance(npcs_new_data, list) else []:
+            if not isinstance(npc_new_data, dict):
+                continue
+
+            npc_name = npc_new_data.get("name")
+            if npc_name not in npcs_names or npc_name in npcs_outcomes:
+                continue
+
+            try:
+                check_yaml_update_npc(npc_new_data)
+            except Exception:
+                continue
+
+            npcs_outcomes[npc_name] = BatchOutcome(
+                index=npcs_names.index(npc_name), prompt=prompt, value=npc_new_data, attempts=1
+            )
+            self.partial_states[npc_name] = npc_new_data["npc_new_state"]
+
+        missing_npcs = [npc for npc in npcs_pack if npc.name not in npcs_outcomes]
+        if missing_npcs:
+            debug(
+                f"{bcolors.WARNING}Packed answer is missing {len(missing_npcs)}/{len(npcs_pack)} NPCs, "
+                f"splitting them in halves{bcolors.ENDC}"
+            )
+            half = (len(missing_npcs) + 1) // 2
+            halves_outcomes = await asyncio.gather(
+                *[
+                    self.update_npcs_pack(npcs_half)
+                    for npcs_half in (missing_npcs[:half], missing_npcs[half:])
+                    if npcs_half
+                ]
+            )
+            for half_outcomes in halves_outcomes:
+                npcs_outcomes.update(half_outcomes)
+
+        return npcs_outcomes
+
     def get_update_npc_prompt(self, current_npc: Npc):
-        keys_to_delete = [
-            key
-            for key in self.npcs[0].__dict__.keys()
-            if key not in ["name", "current_state_prompt"]
-        ]
-        other_npcs = [
-            dataclass_to_dict_copy(npc, keys_to_delete)
-            for npc in self.npcs
-            if npc != current_npc and npc.name in current_npc.social_connections
-        ]
+        other_npcs = self.get_connected_npcs_views([current_npc])
 
         npc_new_state_request = npc_new_state.format(
             world_general_description=self.world_general_description,
@@ -377,6 +1001,25 @@ class Game:
         return
 
     async def init_world(self, world_data: dict = None):
+        self.configure_llm_client()
+
+        try:
+            with deadline_scope(self.settings.init_world_deadline):
+                await run_with_deadline(
+                    self.run_init_world(world_data), grace=self.settings.deadline_grace
+                )
+        except DeadlineExceededError:
+            # Everything generated so far is already saved
+            debug(
+                f"{bcolors.FAIL}The world wasn't initialized in {self.settings.init_world_deadline}s, "
+                f"keeping {len(self.npcs)} NPCs generated so far{bcolors.ENDC}"
+            )
+
+        await self.flush()
+
+        return self
+
+    async def run_init_world(self, world_data: dict = None):
         if world_data:
             new_or_load = "n"
         else:
@@ -454,6 +1097,7 @@ class Game:
         self.cur_world_path.mkdir(parents=True, exist_ok=True)
 
         self.world_general_description = self.cur_world.current_state_prompt
+        self.previous_world_state_prompt = ""
 
 
         self.save_world()
@@ -506,6 +1150,7 @@ class Game:
         self.cur_world_path.mkdir(parents=True, exist_ok=True)
 
         self.world_general_description = self.cur_world.current_state_prompt
+        self.previous_world_state_prompt = ""
 
         self.save_world()
 
@@ -612,6 +1257,7 @@ class Game:
         )
 
         self.world_general_description = self.cur_world.current_state_prompt
+        self.previous_world_state_prompt = ""
 
         self.cur_world_path = (
             GAMES_PATH / self.game_name / "worlds" / self.cur_world.name
@@ -636,13 +1282,14 @@ class Game:
         # )
 
         self.cur_world_path = Path(self.game_path / "worlds" / os.listdir(self.game_path / "worlds")[0])
-        last_modified_world_yaml = get_last_modified_file(self.cur_world_path)
-        load_yaml_to_dataclass(self.cur_world, last_modified_world_yaml)
+        storage = self.get_storage()
+        load_dict_to_dataclass(self.cur_world, storage.load_world())
 
-        oldest_modified_world_yaml = get_oldest_modified_file(self.cur_world_path)
-        with open(oldest_modified_world_yaml) as f:
-            oldest_modified_world = yaml.safe_load(f)
-        self.world_general_description = oldest_modified_world["current_state_prompt"]
+        first_world = storage.load_first_world() or {}
+        self.world_general_description = first_world.get("current_state_prompt", "")
+        # Only read here, afterwards it's kept in memory as the ticks go
+        previous_world = storage.load_previous_world() or {}
+        self.previous_world_state_prompt = previous_world.get("current_state_prompt", "")
 
         debug(
             f"{bcolors.OKGREEN}The world: {self.cur_world.name} is loaded{bcolors.ENDC}"
@@ -651,30 +1298,18 @@ class Game:
         return
 
     async def new_npcs(self):
+        """Create `number_of_npcs` NPCs, at most `npc_creation_wave_size` at a time. Each NPC
+        is saved as soon as it is generated, the ones that failed to generate are dropped"""
         if not self.cur_npcs_path.exists():
             self.cur_npcs_path.mkdir(parents=True, exist_ok=True)
 
-        new_npc_prompts = []
-        # Create NPC placeholders and prompts
-        for npc_num in range(self.settings.number_of_npcs):
-            debug(
-                f"{bcolors.OKCYAN}Generating NPC {npc_num+1}/{self.settings.number_of_npcs}...{bcolors.ENDC}"
-            )
-            new_npc = Npc()
-            self.npcs.append(new_npc)
-
-            populate_dataclass_with_dicts(new_npc, [self.settings.npc_attributes_names])
+        self.npcs_to_create = self.settings.number_of_npcs
+        self.npcs_created = 0
 
-            new_npc_prompt = create_npc_request.format(
-                world_general_description=self.world_general_description,
-                world_current_attributes=self.cur_world.attributes,
-                npc_yaml_template=yaml.dump(
-                    new_npc, sort_keys=False, Dumper=YamlDumperDoubleQuotes
-                ),
-                global_goal=random.choice(self.global_goals),
-            )
-
-            new_npc_prompts.append(new_npc_prompt)
+        # The template is the same for every NPC
+        npc_template = Npc()
+        populate_dataclass_with_dicts(npc_template, [self.settings.npc_attributes_names])
+        npc_yaml_template = yaml.dump(npc_template, sort_keys=False, Dumper=YamlDumperDoubleQuotes)
 
         openai_kwargs = {
             "model": self.settings.LLM_model,
@@ -682,39 +1317,67 @@ class Game:
             "response_processors": [yaml_from_str, check_yaml_new_npc],
             "verbose": self.settings.openai_verbose,
             "api_key": os.environ.get("OPENAI_API_KEY"),
+            "client": self.llm_client,
+            "retry_policy": self.retry_policy,
+            "cache": self.response_cache,
         }
-        
-        # NPC batch generation
-        npcs_data = await batch_completion(new_npc_prompts, openai_kwargs=openai_kwargs)
-
-        # Save NPCs to yaml and self.npcs
-        for npc, new_npc_data in zip(self.npcs, npcs_data):
-            self.save_npc(new_npc_data)
-            new_npc_yaml_path = (
-                self.cur_npcs_path
-                / new_npc_data["name"]
-                / f"npc_tick_{self.cur_world.current_tick}.yaml"
-            )
 
-            load_yaml_to_dataclass(npc, new_npc_yaml_path)
+        new_npcs: dict[int, Npc] = {}
+        npcs_nums = iter(range(self.npcs_to_create))
+
+        async def create_npcs():
+            # Every worker takes the next NPC as soon as its previous one is done
+            for npc_num in npcs_nums:
+                new_npc_prompt = create_npc_request.format(
+                    world_general_description=self.world_general_description,
+                    world_current_attributes=self.cur_world.attributes,
+                    npc_yaml_template=npc_yaml_template,
+                    global_goal=random.choice(self.global_goals),
+                )
+                npc_outcome = (
+                    await batch_completion(
+                        [new_npc_prompt],
+                        openai_kwargs=openai_kwargs,
+                        retry_rounds=self.settings.llm_batch_retry_rounds,
+                    )
+                )[0]
+
+                if not npc_outcome.ok:
+                    debug(
+                        f"{bcolors.FAIL}NPC generation failed: {npc_outcome.error!r}{bcolors.ENDC}"
+                    )
+                    continue
 
-            debug(
-                f"{bcolors.OKGREEN}NPC {new_npc.name} generated successfully{bcolors.ENDC}"
-            )
+                new_npcs[npc_num] = self.save_new_npc(npc_outcome.value)
+                self.npcs_created += 1
+
+                debug(
+                    f"{bcolors.OKGREEN}NPC {new_npcs[npc_num].name} generated successfully "
+                    f"({self.npcs_created}/{self.npcs_to_create}){bcolors.ENDC}"
+                )
+
+        wave_size = self.settings.npc_creation_wave_size or self.npcs_to_create
+        await asyncio.gather(*[create_npcs() for _ in range(min(wave_size, self.npcs_to_create))])
+
+        # In the order they were requested, not the order they were generated in
+        self.npcs.extend(new_npcs[npc_num] for npc_num in sorted(new_npcs))
 
         return
 
+    def save_new_npc(self, new_npc_data: dict) -> Npc:
+        self.save_npc(new_npc_data)
+
+        npc = Npc()
+        load_dict_to_dataclass(npc, new_npc_data)
+
+        return npc
+
     def load_npcs(self):
         self.cur_npcs_path = self.cur_world_path / "npcs"
 
-        for npc_path in self.cur_npcs_path.iterdir():
-            # Skip global_goals.yaml file
-            if npc_path.name == "global_goals.yaml":
-                continue
-
+        for npc_data in self.get_storage().load_npcs():
             new_npc = Npc()
-            last_modified_npc_yaml = get_last_modified_file(npc_path)
-            load_yaml_to_dataclass(new_npc, last_modified_npc_yaml)
+            load_dict_to_dataclass(new_npc, npc_data)
             self.npcs.append(new_npc)
 
     async def new_global_goals(self):
@@ -750,6 +1413,9 @@ class Game:
             response_processors=[yaml_from_str],
             verbose=self.settings.openai_verbose,
             api_key=os.environ.get("OPENAI_API_KEY"),
+            client=self.llm_client,
+            retry_policy=self.retry_policy,
+            cache=self.response_cache,
         )
 
         self.save_global_goals()
@@ -761,8 +1427,12 @@ class Game:
         debug(
             f"{bcolors.OKCYAN}Generating social connections between NPCs...{bcolors.ENDC}"
         )
+        # All the NPCs may have failed to generate
+        if not self.npcs:
+            return
+
         # If there is only one npc, skip social connections generation
-        if len(self.npcs) < 2:
+        if len(self.npcs) == 1:
             self.npcs[0].social_connections = []
             self.save_npc(self.npcs[0])
             return
@@ -772,29 +1442,33 @@ class Game:
             for key in self.npcs[0].__dict__.keys()
             if key not in ["name", "global_goal", "current_state_prompt"]
         ]
+        # Every NPC is dumped once and shown to the NPCs it is a candidate of
+        npcs_views = {
+            npc.name: yaml.dump(
+                dataclass_to_dict_copy(npc, keys_to_delete), sort_keys=False, Dumper=YamlDumperDoubleQuotes
+            )
+            for npc in self.npcs
+        }
+        candidates = get_social_candidates(
+            self.npcs,
+            candidates_num=self.settings.social_connections_candidates,
+            mode=self.settings.social_connections_candidates_mode,
+            seed=self.cur_world.name,
+        )
+        npc_social_connection_yaml_template = load_yaml(
+            YAML_TEMPLATES_PATH / "npc_social_connections.yaml"
+        )
 
         social_connections_prompts = []
 
         for current_npc in self.npcs:
-            corresponding_other_npcs = []
-            for other_npc in self.npcs:
-                if current_npc == other_npc:
-                    continue
-                npc_dict = dataclass_to_dict_copy(other_npc, keys_to_delete)
-                corresponding_other_npcs.append(npc_dict)
-            
             created_social_connections_prompt = create_social_connections.format(
                 world_general_description=self.cur_world.current_state_prompt,
                 current_npc_name=current_npc.name,
                 current_npc_state=current_npc.current_state_prompt,
                 max_npc_social_connections=self.settings.max_npc_social_connections,
-                npc_social_connection_yaml_template=load_yaml(
-                    YAML_TEMPLATES_PATH / "npc_social_connections.yaml"
-                ),
-                other_npcs=[
-                    yaml.dump(npc, sort_keys=False, Dumper=YamlDumperDoubleQuotes)
-                    for npc in corresponding_other_npcs
-                ],
+                npc_social_connection_yaml_template=npc_social_connection_yaml_template,
+                other_npcs=[npcs_views[name] for name in candidates[current_npc.name]],
             )
 
             social_connections_prompts.append(created_social_connections_prompt)
@@ -805,50 +1479,128 @@ class Game:
             "response_processors": [yaml_from_str],
             "verbose": self.settings.openai_verbose,
             "api_key": os.environ.get("OPENAI_API_KEY"),
+            "client": self.llm_client,
+            "retry_policy": self.retry_policy,
+            "cache": self.response_cache,
         }
 
-        npcs_social_connections = await batch_completion(social_connections_prompts, openai_kwargs=openai_kwargs)
+        npcs_social_connections = await batch_completion(
+            social_connections_prompts,
+            openai_kwargs=openai_kwargs,
+            retry_rounds=self.settings.llm_batch_retry_rounds,
+        )
 
-        for current_npc, current_npc_social_connections in zip(self.npcs, npcs_social_connections):
-            current_npc.social_connections = current_npc_social_connections
-            self.save_npc(current_npc)
+        # NPCs whose connections failed to generate stay without connections
+        social_connections = {}
+        for current_npc, social_connections_outcome in zip(self.npcs, npcs_social_connections):
+            if social_connections_outcome.ok and isinstance(social_connections_outcome.value, list):
+                social_connections[current_npc.name] = social_connections_outcome.value
+            else:
+                social_connections[current_npc.name] = []
+                debug(
+                    f"{bcolors.FAIL}Social connections of {current_npc.name} failed to generate: "
+                    f"{social_connections_outcome.error!r}{bcolors.ENDC}"
+                )
 
-    def save_world(self):
-        self.cur_world_path.mkdir(parents=True, exist_ok=True)
-        save_path = (
-            self.cur_world_path / f"world_tick_{self.cur_world.current_tick}.yaml"
-        )
+        if self.settings.social_connections_symmetric:
+            social_connections = symmetrize_social_connections(
+                self.npcs, social_connections, self.settings.max_npc_social_connections
+            )
+
+        for current_npc in self.npcs:
+            current_npc.social_connections = social_connections[current_npc.name]
+        self.save_npcs()
+
+    def save_world(self, world: World = None):
+        if world is None:
+            world = self.cur_world
+
+        self.storage_writer.save(self.get_storage().save_world, copy.deepcopy(world))
+
+        return
 
-        save_yaml_from_data(save_path, self.cur_world)
+    def save_tick(self, world: World, npcs: List[Npc]):
+        """Save a snapshot of the world and NPC states of one tick, they mustn't be changed afterwards"""
+        self.storage_writer.save(self.get_storage().save_tick, world, npcs)
 
         return
 
     def save_global_goals(self):
-        self.cur_global_goals_path.parent.mkdir(parents=True, exist_ok=True)
-        save_yaml_from_data(self.cur_global_goals_path, self.global_goals)
+        self.storage_writer.save(self.get_storage().save_global_goals, copy.deepcopy(self.global_goals))
 
         return
 
-    def save_npcs(self):
-        for npc in self.npcs:
-            self.save_npc(npc)
+    def save_npcs(self, npcs: List[Npc] = None, tick: int = None):
+        if npcs is None:
+            npcs = self.npcs
+
+        if tick is None:
+            tick = self.cur_world.current_tick
+
+        self.storage_writer.save(self.get_storage().save_npcs, copy.deepcopy(npcs), tick)
 
         return
 
-    def save_npc(self, npc_data: dict | Npc):
-        if isinstance(npc_data, dict):
-            npc_name = npc_data["name"]
-        else:
-            npc_name = npc_data.name
+    def save_npc(self, npc_data: dict | Npc, tick: int = None):
+        if tick is None:
+            tick = self.cur_world.current_tick
 
-        npc_dir = self.cur_npcs_path / npc_name
-        npc_dir.mkdir(parents=True, exist_ok=True)
-        save_yaml_from_data(
-            npc_dir / f"npc_tick_{self.cur_world.current_tick}.yaml", npc_data
-        )
+        self.storage_writer.save(self.get_storage().save_npc, copy.deepcopy(npc_data), tick)
+
+        return
+
+    async def flush(self):
+        """Wait until every state saved so far is written and durable. The saves
+        don't block the event loop, they are written in the background in order"""
+        await self.storage_writer.flush()
+        if self.storage is not None:
+            await asyncio.to_thread(self.storage.flush)
 
         return
 
+    def get_storage(self) -> YamlStorage | LogStorage | SqliteStorage:
+        """Storage of the current world's states, created for the `storage_backend`
+        setting and the world's directory when they change"""
+        storage = self.storage
+        if (
+            storage is None
+            or storage.backend != self.settings.storage_backend
+            or storage.world_path != Path(self.cur_world_path)
+        ):
+            self.close_storage()
+            if self.settings.storage_backend == "log":
+                storage = LogStorage(
+                    self.cur_world_path,
+                    segment_max_bytes=self.settings.log_segment_max_mb * 2**20,
+                    fsync_every=self.settings.log_fsync_every,
+                )
+                # A world saved in the YAML layout, e.g. uploaded or created with another backend
+                if storage.load_world() is None and YamlStorage(self.cur_world_path).load_world() is not None:
+                    storage.import_yaml()
+            elif self.settings.storage_backend == "sqlite":
+                storage = SqliteStorage(self.cur_world_path)
+                # A world saved in the YAML layout, e.g. uploaded or created with another backend
+                if storage.load_world() is None and YamlStorage(self.cur_world_path).load_world() is not None:
+                    storage.import_yaml()
+            else:
+                storage = YamlStorage(self.cur_world_path)
+            self.storage = storage
+
+        return storage
+
+    def close_storage(self):
+        """Close the storage once the saves queued so far are written"""
+        if self.storage is not None:
+            self.storage_writer.save(self.storage.close)
+            self.storage = None
+
+        return
+
+    def export_yaml(self, export_path: Path | None = None) -> Path:
+        """Write the saved states of the current world in the YAML layout, to the
+        world's directory by default"""
+        return self.get_storage().export_yaml(export_path)
+
     def is_in_existing_items(self, existing_items: List | None, item_name: str):
         in_existing_items = False
         if not existing_items:
@@ -931,27 +1683,41 @@ class Game:
         sys.exit(0)
 
     async def generate_images(self):
+        await self.generate_images_from_requests(*self.get_images_requests())
+
+        return
+
+    def get_images_requests(self, world: World = None, npcs: List[Npc] = None) -> tuple[list[str], list[str]]:
+        """Paths and prompts of the images of the given (by default the current) world and NPC states"""
+        if world is None:
+            world = self.cur_world
+        if npcs is None:
+            npcs = self.npcs
+
         image_paths = []
         img_prompts = []
 
         if self.settings.text_to_image_generate_world:
-            image_paths.append(str(self.cur_world_path / f"world_tick_{self.cur_world.current_tick}.jpg"))
-            img_prompts.append(self.cur_world.current_state_prompt)
+            image_paths.append(str(self.cur_world_path / f"world_tick_{world.current_tick}.jpg"))
+            img_prompts.append(world.current_state_prompt)
 
         if self.settings.text_to_image_generate_npcs:
-            for npc in self.npcs:
+            for npc in npcs:
                 npc_image_prompt = generate_npc_image.format(
                     npc_name=npc.name,
                     npc_current_state_prompt=npc.current_state_prompt,
-                    world_current_state_prompt=self.cur_world.current_state_prompt,
-                    daytime=hour_to_daytime(self.cur_world.time["current_hour"]),
+                    world_current_state_prompt=world.current_state_prompt,
+                    daytime=hour_to_daytime(world.time["current_hour"]),
                     date=self.current_date_to_str(),
-                    temperature=self.cur_world.attributes["temperature"],
+                    temperature=world.attributes["temperature"],
                 )
                 
-                image_paths.append(str(self.cur_npcs_path / npc.name / f"npc_tick_{self.cur_world.current_tick}.jpg"))
+                image_paths.append(str(self.cur_npcs_path / npc.name / f"npc_tick_{world.current_tick}.jpg"))
                 img_prompts.append(npc_image_prompt)
 
+        return image_paths, img_prompts
+
+    async def generate_images_from_requests(self, image_paths: list[str], img_prompts: list[str]):
         openai_kwargs = {
             "model_name": self.settings.text_to_image_model,
             "tries_num": self.settings.llm_request_tries_num,
@@ -962,11 +1728,19 @@ class Game:
             "img_size": self.settings.text_to_image_size,
             "img_quality": self.settings.text_to_image_quality,
             "img_n": self.settings.text_to_image_n,
-            "response_format": "b64_json"
+            "response_format": "b64_json",
+            "client": self.llm_client,
+            "retry_policy": self.retry_policy,
+            "cache": self.response_cache,
         }
 
+        # Only the YAML storage creates the NPCs' directories
+        for image_dir in {Path(image_path).parent for image_path in image_paths}:
+            image_dir.mkdir(parents=True, exist_ok=True)
+
         await batch_image_generation(image_paths, img_prompts, openai_kwargs)
 
+        return
 
 if __name__ == "__main__":
     # with open(YAML_TEMPLATES_PATH / "npc.yaml", "r") as f:
@@ -0,0 +1,157 @@
+from collections.abc import MutableMapping
+import numpy as np
+import yaml
+from utils import YamlDumperDoubleQuotes
+
+
+def to_number(value) -> float | None:
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def from_number(value: float) -> int | float:
+    return int(value) if float(value).is_integer() else float(value)
+
+
+class AttributesView(MutableMapping):
+    """`Npc.attributes` of an NPC whose attributes live in an `AttributeStore`.
+
+    Behaves like the NPC's attributes dict (same keys in the same order) while the
+    numeric values are read from and written to the NPC's row of the store. Values
+    that aren't numbers are kept in the view itself. A deep copy is a plain dict,
+    so the snapshots of the states don't change with the store.
+    """
+
+    def __init__(self, store: "AttributeStore", row: int, keys: list[str], others: dict | None = None):
+        self.store = store
+        self.row = row
+        self._keys = keys
+        self._others = others or {}
+
+    def __getitem__(self, key):
+        if key in self._others:
+            return self._others[key]
+        if key not in self._keys:
+            raise KeyError(key)
+
+        return from_number(self.store.values[self.row, self.store.columns[key]])
+
+    def __setitem__(self, key, value):
+        number = to_number(value)
+        if number is None or key not in self.store.columns:
+            self._others[key] = value
+        else:
+            self._others.pop(key, None)
+            self.store.values[self.row, self.store.columns[key]] = number
+
+        if key not in self._keys:
+            self._keys.append(key)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+
+        self._keys.remove(key)
+        self._others.pop(key, None)
+        if key in self.store.columns:
+            self.store.values[self.row, self.store.columns[key]] = np.nan
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __deepcopy__(self, memo):
+        return dict(self)
+
+
+def represent_attributes_view(dumper: yaml.Dumper, view: AttributesView):
+    return dumper.represent_dict(dict(view))
+
+
+for dumper in (yaml.Dumper, yaml.SafeDumper, YamlDumperDoubleQuotes):
+    yaml.add_representer(AttributesView, represent_attributes_view, Dumper=dumper)
+
+
+class AttributeStore:
+    """Numeric attributes of all the NPCs in one (NPCs, attributes) array.
+
+    The columns are `npc_attributes_names` followed by any other numeric attribute
+    the NPCs have. Attributes an NPC doesn't have are NaN, so the deltas of a tick
+    are applied to all NPCs at once with one clip and add, and the aggregate stats
+    are computed only when asked for.
+    """
+
+    def __init__(self, npcs: list, attributes_names: list[str] | None = None):
+        columns_names = list(dict.fromkeys(attributes_names or []))
+        for npc in npcs:
+            for key, value in npc.attributes.items():
+                if key not in columns_names and to_number(value) is not None:
+                    columns_names.append(key)
+
+        self.columns: dict[str, int] = {name: i for i, name in enumerate(columns_names)}
+        self.values = np.full((len(npcs), len(columns_names)), np.nan)
+
+        for row, npc in enumerate(npcs):
+            view = AttributesView(self, row, [])
+            for key, value in npc.attributes.items():
+                view[key] = value
+            npc.attributes = view
+
+        self.npcs_num = len(npcs)
+
+    def is_bound(self, npcs: list) -> bool:
+        """False if the NPCs or their attributes dicts have been replaced since the store was built"""
+        return len(npcs) == self.npcs_num and all(
+            isinstance(npc.attributes, AttributesView)
+            and npc.attributes.store is self
+            and npc.attributes.row == row
+            for row, npc in enumerate(npcs)
+        )
+
+    def new_deltas(self) -> np.ndarray:
+        return np.zeros_like(self.values)
+
+    def set_deltas(self, deltas: np.ndarray, row: int, npc_deltas: dict):
+        """Fill the row of `deltas` with the NPC's deltas, the ones that aren't numbers are ignored"""
+        if not isinstance(npc_deltas, dict):
+            return
+
+        for key, value in npc_deltas.items():
+            column = self.columns.get(key)
+            number = to_number(value)
+            if column is not None and number is not None:
+                deltas[row, column] = number
+
+        return
+
+    def add_deltas(self, deltas: np.ndarray, max_delta: float = 0):
+        """Add the deltas of all the NPCs, each clipped to ±`max_delta` if it is > 0"""
+        if max_delta > 0:
+            np.clip(deltas, -max_delta, max_delta, out=deltas)
+        self.values += deltas
+
+        return
+
+    def get_stats(self) -> dict[str, dict[str, float]]:
+        """Mean, minimum and maximum of every attribute over the NPCs that have it"""
+        stats = {}
+        for name, column in self.columns.items():
+            values = self.values[:, column]
+            values = values[~np.isnan(values)]
+            if values.size:
+                stats[name] = {
+                    "mean": float(values.mean()),
+                    "min": float(values.min()),
+                    "max": float(values.max()),
+                }
+
+        return stats
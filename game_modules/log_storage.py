@@ -0,0 +1,284 @@
+from collections import defaultdict
+from collections.abc import Iterator, Mapping
+import json
+import os
+from pathlib import Path
+import threading
+from game_modules.yaml_storage import YamlStorage, get_file_tick
+
+
+def get_state(data) -> dict:
+    """The fields of a world or NPC dataclass (or its dict) as they are saved"""
+    return data if isinstance(data, dict) else dict(vars(data))
+
+
+def to_json(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+
+    return str(value)
+
+
+class LogStorage:
+    """The states of a world as records appended to a log.
+
+    Each record is one JSON line {"kind", "tick", "name", "state"} of the world
+    ("world"), an NPC ("npc") or the global goals ("global_goals"). The log is
+    split in segments (log/segment_N.jsonl) of about `segment_max_bytes`: a new
+    one is started when a tick is saved and the current one is full, so the
+    records of a tick are never split between segments. The file is flushed after
+    every save and fsynced every `fsync_every` ticks and on `flush()`/`close()`,
+    so a crash loses at most the last few ticks.
+
+    The latest states are read from the end of the last segment only, however
+    long the history is. The global goals, saved only when the world is created,
+    are also kept in log/global_goals.json so loading them doesn't read the log.
+    `import_yaml`/`export_yaml` convert from and to the YAML layout (see `YamlStorage`).
+    """
+
+    backend = "log"
+
+    def __init__(self, world_path: Path | str, segment_max_bytes: int = 16 * 2**20, fsync_every: int = 10):
+        self.world_path = Path(world_path)
+        self.log_path = self.world_path / "log"
+        self.global_goals_path = self.log_path / "global_goals.json"
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_every = max(1, fsync_every)
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        self._last_tick = None
+        self._unsynced_ticks = 0
+
+    def get_segments(self) -> list[Path]:
+        if not self.log_path.exists():
+            return []
+
+        return sorted(self.log_path.glob("segment_*.jsonl"), key=lambda path: int(path.stem.split("_")[1]))
+
+    def _open(self, tick: int):
+        if self._file is None:
+            segments = self.get_segments()
+            self._segment = segments[-1] if segments else self.log_path / "segment_0.jsonl"
+            self.log_path.mkdir(parents=True, exist_ok=True)
+            self._file = open(self._segment, "a", encoding="utf-8")
+
+        if tick != self._last_tick and self._file.tell() >= self.segment_max_bytes:
+            self._sync()
+            self._file.close()
+            self._segment = self.log_path / f"segment_{int(self._segment.stem.split('_')[1]) + 1}.jsonl"
+            self._file = open(self._segment, "a", encoding="utf-8")
+
+        return self._file
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced_ticks = 0
+
+        return
+
+    def append(self, records: list[dict]):
+        """Append the records of one save, all of the same tick"""
+        with self._lock:
+            tick = records[0]["tick"]
+            file = self._open(tick)
+            file.write("".join(json.dumps(record, default=to_json) + "\n" for record in records))
+            file.flush()
+
+            if tick != self._last_tick:
+                self._last_tick = tick
+                self._unsynced_ticks += 1
+                if self._unsynced_ticks >= self.fsync_every:
+                    self._sync()
+
+        return
+
+    def save_world(self, world, tick: int | None = None):
+        state = get_state(world)
+        if tick is None:
+            tick = state["current_tick"]
+        self.append([{"kind": "world", "tick": tick, "name": state["name"], "state": state}])
+
+        return
+
+    def save_npc(self, npc_data, tick: int):
+        state = get_state(npc_data)
+        self.append([{"kind": "npc", "tick": tick, "name": state["name"], "state": state}])
+
+        return
+
+    def save_npcs(self, npcs: list, tick: int):
+        states = [get_state(npc) for npc in npcs]
+        if states:
+            self.append([{"kind": "npc", "tick": tick, "name": state["name"], "state": state} for state in states])
+
+        return
+
+    def save_tick(self, world, npcs: list):
+        tick = world.current_tick
+        self.append(
+            [{"kind": "world", "tick": tick, "name": world.name, "state": get_state(world)}]
+            + [{"kind": "npc", "tick": tick, "name": npc.name, "state": get_state(npc)} for npc in npcs]
+        )
+
+        return
+
+    def save_global_goals(self, global_goals: list):
+        tick = self._last_tick if self._last_tick is not None else 0
+        self.append([{"kind": "global_goals", "tick": tick, "name": "", "state": global_goals}])
+
+        temp_path = self.global_goals_path.with_suffix(".json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(global_goals, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.global_goals_path)
+
+        return
+
+    @staticmethod
+    def read_records(segment: Path) -> Iterator[dict]:
+        with open(segment, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a segment cut by a crash
+                    continue
+
+    @staticmethod
+    def read_records_backwards(segment: Path, block_size: int = 2**16) -> Iterator[dict]:
+        """The records of the segment from the last one, reading only as much of it as needed"""
+        with open(segment, "rb") as f:
+            position = f.seek(0, os.SEEK_END)
+            rest = b""
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + rest).split(b"\n")
+                # The first line may continue in the previous block
+                rest = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        try:
+                            yield json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+            if rest.strip():
+                try:
+                    yield json.loads(rest)
+                except json.JSONDecodeError:
+                    pass
+
+    def read_tail(self) -> Iterator[dict]:
+        """All the records from the last one backwards"""
+        for segment in reversed(self.get_segments()):
+            yield from self.read_records_backwards(segment)
+
+    def load_world(self) -> dict | None:
+        """The latest state of the world"""
+        return next((record["state"] for record in self.read_tail() if record["kind"] == "world"), None)
+
+    def load_first_world(self) -> dict | None:
+        """The state the world was created with"""
+        for segment in self.get_segments():
+            for record in self.read_records(segment):
+                if record["kind"] == "world":
+                    return record["state"]
+
+        return None
+
+    def load_previous_world(self) -> dict | None:
+        """The state of the world before the latest one"""
+        worlds_records = (record for record in self.read_tail() if record["kind"] == "world")
+        last_record = next(worlds_records, None)
+        if last_record is None:
+            return None
+
+        # The latest tick may have been saved again after the states were edited
+        return next(
+            (record["state"] for record in worlds_records if record["tick"] < last_record["tick"]), None
+        )
+
+    def load_npcs(self) -> list[dict]:
+        """The latest state of every NPC, read back to the latest state of the world
+        (every tick saves the world and all the NPCs)"""
+        npcs_records: dict[str, dict] = {}
+        world_tick = None
+        for record in self.read_tail():
+            if world_tick is not None and record["tick"] < world_tick:
+                break
+            if record["kind"] == "world" and world_tick is None:
+                world_tick = record["tick"]
+            elif record["kind"] == "npc":
+                npcs_records.setdefault(record["name"], record)
+
+        # In the order they were saved in
+        return [record["state"] for record in reversed(npcs_records.values())]
+
+    def load_global_goals(self) -> list:
+        if self.global_goals_path.exists():
+            with open(self.global_goals_path, encoding="utf-8") as f:
+                return json.load(f)
+
+        # A log saved before global_goals.json was added
+        return next((record["state"] for record in self.read_tail() if record["kind"] == "global_goals"), [])
+
+    def import_yaml(self, import_path: Path | str | None = None):
+        """Append the states saved in the YAML layout, in the world's directory by default"""
+        yaml_storage = YamlStorage(import_path or self.world_path)
+        ticks_files: dict[int, list[tuple[str, Path]]] = defaultdict(list)
+        for world_file in yaml_storage.world_path.glob("world_tick_*.yaml"):
+            ticks_files[get_file_tick(world_file)].append(("world", world_file))
+        if yaml_storage.npcs_path.exists():
+            for npc_file in sorted(yaml_storage.npcs_path.glob("*/npc_tick_*.yaml")):
+                ticks_files[get_file_tick(npc_file)].append(("npc", npc_file))
+
+        # One save per tick, the world first like `save_tick`
+        for tick in sorted(ticks_files):
+            records = [
+                {"kind": kind, "tick": tick, "name": state["name"], "state": state}
+                for kind, path in sorted(ticks_files[tick], key=lambda item: item[0] != "world")
+                if (state := yaml_storage._load(path))
+            ]
+            if records:
+                self.append(records)
+        self.save_global_goals(yaml_storage.load_global_goals())
+        self.flush()
+
+        return
+
+    def export_yaml(self, export_path: Path | str | None = None) -> Path:
+        """Write every saved state in the YAML layout (see `YamlStorage`), to the world's directory by default"""
+        yaml_storage = YamlStorage(export_path or self.world_path)
+        for segment in self.get_segments():
+            for record in self.read_records(segment):
+                if record["kind"] == "world":
+                    yaml_storage.write_world(record["state"], record["tick"])
+                elif record["kind"] == "npc":
+                    yaml_storage.write_npc(record["state"], record["tick"])
+                elif record["kind"] == "global_goals":
+                    yaml_storage.save_global_goals(record["state"])
+        yaml_storage.reindex()
+
+        return yaml_storage.world_path
+
+    def flush(self):
+        """Make everything saved so far durable"""
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+        return
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+        return
@@ -0,0 +1,158 @@
+import heapq
+import random
+import re
+
+
+class SocialGraph:
+    """Index of the NPCs' social connections used to build their prompts.
+
+    Built once per tick from the NPCs (name to index map, connection sets and the
+    `name` + `current_state_prompt` view of every NPC shown to the NPCs connected
+    with it), so building the prompts of N NPCs takes O(N + connections) instead
+    of scanning all the NPCs for each of them. The views are shared, don't modify
+    them.
+    """
+
+    def __init__(self, npcs: list):
+        self.fingerprint = self.get_fingerprint(npcs)
+
+        self.indices: dict[str, int] = {npc.name: i for i, npc in enumerate(npcs)}
+        self.views: list[dict] = [
+            {"name": npc.name, "current_state_prompt": npc.current_state_prompt} for npc in npcs
+        ]
+        # Names each NPC is connected with, only the existing NPCs other than itself
+        self.connections: dict[str, set[str]] = {
+            npc.name: {
+                name
+                for name in npc.social_connections or []
+                if name in self.indices and name != npc.name
+            }
+            for npc in npcs
+        }
+
+    @staticmethod
+    def get_fingerprint(npcs: list) -> list[tuple]:
+        return [
+            (npc.name, npc.current_state_prompt, tuple(npc.social_connections or ()))
+            for npc in npcs
+        ]
+
+    def is_current(self, npcs: list) -> bool:
+        """False if the NPCs, their states or their connections have changed since the graph was built"""
+        return self.get_fingerprint(npcs) == self.fingerprint
+
+    def get_connected_views(self, npcs: list) -> list[dict]:
+        """Views of the NPCs connected with any of `npcs` (excluding them), in the NPCs' order"""
+        names = {npc.name for npc in npcs}
+        connected_names = set()
+        for name in names:
+            connected_names |= self.connections.get(name, set())
+        connected_names -= names
+
+        return [self.views[i] for i in sorted(self.indices[name] for name in connected_names)]
+
+
+def get_words(text: str) -> set[str]:
+    return {word for word in re.findall(r"\w+", str(text).lower()) if len(word) > 2}
+
+
+def get_social_candidates(
+    npcs: list,
+    candidates_num: int = 0,
+    mode: str = "similar",
+    seed: str | int = 0,
+    max_word_npcs: int = 50,
+) -> dict[str, list[str]]:
+    """Names of the NPCs each NPC may choose its social connections from.
+
+    With `candidates_num` <= 0 every other NPC is a candidate. Otherwise each NPC gets
+    `candidates_num` candidates: in the "random" mode its neighbours in a random ring
+    of all the NPCs (every NPC is a candidate of as many NPCs as it has candidates),
+    in the "similar" mode the NPCs sharing the most (and rarest) words of the name,
+    global goal and state with it, topped up with random ones. Words shared by more
+    than `max_word_npcs` NPCs are ignored, so it takes near linear time.
+    """
+    names = [npc.name for npc in npcs]
+    if candidates_num <= 0 or candidates_num >= len(names) - 1:
+        return {name: [other_name for other_name in names if other_name != name] for name in names}
+
+    rng = random.Random(seed)
+
+    if mode == "random":
+        ring = names[:]
+        rng.shuffle(ring)
+        candidates = {}
+        for i, name in enumerate(ring):
+            offsets = [offset for step in range(1, candidates_num // 2 + 2) for offset in (step, -step)]
+            candidates[name] = list(
+                dict.fromkeys(ring[(i + offset) % len(ring)] for offset in offsets)
+            )[:candidates_num]
+        return candidates
+
+    npcs_words = [
+        get_words(f"{npc.name} {npc.global_goal} {npc.current_state_prompt}") for npc in npcs
+    ]
+    word_npcs: dict[str, list[int]] = {}
+    for i, words in enumerate(npcs_words):
+        for word in words:
+            word_npcs.setdefault(word, []).append(i)
+
+    candidates = {}
+    for i, words in enumerate(npcs_words):
+        scores: dict[int, float] = {}
+        for word in words:
+            same_word_npcs = word_npcs[word]
+            if len(same_word_npcs) > max_word_npcs:
+                continue
+            for j in same_word_npcs:
+                if j != i:
+                    scores[j] = scores.get(j, 0.0) + 1 / len(same_word_npcs)
+
+        similar = heapq.nlargest(candidates_num, scores, key=lambda j: (scores[j], -j))
+        npc_candidates = [names[j] for j in similar]
+
+        # Strangers can be connected too and keep the graph from splitting into cliques
+        while len(npc_candidates) < candidates_num:
+            name = names[rng.randrange(len(names))]
+            if name != names[i] and name not in npc_candidates:
+                npc_candidates.append(name)
+
+        candidates[names[i]] = npc_candidates
+
+    return candidates
+
+
+def symmetrize_social_connections(
+    npcs: list, social_connections: dict[str, list[str]], max_connections: int = 0
+) -> dict[str, list[str]]:
+    """Make the connections chosen by the NPCs mutual: if A is connected with B, B is
+    connected with A. Names of unknown NPCs are dropped. Connections chosen by both
+    NPCs are added first, then the one-sided ones while both NPCs have fewer than
+    `max_connections` (if > 0) connections"""
+    names = {npc.name for npc in npcs}
+    chosen = {
+        npc.name: [
+            name
+            for name in social_connections.get(npc.name) or []
+            if isinstance(name, str) and name in names and name != npc.name
+        ]
+        for npc in npcs
+    }
+
+    pairs = [(name, other_name) for name in chosen for other_name in chosen[name]]
+    mutual_pairs = [pair for pair in pairs if pair[0] in chosen[pair[1]]]
+    one_sided_pairs = [pair for pair in pairs if pair[0] not in chosen[pair[1]]]
+
+    connections: dict[str, list[str]] = {npc.name: [] for npc in npcs}
+    for name, other_name in mutual_pairs + one_sided_pairs:
+        if other_name in connections[name]:
+            continue
+        if max_connections > 0 and (
+            len(connections[name]) >= max_connections or len(connections[other_name]) >= max_connections
+        ):
+            continue
+
+        connections[name].append(other_name)
+        connections[other_name].append(name)
+
+    return connections
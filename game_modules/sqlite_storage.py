@@ -0,0 +1,263 @@
+from collections.abc import Mapping
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from game_modules.attribute_store import to_number
+from game_modules.log_storage import get_state, to_json
+from game_modules.yaml_storage import YamlStorage, get_file_tick
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS worlds (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    global_goals TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS npcs (
+    id INTEGER PRIMARY KEY,
+    world_id INTEGER NOT NULL REFERENCES worlds (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    UNIQUE (world_id, name)
+);
+-- A state of the world (npc_id is NULL) or of one of its NPCs at a tick
+CREATE TABLE IF NOT EXISTS ticks (
+    id INTEGER PRIMARY KEY,
+    world_id INTEGER NOT NULL REFERENCES worlds (id) ON DELETE CASCADE,
+    npc_id INTEGER REFERENCES npcs (id) ON DELETE CASCADE,
+    tick INTEGER NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ticks_world_tick ON ticks (world_id, tick);
+CREATE INDEX IF NOT EXISTS ticks_npc_tick ON ticks (npc_id, tick);
+-- The numeric attributes of every state, to query them without parsing the states
+CREATE TABLE IF NOT EXISTS attributes (
+    tick_id INTEGER NOT NULL REFERENCES ticks (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attributes_tick ON attributes (tick_id);
+CREATE INDEX IF NOT EXISTS attributes_name_value ON attributes (name, value);
+"""
+
+
+class SqliteStorage:
+    """The states of a world in the game's SQLite database (game.sqlite3 in the game's directory).
+
+    Every world and NPC state is a row of `ticks` (the state as JSON) and its
+    numeric attributes rows of `attributes`, so the history can be queried
+    directly, e.g. the NPCs whose health dropped below 0 at any tick:
+
+        SELECT DISTINCT npcs.name FROM attributes
+        JOIN ticks ON ticks.id = attributes.tick_id JOIN npcs ON npcs.id = ticks.npc_id
+        WHERE attributes.name = 'health' AND attributes.value < 0
+
+    The database is in WAL mode, so it can be read while the game is saving.
+    `import_yaml`/`export_yaml` convert from and to the YAML layout (see `YamlStorage`).
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, world_path: Path | str, db_path: Path | str | None = None):
+        self.world_path = Path(world_path)
+        # <game>/worlds/<world>
+        self.db_path = Path(db_path) if db_path else self.world_path.parent.parent / "game.sqlite3"
+
+        self._lock = threading.Lock()
+        self._npcs_ids: dict[str, int] = {}
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Saved from a worker thread and loaded from the event loop's, one at a time
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+
+        with self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO worlds (name) VALUES (?)", (self.world_path.name,))
+        (self.world_id,) = self._connection.execute(
+            "SELECT id FROM worlds WHERE name = ?", (self.world_path.name,)
+        ).fetchone()
+
+    def get_npc_id(self, name: str) -> int:
+        """Id of the NPC, added to the world if it's new. Called within a save's transaction"""
+        if name not in self._npcs_ids:
+            world_id = self.world_id
+            self._connection.execute("INSERT OR IGNORE INTO npcs (world_id, name) VALUES (?, ?)", (world_id, name))
+            (self._npcs_ids[name],) = self._connection.execute(
+                "SELECT id FROM npcs WHERE world_id = ? AND name = ?", (world_id, name)
+            ).fetchone()
+
+        return self._npcs_ids[name]
+
+    def insert_state(self, npc_id: int | None, tick: int, state: dict):
+        """Insert the state of the world (`npc_id` None) or an NPC, replacing the one of the same tick"""
+        world_id = self.world_id
+        self._connection.execute(
+            "DELETE FROM ticks WHERE world_id = ? AND npc_id IS ? AND tick = ?", (world_id, npc_id, tick)
+        )
+        tick_id = self._connection.execute(
+            "INSERT INTO ticks (world_id, npc_id, tick, state) VALUES (?, ?, ?, ?)",
+            (world_id, npc_id, tick, json.dumps(state, default=to_json)),
+        ).lastrowid
+
+        attributes = state.get("attributes")
+        if isinstance(attributes, Mapping):
+            self._connection.executemany(
+                "INSERT INTO attributes (tick_id, name, value) VALUES (?, ?, ?)",
+                [
+                    (tick_id, name, number)
+                    for name, value in attributes.items()
+                    if (number := to_number(value)) is not None
+                ],
+            )
+
+        return
+
+    def save_world(self, world, tick: int | None = None):
+        state = get_state(world)
+        if tick is None:
+            tick = state["current_tick"]
+
+        with self._lock, self._connection:
+            self.insert_state(None, tick, state)
+
+        return
+
+    def save_npc(self, npc_data, tick: int):
+        state = get_state(npc_data)
+        with self._lock, self._connection:
+            self.insert_state(self.get_npc_id(state["name"]), tick, state)
+
+        return
+
+    def save_npcs(self, npcs: list, tick: int):
+        with self._lock, self._connection:
+            for npc in npcs:
+                state = get_state(npc)
+                self.insert_state(self.get_npc_id(state["name"]), tick, state)
+
+        return
+
+    def save_tick(self, world, npcs: list):
+        """Save the world and all the NPCs in one transaction"""
+        tick = world.current_tick
+        with self._lock, self._connection:
+            self.insert_state(None, tick, get_state(world))
+            for npc in npcs:
+                self.insert_state(self.get_npc_id(npc.name), tick, get_state(npc))
+
+        return
+
+    def save_global_goals(self, global_goals: list):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE worlds SET global_goals = ? WHERE id = ?", (json.dumps(global_goals), self.world_id)
+            )
+
+        return
+
+    def load_world_state(self, order: str, before_tick: int | None = None) -> dict | None:
+        query = "SELECT state FROM ticks WHERE world_id = ? AND npc_id IS NULL"
+        parameters = [self.world_id]
+        if before_tick is not None:
+            query += " AND tick < ?"
+            parameters.append(before_tick)
+        query += f" ORDER BY tick {order}, id {order} LIMIT 1"
+
+        with self._lock:
+            row = self._connection.execute(query, parameters).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def load_world(self) -> dict | None:
+        """The latest state of the world"""
+        return self.load_world_state("DESC")
+
+    def load_first_world(self) -> dict | None:
+        """The state the world was created with"""
+        return self.load_world_state("ASC")
+
+    def load_previous_world(self) -> dict | None:
+        """The state of the world before the latest one"""
+        world = self.load_world()
+        if world is None:
+            return None
+
+        return self.load_world_state("DESC", before_tick=world["current_tick"])
+
+    def load_npcs(self) -> list[dict]:
+        """The latest state of every NPC, in the order they were created"""
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT ticks.state FROM npcs JOIN ticks ON ticks.id = (
+                    SELECT id FROM ticks WHERE npc_id = npcs.id ORDER BY tick DESC, id DESC LIMIT 1
+                )
+                WHERE npcs.world_id = ? ORDER BY npcs.id
+                """,
+                (self.world_id,),
+            ).fetchall()
+
+        return [json.loads(state) for (state,) in rows]
+
+    def load_global_goals(self) -> list:
+        with self._lock:
+            (global_goals,) = self._connection.execute(
+                "SELECT global_goals FROM worlds WHERE id = ?", (self.world_id,)
+            ).fetchone()
+
+        return json.loads(global_goals)
+
+    def import_yaml(self, import_path: Path | str | None = None):
+        """Add the states saved in the YAML layout, in the world's directory by default"""
+        yaml_storage = YamlStorage(import_path or self.world_path)
+        world_files = sorted(yaml_storage.world_path.glob("world_tick_*.yaml"), key=get_file_tick)
+        npcs_files = sorted(
+            yaml_storage.npcs_path.glob("*/npc_tick_*.yaml") if yaml_storage.npcs_path.exists() else [],
+            key=get_file_tick,
+        )
+
+        with self._lock, self._connection:
+            for world_file in world_files:
+                self.insert_state(None, get_file_tick(world_file), yaml_storage._load(world_file))
+            for npc_file in npcs_files:
+                state = yaml_storage._load(npc_file)
+                self.insert_state(self.get_npc_id(state["name"]), get_file_tick(npc_file), state)
+        self.save_global_goals(yaml_storage.load_global_goals())
+
+        return
+
+    def export_yaml(self, export_path: Path | str | None = None) -> Path:
+        """Write every saved state in the YAML layout, to the world's directory by default"""
+        yaml_storage = YamlStorage(export_path or self.world_path)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT npcs.name, ticks.tick, ticks.state FROM ticks LEFT JOIN npcs ON npcs.id = ticks.npc_id "
+                "WHERE ticks.world_id = ? ORDER BY ticks.id",
+                (self.world_id,),
+            ).fetchall()
+
+        for npc_name, tick, state in rows:
+            if npc_name is None:
+                yaml_storage.write_world(json.loads(state), tick)
+            else:
+                yaml_storage.write_npc(json.loads(state), tick)
+        yaml_storage.save_global_goals(self.load_global_goals())
+        yaml_storage.reindex()
+
+        return yaml_storage.world_path
+
+    def flush(self):
+        """Move the WAL into the database file, e.g. before it is copied or zipped"""
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        return
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+        return
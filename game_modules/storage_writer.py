@@ -0,0 +1,95 @@
+import asyncio
+from typing import Callable
+
+from logging import debug
+
+
+class StorageWriter:
+    """Runs the saves of a game in a worker thread, in the order they were made.
+
+    `save` only queues the call, so serializing and writing the states never
+    blocks the event loop. The saves queued during one step of the loop (e.g.
+    the world and all the NPCs of a tick) and the ones queued while the previous
+    batch was being written are run as one batch. Only used from the event loop's
+    thread; the data passed to `save` mustn't be changed afterwards, pass copies.
+    """
+
+    def __init__(self):
+        self._pending: list[tuple[Callable, tuple]] = []
+        # Completes when the pending saves are written
+        self._pending_future: asyncio.Future | None = None
+        # Completes when the batch being written is written
+        self._writing_future: asyncio.Future | None = None
+
+        self.batches = 0
+        self.saves = 0
+
+    def save(self, save_function: Callable, *args):
+        """Queue `save_function(*args)`. Without a running event loop it is called at once"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            save_function(*args)
+            return
+
+        self._pending.append((save_function, args))
+        if self._pending_future is None:
+            self._pending_future = loop.create_future()
+            # Mark a failure as retrieved, the saves nobody waits for are only logged
+            self._pending_future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            # After the current step, so that its other saves join the batch
+            loop.call_soon(self._write_pending)
+
+        return
+
+    def _write_pending(self):
+        if self._writing_future is not None or not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        self._writing_future, self._pending_future = self._pending_future, None
+
+        loop = asyncio.get_running_loop()
+        written = loop.run_in_executor(None, self.write_batch, batch)
+        written.add_done_callback(self._on_written)
+
+        return
+
+    def _on_written(self, written: asyncio.Future):
+        future, self._writing_future = self._writing_future, None
+        if written.exception() is not None:
+            future.set_exception(written.exception())
+        else:
+            future.set_result(None)
+
+        # The saves queued meanwhile
+        self._write_pending()
+
+        return
+
+    def write_batch(self, batch: list[tuple[Callable, tuple]]):
+        """Run all the saves of the batch, then raise the first error if any failed"""
+        error = None
+        for save_function, args in batch:
+            try:
+                save_function(*args)
+            except Exception as e:
+                debug(f"Saving with {save_function.__qualname__} failed: {e!r}")
+                error = error or e
+
+        self.batches += 1
+        self.saves += len(batch)
+        if error is not None:
+            raise error
+
+        return
+
+    def flush(self) -> asyncio.Future:
+        """Future completed when every save queued so far is written (or failed with
+        the first error of the last batch). Cancelling it doesn't stop the saving"""
+        future = self._pending_future or self._writing_future
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+
+        return asyncio.shield(future)
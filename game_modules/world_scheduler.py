@@ -0,0 +1,256 @@
+import asyncio
+from dataclasses import dataclass
+import math
+from pathlib import Path
+import time
+from classes import Game
+from llm_modules.client import get_llm_client
+from utils import bcolors
+
+from logging import debug
+
+
+@dataclass
+class WorldJob:
+    """One world driven by the `WorldScheduler`"""
+
+    game_name: str
+    ticks: int  # number of ticks to run
+    world_data: dict | None = None  # creates a new world if set, otherwise the game is loaded
+    settings_path: Path | None = None
+    game: Game | None = None  # None while the world is spilled to disk
+    created: bool = False
+    ticks_done: int = 0
+    unsaved_ticks: int = 0
+    seconds: float = 0.0
+    last_run: float = 0.0
+    running: bool = False
+    spilling: asyncio.Future | None = None  # completes when the world being spilled is saved and dropped
+    error: BaseException | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.ticks_done >= self.ticks or self.error is not None
+
+
+class WorldScheduler:
+    """Runs the ticks of many worlds concurrently in one process.
+
+    Up to `max_active_worlds` worlds run a tick at once, they all share the
+    process-wide LLM client so their requests are interleaved under its
+    concurrency and rate limits. The next world to run is the one with the fewest
+    ticks done (the least recently run among equals), so all worlds progress
+    evenly. At most `max_resident_worlds` worlds are kept in memory: once a tick
+    leaves more of them resident, the idle ones whose turn is the furthest away and
+    the finished ones are saved and dropped, and loaded again from disk when their
+    turn comes.
+    """
+
+    def __init__(
+        self,
+        max_active_worlds: int = 32,
+        max_resident_worlds: int = 64,
+        checkpoint_every: int = 1,
+        generate_images: bool = False,
+        report_every: float = 30.0,
+    ):
+        self.max_active_worlds = max_active_worlds
+        self.max_resident_worlds = max(max_resident_worlds, max_active_worlds)
+        self.checkpoint_every = checkpoint_every
+        self.generate_images = generate_images
+        self.report_every = report_every
+
+        self.llm_client = get_llm_client()
+        self.jobs: dict[str, WorldJob] = {}
+
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.spills = 0
+        self.loads = 0
+
+        self._queue: asyncio.PriorityQueue | None = None
+        self._seq = 0
+
+    def add_world(
+        self,
+        game_name: str,
+        ticks: int,
+        world_data: dict | None = None,
+        settings_path: Path | None = None,
+    ) -> WorldJob:
+        job = WorldJob(game_name=game_name, ticks=ticks, world_data=world_data, settings_path=settings_path)
+        self.jobs[game_name] = job
+
+        return job
+
+    def _enqueue(self, job: WorldJob):
+        self._seq += 1
+        self._queue.put_nowait((job.ticks_done, job.last_run, self._seq, job.game_name))
+
+        return
+
+    async def load(self, job: WorldJob):
+        """Create the job's world or load it back from disk"""
+        game = Game()
+        if job.settings_path:
+            game.settings.load(path=job.settings_path)
+
+        if job.world_data is not None and not job.created:
+            game.new_game(job.game_name)
+            await game.init_world(job.world_data)
+            job.created = True
+        else:
+            game.game_name = job.game_name
+            game.load_game()
+            await game.init_world()
+            self.loads += 1
+
+        job.game = game
+
+        return
+
+    async def spill(self, job: WorldJob):
+        """Save the job's world if needed and drop it from memory. A worker taking
+        the job meanwhile waits until it is dropped and loads it again"""
+        game = job.game
+        if game is None or job.running or job.spilling is not None:
+            return
+
+        # Set before the first await, so the world is never ticked while it is being spilled
+        job.spilling = asyncio.get_running_loop().create_future()
+        try:
+            if job.unsaved_ticks:
+                game.start_tick_stages(generate_images=False)
+                job.unsaved_ticks = 0
+            await game.wait_pending_ticks()
+            game.close_storage()
+            await game.flush()
+
+            job.game = None
+            self.spills += 1
+        finally:
+            job.spilling.set_result(None)
+            job.spilling = None
+
+        return
+
+    async def spill_idle(self):
+        resident = [job for job in self.jobs.values() if job.game is not None and job.spilling is None]
+        if len(resident) <= self.max_resident_worlds:
+            return
+
+        # The ones whose turn is the furthest away, the next ones to run stay in memory
+        idle = sorted(
+            (job for job in resident if not job.running),
+            key=lambda job: (job.ticks_done, job.last_run),
+            reverse=True,
+        )
+        for job in idle[: len(resident) - self.max_resident_worlds]:
+            await self.spill(job)
+
+        return
+
+    async def run_tick(self, job: WorldJob):
+        if job.game is None:
+            await self.load(job)
+
+        start = time.perf_counter()
+        checkpoint = job.ticks_done + 1 == job.ticks or (
+            self.checkpoint_every > 0 and (job.unsaved_ticks + 1) % self.checkpoint_every == 0
+        )
+        await job.game.progress_world(save=checkpoint, generate_images=self.generate_images)
+
+        job.seconds += time.perf_counter() - start
+        job.ticks_done += 1
+        job.unsaved_ticks = 0 if checkpoint else job.unsaved_ticks + 1
+
+        return
+
+    async def _worker(self):
+        while True:
+            *_, game_name = await self._queue.get()
+            if game_name is None:
+                return
+
+            job = self.jobs[game_name]
+            if job.spilling is not None:
+                await asyncio.shield(job.spilling)
+            job.running = True
+            try:
+                await self.run_tick(job)
+            except Exception as e:
+                job.error = e
+                debug(f"{bcolors.FAIL}World {job.game_name} failed: {e!r}{bcolors.ENDC}")
+            finally:
+                job.running = False
+                job.last_run = time.monotonic()
+
+            if job.finished:
+                await self.spill(job)
+                if all(job.finished for job in self.jobs.values()):
+                    # Wake up the other workers to stop
+                    for _ in range(self.max_active_worlds):
+                        self._queue.put_nowait((math.inf, math.inf, math.inf, None))
+            else:
+                # Before the job is queued again, so no worker takes it while it may be spilled
+                await self.spill_idle()
+                self._enqueue(job)
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_every)
+            debug(f"{bcolors.OKCYAN}World scheduler: {self.get_stats()}{bcolors.ENDC}")
+
+    async def run(self) -> dict:
+        """Run all the added worlds until each has done its ticks and return the stats"""
+        self._queue = asyncio.PriorityQueue()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+        for job in self.jobs.values():
+            if not job.finished:
+                self._enqueue(job)
+
+        if self._queue.empty():
+            return self.get_stats()
+
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(
+                *[self._worker() for _ in range(min(self.max_active_worlds, len(self.jobs)))]
+            )
+        finally:
+            reporter.cancel()
+            self.finished_at = time.monotonic()
+
+        return self.get_stats()
+
+    def get_stats(self) -> dict:
+        end = self.finished_at or time.monotonic()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        ticks_done = sum(job.ticks_done for job in self.jobs.values())
+
+        return {
+            "worlds": len(self.jobs),
+            "running": sum(job.running for job in self.jobs.values()),
+            "resident": sum(job.game is not None for job in self.jobs.values()),
+            "finished": sum(job.finished for job in self.jobs.values()),
+            "failed": sum(job.error is not None for job in self.jobs.values()),
+            "ticks_done": ticks_done,
+            "ticks_per_minute": ticks_done / elapsed * 60 if elapsed else 0.0,
+            "requests_in_flight": sum(self.llm_client.in_flight.values()),
+            "spills": self.spills,
+            "loads": self.loads,
+            "elapsed": elapsed,
+        }
+
+    def get_jobs_stats(self) -> list[dict]:
+        return [
+            {
+                "game_name": job.game_name,
+                "ticks_done": job.ticks_done,
+                "seconds": job.seconds,
+                "error": repr(job.error) if job.error else None,
+            }
+            for job in self.jobs.values()
+        ]
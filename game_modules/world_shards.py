@@ -0,0 +1,139 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+from pathlib import Path
+import time
+from classes import Settings
+from game_modules.world_scheduler import WorldScheduler
+from llm_modules.client import get_llm_client
+from llm_modules.shared_budget import BudgetManager, SharedBudget
+
+
+async def _run_shard(shard: int, worlds: list[dict], options: dict, coordinator) -> dict:
+    llm_client = get_llm_client()
+    shared_budget = SharedBudget(coordinator, shard, options["shards"])
+    llm_client.shared_budget = shared_budget
+
+    scheduler = WorldScheduler(
+        max_active_worlds=options["max_active_worlds"],
+        max_resident_worlds=options["max_resident_worlds"],
+        checkpoint_every=options["checkpoint_every"],
+        generate_images=options["generate_images"],
+    )
+    for world in worlds:
+        scheduler.add_world(**world)
+
+    try:
+        stats = await scheduler.run()
+    finally:
+        await llm_client.close()
+        shared_budget.close()
+
+    stats["shard"] = shard
+    stats["jobs"] = scheduler.get_jobs_stats()
+    stats["budget"] = shared_budget.get_status()
+
+    return stats
+
+
+def run_shard(shard: int, worlds: list[dict], options: dict, coordinator) -> dict:
+    """Entry point of a worker process, runs its worlds in its own event loop"""
+    logging.basicConfig(level=options["log_level"])
+
+    return asyncio.run(_run_shard(shard, worlds, options, coordinator))
+
+
+class ShardedWorldRunner:
+    """Runs many worlds in a pool of `shards` processes.
+
+    The YAML saving and parsing and the prompt formatting of each tick are CPU
+    bound, so with thousands of worlds a single event loop becomes the
+    bottleneck. Each worker process runs a `WorldScheduler` over its share of the
+    worlds, while the concurrency slots and RPM/TPM limits of the provider are
+    held by a `BudgetCoordinator` in the manager process, so the shards together
+    stay within the same budget as a single process. The workers lease the budget
+    in batches, so the coordinator isn't called for every request.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        settings_path: Path | str = "./settings.yaml",
+        max_active_worlds: int = 32,
+        max_resident_worlds: int = 64,
+        checkpoint_every: int = 1,
+        generate_images: bool = False,
+        log_level: int = logging.WARNING,
+    ):
+        self.shards = shards
+        self.settings_path = settings_path
+        self.options = {
+            "shards": shards,
+            # Per worker, so that all the shards together keep to the totals
+            "max_active_worlds": max(1, max_active_worlds // shards),
+            "max_resident_worlds": max(1, max_resident_worlds // shards),
+            "checkpoint_every": checkpoint_every,
+            "generate_images": generate_images,
+            "log_level": log_level,
+        }
+        self.worlds: list[dict] = []
+
+    def add_world(self, game_name: str, ticks: int, world_data: dict | None = None):
+        self.worlds.append(
+            {
+                "game_name": game_name,
+                "ticks": ticks,
+                "world_data": world_data,
+                "settings_path": self.settings_path,
+            }
+        )
+
+        return
+
+    def run(self) -> dict:
+        """Run all the worlds until each has done its ticks and return the aggregate stats"""
+        settings = Settings()
+        settings.load(path=self.settings_path)
+
+        # Spawned workers start with a clean interpreter on every platform
+        mp_context = multiprocessing.get_context("spawn")
+        start = time.monotonic()
+        with BudgetManager(ctx=mp_context) as manager:
+            coordinator = manager.BudgetCoordinator(
+                self.shards,
+                settings.llm_max_concurrent_requests,
+                settings.llm_default_max_concurrent_requests,
+                settings.llm_rate_limits,
+            )
+            with ProcessPoolExecutor(self.shards, mp_context=mp_context) as pool:
+                futures = [
+                    pool.submit(run_shard, shard, self.worlds[shard :: self.shards], self.options, coordinator)
+                    for shard in range(self.shards)
+                ]
+                shards_stats = [future.result() for future in futures]
+            budget_status = coordinator.get_status()
+        elapsed = time.monotonic() - start
+
+        ticks_done = sum(shard_stats["ticks_done"] for shard_stats in shards_stats)
+        # Requests of every model made by all the shards
+        for shard_stats in shards_stats:
+            for model, shard_budget in shard_stats.pop("budget").items():
+                model_status = budget_status.setdefault(model, {})
+                model_status["requests"] = model_status.get("requests", 0) + shard_budget["requests"]
+
+        return {
+            "shards": self.shards,
+            "worlds": len(self.worlds),
+            "finished": sum(shard_stats["finished"] for shard_stats in shards_stats),
+            "failed": sum(shard_stats["failed"] for shard_stats in shards_stats),
+            "ticks_done": ticks_done,
+            "ticks_per_minute": ticks_done / elapsed * 60 if elapsed else 0.0,
+            # The slots leased at most at once, an upper bound of the requests in flight
+            "max_requests_in_flight": sum(model_status.get("max_leased", 0) for model_status in budget_status.values()),
+            "spills": sum(shard_stats["spills"] for shard_stats in shards_stats),
+            "loads": sum(shard_stats["loads"] for shard_stats in shards_stats),
+            "elapsed": elapsed,
+            "budget": budget_status,
+            "jobs": [job for shard_stats in shards_stats for job in shard_stats["jobs"]],
+        }
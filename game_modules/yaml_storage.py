@@ -0,0 +1,252 @@
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+from utils import fsync_dir, fsync_file, load_yaml, save_yaml_from_data
+
+
+def get_file_tick(path: Path) -> int | None:
+    """N of a world_tick_N.yaml or npc_tick_N.yaml file"""
+    match = re.fullmatch(r"(?:world|npc)_tick_(\d+)\.yaml", path.name)
+
+    return int(match.group(1)) if match else None
+
+
+class YamlStorage:
+    """The states of a world as YAML files, one per tick and state owner.
+
+    world_tick_N.yaml in the world's directory, npcs/<name>/npc_tick_N.yaml for the
+    NPCs and npcs/global_goals.yaml. It is also the layout the other storages are
+    exported to and imported from.
+
+    Every file is written next to the one it replaces and swapped in atomically.
+    `flush()` fsyncs the files written since the last flush and their directories,
+    once per checkpoint instead of once per file.
+
+    manifest.json in the world's directory records the first, previous and current
+    tick of the world with their files and the file of every NPC's latest state, so
+    the states are loaded without listing the directories. It is replaced
+    atomically on every save. A world without one (saved before it was added) is
+    indexed once from the ticks in the file names, never from the files' mtimes
+    which unzipping doesn't keep.
+    """
+
+    backend = "yaml"
+
+    def __init__(self, world_path: Path | str):
+        self.world_path = Path(world_path)
+        self.npcs_path = self.world_path / "npcs"
+        self.global_goals_path = self.npcs_path / "global_goals.yaml"
+        self.manifest_path = self.world_path / "manifest.json"
+
+        self._lock = threading.Lock()
+        self._manifest: dict | None = None
+        # Files written since the last flush()
+        self._unsynced_files: set[Path] = set()
+
+    def get_manifest(self) -> dict:
+        if self._manifest is None:
+            if self.manifest_path.exists():
+                with open(self.manifest_path) as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = self.index_files()
+
+        return self._manifest
+
+    def index_files(self) -> dict:
+        """Manifest of the files already in the world's directory"""
+        manifest = {"first_tick": None, "previous_tick": None, "current_tick": None, "ticks": {}, "npcs": {}}
+        if not self.world_path.exists():
+            return manifest
+
+        ticks = sorted(
+            tick for path in self.world_path.glob("world_tick_*.yaml") if (tick := get_file_tick(path)) is not None
+        )
+        for tick in ticks:
+            self.add_world_tick(manifest, tick)
+
+        if self.npcs_path.exists():
+            for npc_path in sorted(self.npcs_path.iterdir()):
+                npc_ticks = [
+                    tick for path in npc_path.glob("npc_tick_*.yaml") if (tick := get_file_tick(path)) is not None
+                ]
+                if npc_ticks:
+                    manifest["npcs"][npc_path.name] = f"npcs/{npc_path.name}/npc_tick_{max(npc_ticks)}.yaml"
+
+        return manifest
+
+    @staticmethod
+    def add_world_tick(manifest: dict, tick: int):
+        if manifest["current_tick"] is None or tick > manifest["current_tick"]:
+            manifest["previous_tick"] = manifest["current_tick"]
+            manifest["current_tick"] = tick
+        if manifest["first_tick"] is None or tick < manifest["first_tick"]:
+            manifest["first_tick"] = tick
+
+        # Only the files of the ticks that are loaded, so the manifest doesn't grow with the history
+        manifest["ticks"] = {
+            str(tick): f"world_tick_{tick}.yaml"
+            for tick in dict.fromkeys(
+                [manifest["first_tick"], manifest["previous_tick"], manifest["current_tick"]]
+            )
+            if tick is not None
+        }
+
+        return
+
+    def update_manifest(self, world_tick: int | None = None, npcs_names: list[str] = (), npcs_tick: int = 0):
+        with self._lock:
+            manifest = self.get_manifest()
+            if world_tick is not None:
+                self.add_world_tick(manifest, world_tick)
+            for npc_name in npcs_names:
+                manifest["npcs"][npc_name] = f"npcs/{npc_name}/npc_tick_{npcs_tick}.yaml"
+            self.write_manifest()
+
+        return
+
+    def reindex(self):
+        """Rebuild the manifest from the files, after they were written with `write_world`/`write_npc`"""
+        with self._lock:
+            self._manifest = self.index_files()
+            self.write_manifest()
+
+        return
+
+    def write_manifest(self):
+        self.world_path.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self._manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+        # Called with the lock held
+        self._unsynced_files.add(self.manifest_path)
+
+        return
+
+    def write_world(self, world, tick: int):
+        self.world_path.mkdir(parents=True, exist_ok=True)
+        world_file = self.world_path / f"world_tick_{tick}.yaml"
+        save_yaml_from_data(world_file, world)
+        with self._lock:
+            self._unsynced_files.add(world_file)
+
+        return
+
+    def write_npc(self, npc_data, tick: int) -> str:
+        npc_name = npc_data["name"] if isinstance(npc_data, dict) else npc_data.name
+
+        npc_dir = self.npcs_path / npc_name
+        npc_dir.mkdir(parents=True, exist_ok=True)
+        npc_file = npc_dir / f"npc_tick_{tick}.yaml"
+        save_yaml_from_data(npc_file, npc_data)
+        with self._lock:
+            self._unsynced_files.add(npc_file)
+
+        return npc_name
+
+    def save_world(self, world, tick: int | None = None):
+        if tick is None:
+            tick = world["current_tick"] if isinstance(world, dict) else world.current_tick
+
+        self.write_world(world, tick)
+        self.update_manifest(world_tick=tick)
+
+        return
+
+    def save_npc(self, npc_data, tick: int):
+        npc_name = self.write_npc(npc_data, tick)
+        self.update_manifest(npcs_names=[npc_name], npcs_tick=tick)
+
+        return
+
+    def save_npcs(self, npcs: list, tick: int):
+        npcs_names = [self.write_npc(npc, tick) for npc in npcs]
+        self.update_manifest(npcs_names=npcs_names, npcs_tick=tick)
+
+        return
+
+    def save_tick(self, world, npcs: list):
+        tick = world.current_tick
+        self.write_world(world, tick)
+        npcs_names = [self.write_npc(npc, tick) for npc in npcs]
+        # One manifest update for the whole tick
+        self.update_manifest(world_tick=tick, npcs_names=npcs_names, npcs_tick=tick)
+
+        return
+
+    def save_global_goals(self, global_goals: list):
+        self.npcs_path.mkdir(parents=True, exist_ok=True)
+        save_yaml_from_data(self.global_goals_path, global_goals)
+        with self._lock:
+            self._unsynced_files.add(self.global_goals_path)
+
+        return
+
+    def load_world_tick(self, tick_name: str) -> dict | None:
+        manifest = self.get_manifest()
+        tick = manifest[tick_name]
+        if tick is None:
+            return None
+
+        return self._load(self.world_path / manifest["ticks"][str(tick)])
+
+    def load_world(self) -> dict | None:
+        """The latest state of the world"""
+        return self.load_world_tick("current_tick")
+
+    def load_first_world(self) -> dict | None:
+        """The state the world was created with"""
+        return self.load_world_tick("first_tick")
+
+    def load_previous_world(self) -> dict | None:
+        """The state of the world before the latest one"""
+        return self.load_world_tick("previous_tick")
+
+    def load_npcs(self) -> list[dict]:
+        """The latest state of every NPC"""
+        return [
+            npc_data
+            for npc_file in self.get_manifest()["npcs"].values()
+            if (npc_data := self._load(self.world_path / npc_file))
+        ]
+
+    def load_global_goals(self) -> list:
+        return self._load(self.global_goals_path) or []
+
+    def export_yaml(self, export_path: Path | str | None = None) -> Path:
+        """Copy the YAML files of the world to `export_path`, they are already in the layout"""
+        if export_path is None or Path(export_path) == self.world_path:
+            return self.world_path
+
+        shutil.copytree(
+            self.world_path, export_path, ignore=shutil.ignore_patterns("*.jpg"), dirs_exist_ok=True
+        )
+
+        return Path(export_path)
+
+    def flush(self):
+        """Make everything saved so far durable"""
+        with self._lock:
+            unsynced_files, self._unsynced_files = self._unsynced_files, set()
+        for path in unsynced_files:
+            fsync_file(path)
+
+        unsynced_dirs = {path.parent for path in unsynced_files}
+        # The NPCs' directories may be new in npcs/ too
+        if any(path.parent == self.npcs_path for path in unsynced_dirs):
+            unsynced_dirs.add(self.npcs_path)
+        for path in unsynced_dirs:
+            fsync_dir(path)
+
+        return
+
+    def close(self):
+        return
+
+    @staticmethod
+    def _load(path: Path | None) -> dict | None:
+        return load_yaml(path) if path and path.exists() else None
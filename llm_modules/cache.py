@@ -0,0 +1,165 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import aiofiles
+import openai
+
+from logging import debug
+
+
+class ResponseCache:
+    """Persistent content-addressed cache of raw LLM and text-to-image responses.
+
+    Responses are stored as json files under `cache_path`, named by the hash of
+    everything that defines the request (model, prompt, model type and image params).
+    When the total size goes over `max_size` bytes the least recently used
+    responses are deleted.
+    """
+
+    def __init__(self, cache_path: Path, max_size: int = 512 * 1024**2):
+        self.cache_path = Path(cache_path)
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> size in bytes, ordered from the least to the most recently used
+        self._index: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, model_type: str = "chat", params: dict = None) -> str:
+        request = {
+            "model": model,
+            "prompt": prompt,
+            "model_type": model_type,
+            "params": params or {},
+        }
+        request_str = json.dumps(request, sort_keys=True, default=str)
+
+        return hashlib.sha256(request_str.encode("utf-8")).hexdigest()
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_path / key[:2] / f"{key}.json"
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+
+        self._index = OrderedDict()
+        self._size = 0
+        if not self.cache_path.exists():
+            return
+
+        # Restore the usage order from the access times left by the previous runs
+        entries = []
+        for path in self.cache_path.glob("*/*.json"):
+            stat = path.stat()
+            entries.append((stat.st_atime, path.stem, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+
+        return
+
+    def _evict(self):
+        while self._size > self.max_size and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            self._get_path(key).unlink(missing_ok=True)
+
+            debug(f"Evicted LLM response {key} from the cache")
+
+        return
+
+    async def get(self, key: str):
+        """Return the cached response or None"""
+        async with self._lock:
+            self._load_index()
+
+            if key not in self._index:
+                self.misses += 1
+                return None
+
+            path = self._get_path(key)
+            try:
+                async with aiofiles.open(path, "r") as f:
+                    response_str = await f.read()
+                response = json.loads(response_str)
+            except (OSError, ValueError):
+                self._size -= self._index.pop(key)
+                path.unlink(missing_ok=True)
+                self.misses += 1
+                return None
+
+            self._index.move_to_end(key)
+            os.utime(path)
+            self.hits += 1
+
+        return openai.util.convert_to_openai_object(response)
+
+    async def put(self, key: str, response):
+        response_str = json.dumps(response)
+        path = self._get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        async with self._lock:
+            self._load_index()
+
+            tmp_path = path.with_suffix(".tmp")
+            async with aiofiles.open(tmp_path, "w") as f:
+                await f.write(response_str)
+            os.replace(tmp_path, path)
+
+            self._size -= self._index.pop(key, 0)
+            self._index[key] = path.stat().st_size
+            self._size += self._index[key]
+
+            self._evict()
+
+        return
+
+    def clear(self):
+        self._load_index()
+        for key in list(self._index.keys()):
+            self._get_path(key).unlink(missing_ok=True)
+        self._index.clear()
+        self._size = 0
+
+        return
+
+    def stats(self) -> dict:
+        self._load_index()
+        requests_num = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests_num if requests_num else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._index),
+            "size": self._size,
+            "max_size": self.max_size,
+        }
+
+
+_response_cache: ResponseCache | None = None
+
+
+def get_response_cache(cache_path: Path, max_size: int) -> ResponseCache:
+    """Return the process-wide response cache, creating it on first use"""
+    global _response_cache
+
+    if _response_cache is None or _response_cache.cache_path != Path(cache_path):
+        _response_cache = ResponseCache(cache_path, max_size)
+    else:
+        _response_cache.max_size = max_size
+
+    return _response_cache
@@ -0,0 +1,227 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import hashlib
+import time
+from llm_modules.retry import RetryClass, RetryPolicy, get_error_code
+
+from logging import debug
+
+
+# Error codes meaning that no request with the key will succeed until the account
+# is fixed, the breaker opens at the first of them
+ACCOUNT_ERROR_CODES = (
+    "invalid_api_key",
+    "insufficient_quota",
+    "billing_hard_limit_reached",
+    "account_deactivated",
+)
+
+
+class CircuitOpenError(Exception):
+    """The provider is failing, requests are rejected without being sent"""
+
+    # Retrying before the breaker lets probes through is pointless
+    retryable = False
+
+    def __init__(self, message: str, last_error: Exception | None = None, retry_in: float = 0.0):
+        super().__init__(message)
+        self.last_error = last_error
+        self.retry_in = retry_in
+
+    @property
+    def code(self) -> str | None:
+        return get_error_code(self.last_error) if self.last_error else None
+
+
+class CircuitState:
+    closed = "closed"  # requests are sent
+    open = "open"  # requests fail at once
+    half_open = "half_open"  # a few probe requests decide whether to close again
+
+
+class CircuitBreaker:
+    """Stops sending requests when the provider keeps failing for everyone.
+
+    The breaker opens when at least `error_rate` of the requests of the last
+    `window` seconds (and at least `min_requests` of them) failed with errors
+    that aren't caused by a single prompt, or at once on account errors like
+    `insufficient_quota`. Rate limits and bad requests count neither as failures
+    nor as successes. After `open_seconds` it lets `half_open_probes`
+    requests through: the first success closes it, a failure opens it again.
+    """
+
+    probe_poll_interval = 0.1
+
+    def __init__(
+        self,
+        error_rate: float = 0.5,
+        min_requests: int = 10,
+        window: float = 60.0,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 1,
+    ):
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self.state = CircuitState.closed
+        self.opened_at = 0.0
+        self.last_error: Exception | None = None
+        self.probes_in_flight = 0
+        self.trips = 0
+        self.rejected = 0
+
+        # (timestamp, failed) of the requests finished during the last window
+        self._results: deque[tuple[float, bool]] = deque()
+        self._retry_policy = RetryPolicy()
+
+    def configure(self, **params):
+        for name, value in params.items():
+            if value is not None:
+                setattr(self, name, value)
+
+        return
+
+    def _purge(self, now: float):
+        while self._results and self._results[0][0] <= now - self.window:
+            self._results.popleft()
+
+    def is_provider_failure(self, error: Exception) -> bool:
+        """Errors caused by the provider or the account, not by the request itself"""
+        if isinstance(error, CircuitOpenError):
+            return False
+        if get_error_code(error) in ACCOUNT_ERROR_CODES:
+            return True
+
+        return self._retry_policy.classify(error) == RetryClass.transient
+
+    def get_state(self) -> str:
+        if self.state == CircuitState.open and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = CircuitState.half_open
+            self.probes_in_flight = 0
+            debug("Circuit breaker is half-open, probing the provider")
+
+        return self.state
+
+    def is_open(self) -> bool:
+        return self.get_state() == CircuitState.open
+
+    def get_open_error(self) -> CircuitOpenError | None:
+        """The error new requests are rejected with, None if they are let through"""
+        state = self.get_state()
+        if state == CircuitState.closed:
+            return None
+        if state == CircuitState.half_open and self.probes_in_flight < self.half_open_probes:
+            return None
+
+        retry_in = max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+        return CircuitOpenError(
+            f"The LLM provider is failing ({self.last_error!r}), requests are paused for {retry_in:.0f}s",
+            last_error=self.last_error,
+            retry_in=retry_in,
+        )
+
+    def before_request(self):
+        """Raise CircuitOpenError if the request may not be sent"""
+        open_error = self.get_open_error()
+        if open_error is not None:
+            self.rejected += 1
+            raise open_error
+
+        if self.state == CircuitState.half_open:
+            self.probes_in_flight += 1
+
+        return
+
+    def _open(self, error: Exception):
+        self.state = CircuitState.open
+        self.opened_at = time.monotonic()
+        self.last_error = error
+        self.trips += 1
+        self._results.clear()
+
+        debug(f"Circuit breaker is open for {self.open_seconds}s after {error!r}")
+
+        return
+
+    def record_success(self):
+        if self.state == CircuitState.half_open:
+            self.state = CircuitState.closed
+            self.last_error = None
+            debug("Circuit breaker is closed, the provider has recovered")
+
+        now = time.monotonic()
+        self._purge(now)
+        self._results.append((now, False))
+
+        return
+
+    def record_failure(self, error: Exception):
+        if self.state == CircuitState.open:
+            # Requests sent before the breaker opened don't extend the pause
+            return
+
+        if not self.is_provider_failure(error):
+            # Rate limits and bad requests say nothing about whether the provider works,
+            # counting them as successes would keep the breaker closed during a throttling storm
+            return
+
+        if self.state == CircuitState.half_open or get_error_code(error) in ACCOUNT_ERROR_CODES:
+            self._open(error)
+            return
+
+        now = time.monotonic()
+        self._purge(now)
+        self._results.append((now, True))
+
+        failures_num = sum(failed for _, failed in self._results)
+        if (
+            len(self._results) >= self.min_requests
+            and failures_num / len(self._results) >= self.error_rate
+        ):
+            self._open(error)
+
+        return
+
+    def is_probing(self) -> bool:
+        return (
+            self.get_state() == CircuitState.half_open
+            and self.probes_in_flight >= self.half_open_probes
+        )
+
+    @asynccontextmanager
+    async def guard(self):
+        """Reject the request in the block if the breaker is open and record its result.
+        While the provider is being probed the request waits for the probes' result"""
+        while self.is_probing():
+            await asyncio.sleep(self.probe_poll_interval)
+
+        self.before_request()
+        is_probe = self.state == CircuitState.half_open
+        try:
+            yield
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        else:
+            self.record_success()
+        finally:
+            # Cancelled probes free their place for the next one
+            if is_probe:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def get_status(self) -> dict:
+        return {
+            "state": self.get_state(),
+            "last_error": repr(self.last_error) if self.last_error else None,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+def get_breaker_key(api_key: str | None) -> str:
+    """Breakers are kept per API key, stored by its hash"""
+    return hashlib.sha256(str(api_key).encode("utf-8")).hexdigest()
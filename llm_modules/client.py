@@ -0,0 +1,360 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from llm_modules.circuit_breaker import CircuitBreaker, get_breaker_key
+from llm_modules.hedging import Hedger
+from llm_modules.key_validation import ApiKeyValidator
+from llm_modules.providers import LLMProvider, OpenAIProvider, ProviderConfig, make_provider
+from llm_modules.scheduler import RateScheduler, estimate_tokens
+from resources_paths import DATA_PATH
+
+from logging import debug
+
+
+# Usage of the requests made inside the current `usage_scope()`, e.g. one tick of one world
+current_usage: ContextVar[dict | None] = ContextVar("current_usage", default=None)
+
+
+@contextmanager
+def usage_scope():
+    """Collect the requests and tokens used inside the block (including the tasks it spawns)
+    into the yielded dict, separately from the other games sharing the client"""
+    usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    token = current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_usage.reset(token)
+
+
+class LLMClient:
+    """Long-lived client shared by every game running in the process.
+
+    Requests are answered by the configured provider (the real OpenAI API by default,
+    which keeps one pooled keep-alive HTTP session) and the number of in-flight
+    requests is limited per model with a semaphore, so many NPCs and many sessions
+    don't open a connection and a request each at once. Models with configured
+    RPM/TPM limits additionally wait for their rate budget before taking a slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_requests: dict[str, int] | None = None,
+        default_max_concurrent_requests: int = 8,
+        provider: LLMProvider | None = None,
+    ):
+        self.max_concurrent_requests: dict[str, int] = dict(max_concurrent_requests or {})
+        self.default_max_concurrent_requests = default_max_concurrent_requests
+
+        self.provider: LLMProvider = provider or OpenAIProvider()
+        self.provider_config: ProviderConfig | None = None
+
+        self.scheduler = RateScheduler()
+        self.key_validator = ApiKeyValidator()
+        self.hedger = Hedger()
+
+        # Circuit breakers per API key hash, shared by all the sessions using the key
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.breaker_enabled = True
+        self.breaker_params: dict = {}
+
+        # Budget shared with the other processes of a sharded simulation, see
+        # llm_modules/shared_budget.py. It replaces the local rate limits
+        self.shared_budget = None
+
+        # Number of requests currently holding a slot, per model
+        self.in_flight: dict[str, int] = {}
+        # Requests and tokens used since the last reset_usage(), per model
+        self.usage: dict[str, dict[str, int]] = {}
+
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._semaphore_limits: dict[str, int] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def configure(
+        self,
+        max_concurrent_requests: dict[str, int] | None = None,
+        default_max_concurrent_requests: int | None = None,
+    ):
+        if max_concurrent_requests is not None:
+            self.max_concurrent_requests = dict(max_concurrent_requests)
+        if default_max_concurrent_requests:
+            self.default_max_concurrent_requests = default_max_concurrent_requests
+
+        return
+
+    def configure_from_settings(self, settings):
+        self.configure(
+            max_concurrent_requests=settings.llm_max_concurrent_requests,
+            default_max_concurrent_requests=settings.llm_default_max_concurrent_requests,
+        )
+        self.scheduler.configure(
+            settings.llm_rate_limits,
+            expected_completion_tokens=settings.llm_expected_completion_tokens,
+        )
+        self.key_validator.configure(
+            valid_ttl=settings.api_key_valid_ttl,
+            invalid_ttl=settings.api_key_invalid_ttl,
+        )
+        self.hedger.configure(
+            enabled=settings.llm_hedging_enabled,
+            quantile=settings.llm_hedge_quantile,
+            max_extra_ratio=settings.llm_hedge_max_extra_ratio,
+            min_samples=settings.llm_hedge_min_samples,
+        )
+
+        self.breaker_enabled = settings.llm_breaker_enabled
+        self.breaker_params = {
+            "error_rate": settings.llm_breaker_error_rate,
+            "min_requests": settings.llm_breaker_min_requests,
+            "window": settings.llm_breaker_window,
+            "open_seconds": settings.llm_breaker_open_seconds,
+            "half_open_probes": settings.llm_breaker_half_open_probes,
+        }
+        for breaker in self.breakers.values():
+            breaker.configure(**self.breaker_params)
+
+        # Recreate the provider only if its settings have changed
+        provider_config = ProviderConfig.from_settings(settings)
+        if provider_config != self.provider_config:
+            self.set_provider(
+                make_provider(provider_config, default_recording_path=DATA_PATH / "recordings" / "session.jsonl")
+            )
+            self.provider_config = provider_config
+
+        return
+
+    def set_provider(self, provider: LLMProvider):
+        old_provider = self.provider
+        self.provider = provider
+
+        try:
+            asyncio.get_running_loop().create_task(old_provider.close())
+        except RuntimeError:
+            pass
+
+        debug(f"LLM provider is set to {provider.name}")
+
+        return
+
+    def get_breaker(self, api_key: str | None) -> CircuitBreaker:
+        key = get_breaker_key(api_key)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(**self.breaker_params)
+
+        return breaker
+
+    @asynccontextmanager
+    async def guard(self, api_key: str | None):
+        """Fail at once with CircuitOpenError while the provider keeps failing for the key"""
+        if not self.breaker_enabled:
+            yield
+            return
+
+        async with self.get_breaker(api_key).guard():
+            yield
+
+    def get_limit(self, model: str) -> int:
+        return self.max_concurrent_requests.get(model, self.default_max_concurrent_requests)
+
+    def _check_loop(self):
+        # Semaphores are bound to the loop they were created in,
+        # e.g. the CLI may run several asyncio.run() calls one after another
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {}
+            self._semaphore_limits = {}
+
+    def get_semaphore(self, model: str) -> asyncio.Semaphore:
+        self._check_loop()
+        limit = self.get_limit(model)
+
+        # Rebuild the semaphore only if the limit has changed, requests holding
+        # the old one will release it normally
+        if self._semaphore_limits.get(model) != limit:
+            self._semaphores[model] = asyncio.Semaphore(limit)
+            self._semaphore_limits[model] = limit
+
+        return self._semaphores[model]
+
+    @asynccontextmanager
+    async def limit(self, model: str):
+        """Hold one of the model's concurrency slots for the duration of the block"""
+        async with self.get_semaphore(model):
+            if self.shared_budget is not None:
+                await self.shared_budget.acquire_slot(model)
+            self.in_flight[model] = self.in_flight.get(model, 0) + 1
+            try:
+                yield
+            finally:
+                self.in_flight[model] -= 1
+                if self.shared_budget is not None:
+                    self.shared_budget.release_slot(model)
+
+    async def acquire_rate(self, model: str, tokens: int) -> list | None:
+        """Wait for the model's rate budget, the shared one if the process has it"""
+        if self.shared_budget is not None:
+            await self.shared_budget.acquire_rate(model, tokens)
+            return None
+
+        return await self.scheduler.acquire(model, tokens)
+
+    def record_usage(self, model: str, prompt_tokens: int, completion_tokens: int):
+        usages = [
+            self.usage.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        ]
+        if current_usage.get() is not None:
+            usages.append(current_usage.get())
+
+        for usage in usages:
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+
+        return
+
+    def record_response_usage(self, model: str, prompt: str, response):
+        try:
+            self.record_usage(
+                model, response["usage"]["prompt_tokens"], response["usage"]["completion_tokens"]
+            )
+        except (KeyError, TypeError):
+            self.record_usage(model, estimate_tokens(prompt), 0)
+
+        return
+
+    def reset_usage(self):
+        self.usage = {}
+
+        return
+
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, hedge: bool = False, **params):
+        """With `hedge` the request is sent again if the provider takes longer than usual
+        to answer. The duplicate takes a concurrency slot of its own and its tokens are
+        counted in the usage whether it wins or not"""
+        async with self.guard(api_key):
+            tokens = self.scheduler.estimate_request_tokens(prompt, params.get("max_tokens"))
+
+            async def send(reservation: list | None):
+                try:
+                    response = await self.provider.chat_completion(model, prompt, api_key, **params)
+                except asyncio.CancelledError:
+                    if hedge:
+                        # Lost to its duplicate, the prompt was already sent
+                        self.record_usage(model, estimate_tokens(prompt), 0)
+                    raise
+
+                self.scheduler.record_usage(reservation, response)
+                self.record_response_usage(model, prompt, response)
+
+                return response
+
+            async def send_hedge():
+                async with self.limit(model):
+                    return await send(await self.acquire_rate(model, tokens))
+
+            async with self.limit(model):
+                # Reserved once the slot is taken, so the reservation is timestamped when the request is sent
+                reservation = await self.acquire_rate(model, tokens)
+                if hedge:
+                    response = await self.hedger.request(model, lambda: send(reservation), send_hedge)
+                else:
+                    response = await send(reservation)
+
+        return response
+
+    async def stream_chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        """Yield the answer's text deltas as they arrive"""
+        content = ""
+        async with self.guard(api_key):
+            tokens = self.scheduler.estimate_request_tokens(prompt, params.get("max_tokens"))
+
+            async with self.limit(model):
+                reservation = await self.acquire_rate(model, tokens)
+                async for delta in self.provider.stream_chat_completion(model, prompt, api_key, **params):
+                    content += delta
+                    yield delta
+
+        # Streams don't report usage, estimate it from the text
+        usage = {"total_tokens": estimate_tokens(prompt) + estimate_tokens(content)}
+        self.scheduler.record_usage(reservation, {"usage": usage})
+        self.record_usage(model, estimate_tokens(prompt), estimate_tokens(content))
+
+    async def image_generation(
+        self,
+        model: str,
+        prompt: str,
+        api_key: str = None,
+        img_size: str = "1024x1024",
+        img_quality: str = "standard",
+        img_n: int = 1,
+        response_format: str = "b64_json",
+    ):
+        async with self.guard(api_key):
+            async with self.limit(model):
+                # Images only count against the requests per minute
+                await self.acquire_rate(model, 0)
+                response = await self.provider.image_generation(
+                    model,
+                    prompt,
+                    api_key,
+                    img_size=img_size,
+                    img_quality=img_quality,
+                    img_n=img_n,
+                    response_format=response_format,
+                )
+
+        self.record_usage(model, estimate_tokens(prompt), 0)
+
+        return response
+
+    def record_failure(self, api_key: str | None, error: Exception):
+        """Count a failure that happened outside of the client, e.g. a request cancelled by its timeout"""
+        if self.breaker_enabled:
+            self.get_breaker(api_key).record_failure(error)
+
+        return
+
+    def get_status(self) -> dict[str, dict]:
+        """In-flight requests, queue depth and predicted drain time per model"""
+        status = self.scheduler.get_status()
+        for model, in_flight in self.in_flight.items():
+            status.setdefault(model, {})["in_flight"] = in_flight
+
+        return status
+
+    async def validate_api_key(self, api_key: str, model: str):
+        """Return True if the key is valid, otherwise the error. Results are cached
+        and concurrent checks of the same key share one request"""
+
+        async def check(api_key: str, model: str):
+            result = await self.provider.validate_api_key(api_key, model)
+            if isinstance(result, Exception):
+                # An account error like insufficient_quota opens the key's breaker at once
+                self.record_failure(api_key, result)
+
+            return result
+
+        return await self.key_validator.validate(api_key, model, check, provider_name=self.provider.name)
+
+    async def close(self):
+        await self.provider.close()
+
+        debug("LLM client is closed")
+
+        return
+
+
+_llm_client: LLMClient | None = None
+
+
+def get_llm_client() -> LLMClient:
+    """Return the process-wide LLM client, creating it on first use"""
+    global _llm_client
+
+    if _llm_client is None:
+        _llm_client = LLMClient()
+
+    return _llm_client
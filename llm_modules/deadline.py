@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+import typing
+
+
+class DeadlineExceededError(Exception):
+    """The deadline of the current scope (e.g. a world tick) has passed"""
+
+    # The remaining time won't come back, retrying is pointless
+    retryable = False
+
+
+# Monotonic time the current scope has to finish by. Tasks spawned inside the
+# scope (e.g. by asyncio.gather) inherit it
+current_deadline: ContextVar[float | None] = ContextVar("current_deadline", default=None)
+
+
+def get_deadline() -> float | None:
+    return current_deadline.get()
+
+
+def time_left() -> float | None:
+    """Seconds left until the current deadline, None if there is no deadline"""
+    deadline_at = current_deadline.get()
+    if deadline_at is None:
+        return None
+
+    return max(0.0, deadline_at - time.monotonic())
+
+
+def earliest(*deadlines: float | None) -> float | None:
+    deadlines = [deadline_at for deadline_at in deadlines if deadline_at is not None]
+    return min(deadlines) if deadlines else None
+
+
+def check_deadline():
+    """Raise DeadlineExceededError if the current deadline has passed"""
+    if time_left() == 0:
+        raise DeadlineExceededError("The deadline is exceeded")
+
+    return
+
+
+@contextmanager
+def deadline_scope(seconds: float | None):
+    """Everything awaited inside the block has to finish within `seconds`.
+    Nested scopes can only shorten the deadline. 0 or None means no extra limit"""
+    deadline_at = current_deadline.get()
+    if seconds:
+        deadline_at = earliest(deadline_at, time.monotonic() + seconds)
+
+    token = current_deadline.set(deadline_at)
+    try:
+        yield deadline_at
+    finally:
+        current_deadline.reset(token)
+
+
+async def run_with_deadline(awaitable: typing.Awaitable, grace: float = 0.0):
+    """Await `awaitable` cancelling it if it's still running `grace` seconds after
+    the current deadline. The grace lets the requests that watch the deadline
+    themselves return their partial results first"""
+    seconds_left = time_left()
+    if seconds_left is None:
+        return await awaitable
+
+    try:
+        return await asyncio.wait_for(awaitable, timeout=seconds_left + grace)
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceededError("The deadline is exceeded, the remaining work is cancelled") from e
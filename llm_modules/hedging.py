@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque
+import time
+import typing
+
+from logging import debug
+
+
+class LatencyTracker:
+    """Rolling window of the latest successful request latencies, per model"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._latencies: dict[str, deque[float]] = {}
+
+    def record(self, model: str, seconds: float):
+        latencies = self._latencies.get(model)
+        if latencies is None:
+            latencies = self._latencies[model] = deque(maxlen=self.window)
+        latencies.append(seconds)
+
+        return
+
+    def samples_num(self, model: str) -> int:
+        return len(self._latencies.get(model, ()))
+
+    def quantile(self, model: str, q: float) -> float | None:
+        latencies = self._latencies.get(model)
+        if not latencies:
+            return None
+
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class Hedger:
+    """Sends a duplicate of a request that takes longer than the model's usual
+    latency (the `quantile` of the recent ones) and returns whichever answer
+    arrives first, cancelling the other one.
+
+    Hedges are sent only once `min_samples` latencies of the model are known and
+    while they stay under `max_extra_ratio` of all the hedgeable requests, which
+    caps the extra spend.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        quantile: float = 0.95,
+        max_extra_ratio: float = 0.1,
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+
+        self.requests = 0
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+
+    def configure(
+        self,
+        enabled: bool | None = None,
+        quantile: float | None = None,
+        max_extra_ratio: float | None = None,
+        min_samples: int | None = None,
+    ):
+        if enabled is not None:
+            self.enabled = enabled
+        if quantile is not None:
+            self.quantile = quantile
+        if max_extra_ratio is not None:
+            self.max_extra_ratio = max_extra_ratio
+        if min_samples is not None:
+            self.min_samples = min_samples
+
+        return
+
+    def get_hedge_delay(self, model: str) -> float | None:
+        """Seconds to wait for the first answer before hedging, None if the request isn't hedged"""
+        if not self.enabled or self.latencies.samples_num(model) < self.min_samples:
+            return None
+
+        return self.latencies.quantile(model, self.quantile)
+
+    def can_hedge(self) -> bool:
+        return self.hedges_sent + 1 <= self.max_extra_ratio * self.requests
+
+    async def _timed(self, model: str, make_request: typing.Callable[[], typing.Awaitable]):
+        start = time.monotonic()
+        response = await make_request()
+        self.latencies.record(model, time.monotonic() - start)
+
+        return response
+
+    async def request(
+        self,
+        model: str,
+        make_request: typing.Callable[[], typing.Awaitable],
+        make_hedge: typing.Callable[[], typing.Awaitable] | None = None,
+    ):
+        """Await `make_request()`. If it is too slow, `make_hedge()` (by default
+        `make_request()` again) is awaited alongside and the first answer wins"""
+        self.requests += 1
+        hedge_delay = self.get_hedge_delay(model)
+
+        primary = asyncio.ensure_future(self._timed(model, make_request))
+        if hedge_delay is None:
+            return await primary
+
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+            if done:
+                return primary.result()
+
+            if not self.can_hedge():
+                self.hedges_skipped += 1
+                return await primary
+
+            self.hedges_sent += 1
+            debug(f"Request to {model} takes longer than {hedge_delay:.1f}s, sending a hedge")
+            hedge = asyncio.ensure_future(self._timed(model, make_hedge or make_request))
+
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Take the first successful answer, an error is raised only if both have failed
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedges_sent": self.hedges_sent,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": self.hedge_wins / self.hedges_sent if self.hedges_sent else 0.0,
+            "hedges_skipped": self.hedges_skipped,
+            "extra_ratio": self.hedges_sent / self.requests if self.requests else 0.0,
+        }
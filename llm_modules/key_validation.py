@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import time
+import typing
+from llm_modules.retry import RetryClass, RetryPolicy
+
+from logging import debug
+
+
+class ApiKeyValidator:
+    """Process-wide cache of API key checks.
+
+    Results are stored by the hash of the key (the key itself is never kept) for
+    `valid_ttl` seconds if the key works and `invalid_ttl` seconds if the provider
+    rejected it. Transient failures (timeouts, rate limits, 5xx) aren't cached.
+    Concurrent checks of the same key wait for one shared request.
+    """
+
+    def __init__(self, valid_ttl: float = 600, invalid_ttl: float = 60):
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+
+        # key hash -> (expires at, True or the error)
+        self._results: dict[str, tuple[float, typing.Any]] = {}
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def configure(self, valid_ttl: float | None = None, invalid_ttl: float | None = None):
+        if valid_ttl is not None:
+            self.valid_ttl = valid_ttl
+        if invalid_ttl is not None:
+            self.invalid_ttl = invalid_ttl
+
+        return
+
+    @staticmethod
+    def make_key(api_key: str, model: str, provider_name: str = "") -> str:
+        key_str = f"{provider_name}:{model}:{api_key}"
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def _check_loop(self):
+        # Futures of the in-flight checks are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._in_flight = {}
+
+    def get_cached(self, key: str):
+        """Return the cached result or None if there is none or it has expired"""
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+
+        expires_at, result = cached
+        if time.monotonic() >= expires_at:
+            del self._results[key]
+            return None
+
+        return result
+
+    def get_ttl(self, result) -> float:
+        if result is True:
+            return self.valid_ttl
+        if RetryPolicy().classify(result) == RetryClass.fatal:
+            return self.invalid_ttl
+
+        return 0
+
+    async def validate(
+        self,
+        api_key: str,
+        model: str,
+        check: typing.Callable[[str, str], typing.Awaitable],
+        provider_name: str = "",
+    ):
+        """Return True if the key is valid, otherwise the error. `check(api_key, model)`
+        is called only if there is no cached result and no check of the key in flight"""
+        key = self.make_key(api_key, model, provider_name)
+
+        result = self.get_cached(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self._check_loop()
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.shared += 1
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        future = self._loop.create_future()
+        self._in_flight[key] = future
+        try:
+            result = await check(api_key, model)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            result = e
+        finally:
+            self._in_flight.pop(key, None)
+
+        ttl = self.get_ttl(result)
+        if ttl > 0:
+            self._results[key] = (time.monotonic() + ttl, result)
+
+        debug(f"API key {key[:8]} is checked: {result!r}, cached for {ttl}s")
+
+        future.set_result(result)
+
+        return result
+
+    def clear(self):
+        self._results = {}
+
+        return
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "entries": len(self._results),
+        }
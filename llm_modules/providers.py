@@ -0,0 +1,646 @@
+from abc import ABC, abstractmethod
+import ast
+import asyncio
+import base64
+from collections import defaultdict
+from dataclasses import dataclass
+import hashlib
+import json
+from pathlib import Path
+import random
+import re
+import struct
+import zlib
+import aiofiles
+import aiohttp
+import openai
+import yaml
+from llm_modules.cache import ResponseCache
+
+from logging import debug
+
+
+class LLMProvider(ABC):
+    """Backend that actually answers chat and text-to-image requests.
+    A subclass must implement `chat_completion` and `image_generation` to be instantiated"""
+
+    name = "base"
+
+    @abstractmethod
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        """The answer as a dict in the OpenAI chat completion format"""
+
+    async def stream_chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        """Yield the answer's text deltas. Providers without streaming yield the whole answer at once"""
+        response = await self.chat_completion(model, prompt, api_key, **params)
+        yield response["choices"][0]["message"]["content"]
+
+    @abstractmethod
+    async def image_generation(
+        self,
+        model: str,
+        prompt: str,
+        api_key: str = None,
+        img_size: str = "1024x1024",
+        img_quality: str = "standard",
+        img_n: int = 1,
+        response_format: str = "b64_json",
+    ):
+        """The images as a dict in the OpenAI image generation format"""
+
+    async def validate_api_key(self, api_key: str, model: str):
+        """Return True if the key can be used, otherwise the error"""
+        return True
+
+    async def close(self):
+        return
+
+
+class OpenAIProvider(LLMProvider):
+    """Real OpenAI API. All requests share one keep-alive aiohttp session"""
+
+    name = "openai"
+
+    def __init__(self, max_connections: int = 100, keepalive_timeout: float = 30):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        # The session is bound to the loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or loop is not self._loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+
+        return self._session
+
+    async def _use_session(self):
+        # openai reuses the session stored in its context var instead of
+        # creating a new one per request
+        openai.aiosession.set(await self.get_session())
+
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        await self._use_session()
+        return await openai.ChatCompletion.acreate(
+            api_key=api_key,
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            **params,
+        )
+
+    async def stream_chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        await self._use_session()
+        response = await openai.ChatCompletion.acreate(
+            api_key=api_key,
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            **params,
+        )
+
+        async for chunk in response:
+            delta = chunk["choices"][0]["delta"].get("content")
+            if delta:
+                yield delta
+
+    async def image_generation(
+        self,
+        model: str,
+        prompt: str,
+        api_key: str = None,
+        img_size: str = "1024x1024",
+        img_quality: str = "standard",
+        img_n: int = 1,
+        response_format: str = "b64_json",
+    ):
+        await self._use_session()
+        return await openai.Image.acreate(
+            api_key=api_key,
+            prompt=prompt,
+            model=model,
+            size=img_size,
+            quality=img_quality,
+            n=img_n,
+            response_format=response_format,
+        )
+
+    async def validate_api_key(self, api_key: str, model: str):
+        # A one token answer, unlike retrieving the model it fails for keys out of quota.
+        # The checks are cached and deduplicated by the client's ApiKeyValidator
+        try:
+            await self.chat_completion(model=model, prompt="This is a test.", api_key=api_key, max_tokens=1)
+        except Exception as e:
+            return e
+        else:
+            return True
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+        return
+
+
+FAKE_FIRST_NAMES = [
+    "Ana", "Andrei", "Bogdan", "Ecaterina", "Elena", "Gheorghe", "Ioana", "Ion",
+    "Irina", "Maria", "Mihai", "Nicolae", "Radu", "Sofia", "Stefan", "Vasile",
+]
+FAKE_LAST_NAMES = [
+    "Boieru", "Carp", "Ciobanu", "Cojocaru", "Lupu", "Moraru", "Popescu",
+    "Rusu", "Stoica", "Tanase", "Ungureanu", "Vrabie",
+]
+FAKE_EVENTS = [
+    "A light rain falls over the fields.",
+    "Merchants arrive at the market square with new goods.",
+    "The river rises after a night of storms.",
+    "A quiet day passes without notable events.",
+    "Smoke from the forge drifts over the rooftops.",
+    "Children play by the church while the elders talk.",
+    "A traveller brings news from a distant town.",
+    "The harvest work keeps everyone busy.",
+]
+FAKE_ACTIVITIES = [
+    "works in the fields",
+    "talks with neighbours",
+    "rests at home",
+    "trades at the market",
+    "repairs some tools",
+    "walks along the river",
+    "prays in the church",
+    "helps a friend",
+]
+FAKE_GOALS = [
+    "Become a respected craftsman",
+    "Start a family",
+    "Save enough money to buy land",
+    "Live a quiet and peaceful life",
+    "Protect the village from danger",
+    "Travel to the capital",
+    "Open a tavern",
+    "Learn to read and write",
+]
+
+
+def get_prompt_kind(prompt: str) -> str:
+    """Guess which of the game's prompts is sent by the output template it asks for"""
+    if "history_summaries:" in prompt:
+        return "history_summaries"
+    if "world_new_state" in prompt:
+        return "world_state"
+    if "current_npcs:" in prompt:
+        return "npcs_states"
+    if "npc_new_state" in prompt:
+        return "npc_state"
+    if "current_npc_name:" in prompt:
+        return "social_connections"
+    if "num_global_goals:" in prompt:
+        return "global_goals"
+    if "npc_global_goal:" in prompt:
+        return "new_npc"
+
+    return "text"
+
+
+def parse_attribute_names(text: str) -> list[str]:
+    """Names of the first `attributes:` mapping found in a yaml dump inside the prompt"""
+    match = re.search(r"attributes:[ \t]*\n((?:[ \t]+[\w ]+:.*\n?)+)", text)
+    if not match:
+        return []
+
+    return re.findall(r"^[ \t]+([\w ]+?):", match.group(1), re.MULTILINE)
+
+
+def parse_dict_literal(text: str, key: str) -> dict:
+    match = re.search(rf"{key}:\s*(\{{.*?\}})", text, re.DOTALL)
+    if not match:
+        return {}
+
+    try:
+        value = ast.literal_eval(match.group(1))
+    except (ValueError, SyntaxError):
+        return {}
+
+    return value if isinstance(value, dict) else {}
+
+
+def parse_quoted_value(text: str, key: str) -> str:
+    match = re.search(rf'{key}: "(.*?)"', text)
+    return match.group(1) if match else ""
+
+
+def parse_int_value(text: str, key: str, default: int = 0) -> int:
+    match = re.search(rf"{key}: (\d+)", text)
+    return int(match.group(1)) if match else default
+
+
+def parse_npc_names(text: str) -> list[str]:
+    names = re.findall(r"name: ['\"]?([^'\"\\\n]+)", text)
+    return [name.strip() for name in names if name.strip()]
+
+
+def make_png(width: int, height: int, rgb: tuple[int, int, int]) -> bytes:
+    """Smallest valid single-colour PNG"""
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+        )
+
+    row = b"\x00" + bytes(rgb) * width
+    raw_data = row * height
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw_data))
+        + chunk(b"IEND", b"")
+    )
+
+
+def to_yaml_code_block(data) -> str:
+    data_str = yaml.safe_dump(data, sort_keys=False, allow_unicode=True, width=1000)
+    return f"```yaml\n{data_str}```"
+
+
+class FakeProvider(LLMProvider):
+    """Offline deterministic backend for benchmarks and load tests.
+
+    Answers every prompt kind the game sends (world state, NPC state, new NPC,
+    global goals, social connections) with valid YAML derived from the prompt.
+    The same sequence of prompts always gets the same answers. Latency and errors
+    (rate limits, server errors, timeouts, malformed output) can be injected.
+    """
+
+    name = "fake"
+    error_kinds = ("rate_limit", "server_error", "timeout", "malformed")
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        image_size: int = 8,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.image_size = image_size
+
+        self.requests_num = 0
+        self.errors_num = 0
+
+        self._error_rng = random.Random(seed)
+        self._prompt_calls = defaultdict(int)
+
+    def _get_rng(self, prompt: str) -> random.Random:
+        # Identical prompts asked again get different but still reproducible answers
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        self._prompt_calls[prompt_hash] += 1
+
+        return random.Random(f"{self.seed}-{prompt_hash}-{self._prompt_calls[prompt_hash]}")
+
+    async def _simulate(self, rng: random.Random, latency_share: float = 1.0):
+        self.requests_num += 1
+
+        delay = (self.latency + rng.uniform(0, self.latency_jitter)) * latency_share
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.error_rate and self._error_rng.random() < self.error_rate:
+            self.errors_num += 1
+            error_kind = self._error_rng.choice(self.error_kinds)
+
+            if error_kind == "rate_limit":
+                raise openai.error.RateLimitError(
+                    "Fake rate limit", http_status=429, headers={"retry-after": "0.1"}
+                )
+            if error_kind == "server_error":
+                raise openai.error.APIError("Fake server error", http_status=500)
+            if error_kind == "timeout":
+                raise openai.error.Timeout("Fake timeout")
+
+            return error_kind
+
+        return None
+
+    def make_content(self, prompt: str, rng: random.Random) -> str:
+        prompt_kind = get_prompt_kind(prompt)
+
+        if prompt_kind == "world_state":
+            attributes = parse_dict_literal(prompt, "world_current_attributes")
+            new_attributes = {}
+            for key, value in attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    new_attributes[key] = value + rng.randint(-2, 2)
+                else:
+                    new_attributes[key] = value
+            if not new_attributes:
+                new_attributes = {"temperature": rng.randint(-5, 30)}
+
+            data = {
+                "world_new_state": " ".join(rng.sample(FAKE_EVENTS, 2)),
+                "attributes": new_attributes,
+            }
+
+        elif prompt_kind == "npc_state":
+            current_npc = prompt[prompt.find("current_npc:"):]
+            npc_name = (parse_npc_names(current_npc) or ["The NPC"])[0]
+            max_delta_match = re.search(r"no more than (\d+)/", prompt)
+            max_delta = int(max_delta_match.group(1)) if max_delta_match else 5
+            attribute_names = parse_attribute_names(current_npc) or ["happiness"]
+
+            data = {
+                "npc_new_state": f"{npc_name} {rng.choice(FAKE_ACTIVITIES)}.",
+                "attributes": {
+                    name: rng.randint(-max_delta, max_delta) for name in attribute_names
+                },
+            }
+
+        elif prompt_kind == "npcs_states":
+            max_delta_match = re.search(r"no more than (\d+)/", prompt)
+            max_delta = int(max_delta_match.group(1)) if max_delta_match else 5
+            current_npcs_match = re.search(r"current_npcs:\s*```yaml\n(.*?)```", prompt, re.DOTALL)
+            try:
+                current_npcs = yaml.safe_load(current_npcs_match.group(1)) if current_npcs_match else []
+            except yaml.YAMLError:
+                current_npcs = []
+
+            data = []
+            for npc in current_npcs if isinstance(current_npcs, list) else []:
+                attribute_names = list((npc.get("attributes") or {"happiness": 0}).keys())
+                data.append(
+                    {
+                        "name": npc.get("name", ""),
+                        "npc_new_state": f"{npc.get('name', 'The NPC')} {rng.choice(FAKE_ACTIVITIES)}.",
+                        "attributes": {
+                            name: rng.randint(-max_delta, max_delta) for name in attribute_names
+                        },
+                    }
+                )
+
+        elif prompt_kind == "history_summaries":
+            histories_match = re.search(r"histories:\s*```yaml\n(.*?)```", prompt, re.DOTALL)
+            try:
+                histories = yaml.safe_load(histories_match.group(1)) if histories_match else []
+            except yaml.YAMLError:
+                histories = []
+
+            data = {"history_summaries": []}
+            for history in histories if isinstance(histories, list) else []:
+                summary = " ".join(
+                    [history.get("history_summary") or ""] + list(history.get("old_states") or [])
+                ).split()
+                data["history_summaries"].append(
+                    {"name": history.get("name", ""), "history_summary": " ".join(summary[-60:])}
+                )
+
+        elif prompt_kind == "new_npc":
+            attribute_names = parse_attribute_names(prompt) or ["happiness"]
+            name = f"{rng.choice(FAKE_FIRST_NAMES)} {rng.choice(FAKE_LAST_NAMES)}"
+
+            data = {
+                "name": name,
+                "global_goal": parse_quoted_value(prompt, "npc_global_goal") or rng.choice(FAKE_GOALS),
+                "attributes": {name: rng.randint(0, 10) for name in attribute_names},
+                "social_connections": [],
+                "current_state_prompt": f"{name} {rng.choice(FAKE_ACTIVITIES)}.",
+            }
+
+        elif prompt_kind == "global_goals":
+            goals_num = parse_int_value(prompt, "num_global_goals", default=len(FAKE_GOALS))
+            data = [
+                f"{FAKE_GOALS[i % len(FAKE_GOALS)]} ({i + 1})" for i in range(goals_num)
+            ]
+
+        elif prompt_kind == "social_connections":
+            max_connections = parse_int_value(prompt, "max_npc_social_connections", default=5)
+            other_npcs = parse_npc_names(prompt[prompt.find("other_npcs:"):])
+            other_npcs = list(dict.fromkeys(other_npcs))
+            data = rng.sample(other_npcs, min(len(other_npcs), rng.randint(1, max(1, max_connections))))
+
+        else:
+            data = {"text": rng.choice(FAKE_EVENTS)}
+
+        return to_yaml_code_block(data)
+
+    def _make_answer(self, prompt: str, rng: random.Random, error_kind: str | None) -> str:
+        if error_kind == "malformed":
+            return "```yaml\n: this is not: [valid yaml\n```"
+
+        return self.make_content(prompt, rng)
+
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        rng = self._get_rng(prompt)
+        error_kind = await self._simulate(rng)
+        content = self._make_answer(prompt, rng, error_kind)
+
+        response = {
+            "object": "chat.completion",
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (len(prompt) + len(content)) // 4,
+            },
+        }
+
+        return openai.util.convert_to_openai_object(response)
+
+    async def stream_chat_completion(
+        self, model: str, prompt: str, api_key: str = None, chunk_size: int = 16, **params
+    ):
+        # A fifth of the latency is spent before the first token, the rest is spread over the chunks
+        rng = self._get_rng(prompt)
+        error_kind = await self._simulate(rng, latency_share=0.2)
+        content = self._make_answer(prompt, rng, error_kind)
+
+        chunks = [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+        chunk_delay = self.latency * 0.8 / max(1, len(chunks))
+        for chunk in chunks:
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+            yield chunk
+
+    async def image_generation(
+        self,
+        model: str,
+        prompt: str,
+        api_key: str = None,
+        img_size: str = "1024x1024",
+        img_quality: str = "standard",
+        img_n: int = 1,
+        response_format: str = "b64_json",
+    ):
+        rng = self._get_rng(prompt)
+        await self._simulate(rng)
+
+        images = []
+        for _ in range(img_n):
+            rgb = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+            image = make_png(self.image_size, self.image_size, rgb)
+            images.append({"b64_json": base64.b64encode(image).decode("utf-8")})
+
+        return openai.util.convert_to_openai_object({"data": images})
+
+
+class ReplayMissError(Exception):
+    """Request that was not captured in the recording"""
+
+    retryable = False
+
+
+class RecordingProvider(LLMProvider):
+    """Forwards requests to another provider and appends every answer to a jsonl recording"""
+
+    name = "record"
+
+    def __init__(self, provider: LLMProvider, recording_path: Path):
+        self.provider = provider
+        self.recording_path = Path(recording_path)
+        self._lock = asyncio.Lock()
+
+    async def _record(self, key: str, model_type: str, response):
+        self.recording_path.parent.mkdir(parents=True, exist_ok=True)
+        record = json.dumps({"key": key, "model_type": model_type, "response": response})
+
+        async with self._lock:
+            async with aiofiles.open(self.recording_path, "a") as f:
+                await f.write(record + "\n")
+
+        return
+
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        response = await self.provider.chat_completion(model, prompt, api_key, **params)
+        await self._record(ResponseCache.make_key(model, prompt, "chat", params), "chat", response)
+
+        return response
+
+    async def image_generation(self, model: str, prompt: str, api_key: str = None, **params):
+        response = await self.provider.image_generation(model, prompt, api_key, **params)
+        await self._record(ResponseCache.make_key(model, prompt, "image", params), "image", response)
+
+        return response
+
+    async def validate_api_key(self, api_key: str, model: str):
+        return await self.provider.validate_api_key(api_key, model)
+
+    async def close(self):
+        await self.provider.close()
+
+
+class ReplayProvider(LLMProvider):
+    """Serves the answers captured by `RecordingProvider` without any network calls.
+
+    Identical requests get their recorded answers in the recorded order, the last
+    one is repeated once they run out.
+    """
+
+    name = "replay"
+
+    def __init__(self, recording_path: Path, latency: float = 0.0):
+        self.recording_path = Path(recording_path)
+        self.latency = latency
+
+        self._responses: dict[str, list] | None = None
+        self._served = defaultdict(int)
+
+    def _load(self):
+        if self._responses is not None:
+            return
+
+        self._responses = defaultdict(list)
+        if not self.recording_path.exists():
+            debug(f"Recording {self.recording_path} doesn't exist")
+            return
+
+        with open(self.recording_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self._responses[record["key"]].append(record["response"])
+
+        return
+
+    async def _replay(self, key: str):
+        self._load()
+        responses = self._responses.get(key)
+        if not responses:
+            raise ReplayMissError(f"Request {key} is not in the recording {self.recording_path}")
+
+        response_num = min(self._served[key], len(responses) - 1)
+        self._served[key] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        return openai.util.convert_to_openai_object(responses[response_num])
+
+    async def chat_completion(self, model: str, prompt: str, api_key: str = None, **params):
+        return await self._replay(ResponseCache.make_key(model, prompt, "chat", params))
+
+    async def image_generation(self, model: str, prompt: str, api_key: str = None, **params):
+        return await self._replay(ResponseCache.make_key(model, prompt, "image", params))
+
+
+@dataclass(frozen=True)
+class ProviderConfig:
+    provider: str = "openai"  # openai, fake, record or replay
+    recording_path: str = ""
+    fake_latency: float = 0.0
+    fake_latency_jitter: float = 0.0
+    fake_error_rate: float = 0.0
+    fake_seed: int = 0
+    max_connections: int = 100
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            provider=settings.llm_provider,
+            recording_path=settings.llm_recording_path,
+            fake_latency=settings.fake_llm_latency,
+            fake_latency_jitter=settings.fake_llm_latency_jitter,
+            fake_error_rate=settings.fake_llm_error_rate,
+            fake_seed=settings.fake_llm_seed,
+            max_connections=settings.llm_max_connections,
+        )
+
+
+def make_provider(config: ProviderConfig, default_recording_path: Path = None) -> LLMProvider:
+    recording_path = Path(config.recording_path) if config.recording_path else default_recording_path
+
+    if config.provider == "openai":
+        return OpenAIProvider(max_connections=config.max_connections)
+    elif config.provider == "fake":
+        return FakeProvider(
+            latency=config.fake_latency,
+            latency_jitter=config.fake_latency_jitter,
+            error_rate=config.fake_error_rate,
+            seed=config.fake_seed,
+        )
+    elif config.provider == "record":
+        return RecordingProvider(OpenAIProvider(max_connections=config.max_connections), recording_path)
+    elif config.provider == "replay":
+        return ReplayProvider(recording_path, latency=config.fake_latency)
+    else:
+        raise ValueError(f"Unknown LLM provider: {config.provider}")
@@ -0,0 +1,192 @@
+import asyncio
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import itertools
+import random
+import time
+import openai
+
+
+# Error codes that won't go away by retrying, the request fails at once
+NON_RETRYABLE_CODES = (
+    "invalid_api_key",
+    "insufficient_quota",
+    "model_not_found",
+    "context_length_exceeded",
+    "billing_hard_limit_reached",
+    "account_deactivated",
+)
+
+# Seconds a request retried until its deadline (max_tries -1) may take when no deadline is set
+DEFAULT_DEADLINE = 300.0
+
+
+class ResponseProcessingError(Exception):
+    """The model answered but one of the response processors rejected the answer
+    (broken YAML, missing keys, etc.)"""
+
+
+class RequestFailedError(Exception):
+    """All tries of the request failed or its deadline was exceeded"""
+
+
+class RetryClass:
+    fatal = "fatal"  # auth, quota, bad request: fail at once
+    rate_limited = "rate_limited"  # 429, back off and honor Retry-After
+    transient = "transient"  # timeouts, connection errors, 5xx: back off
+    processing = "processing"  # bad model output: ask again right away
+
+
+def get_error_code(error: Exception) -> str | None:
+    code = getattr(error, "code", None)
+    if not code:
+        code = getattr(getattr(error, "error", None), "code", None)
+
+    return code
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Seconds to wait according to the `Retry-After` (or `retry-after-ms`) header of the error"""
+    headers = getattr(error, "headers", None) or {}
+
+    def header(name):
+        return headers.get(name) or headers.get(name.title()) or headers.get(name.upper())
+
+    retry_after_ms = header("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = header("retry-after")
+    if not retry_after:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+@dataclass
+class RetryPolicy:
+    """How `request_openai` retries a failed request.
+
+    Waits grow exponentially with full jitter up to `max_delay`, a `Retry-After`
+    sent by the provider takes precedence. Non-retryable errors are raised at once and
+    no retry is started once it can't finish before the `deadline` (in seconds)
+    of the whole call. Retrying until the deadline (`max_tries` -1) without a
+    deadline uses `DEFAULT_DEADLINE`, so a request is never retried forever.
+    """
+
+    max_tries: int = 5  # -1 means retry until the deadline
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    multiplier: float = 2.0
+    jitter: bool = True
+    deadline: float | None = DEFAULT_DEADLINE
+    non_retryable_codes: tuple = field(default=NON_RETRYABLE_CODES)
+
+    def __post_init__(self):
+        if self.max_tries == -1 and not self.deadline:
+            self.deadline = DEFAULT_DEADLINE
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            max_tries=settings.llm_request_tries_num,
+            base_delay=settings.llm_retry_base_delay,
+            max_delay=settings.llm_retry_max_delay,
+            deadline=settings.llm_request_deadline or None,
+        )
+
+    def tries(self):
+        if self.max_tries == -1:
+            return itertools.count()
+
+        return range(self.max_tries)
+
+    def is_last_try(self, i: int) -> bool:
+        return self.max_tries != -1 and i >= self.max_tries - 1
+
+    def classify(self, error: Exception) -> str:
+        if isinstance(error, ResponseProcessingError):
+            return RetryClass.processing
+
+        if get_error_code(error) in self.non_retryable_codes:
+            return RetryClass.fatal
+
+        # Errors can declare themselves non-retryable
+        if getattr(error, "retryable", True) is False:
+            return RetryClass.fatal
+
+        if isinstance(
+            error,
+            (
+                openai.error.AuthenticationError,
+                openai.error.PermissionError,
+                openai.error.InvalidRequestError,
+                openai.error.InvalidAPIType,
+                openai.error.SignatureVerificationError,
+            ),
+        ):
+            return RetryClass.fatal
+
+        if isinstance(error, openai.error.RateLimitError):
+            return RetryClass.rate_limited
+
+        # Timeouts, connection errors, 5xx and anything unexpected
+        return RetryClass.transient
+
+    def is_retryable(self, error: Exception) -> bool:
+        return self.classify(error) != RetryClass.fatal
+
+    def get_delay(self, try_num: int, error: Exception) -> float:
+        """Seconds to wait before the try following `try_num` (0-based) that failed with `error`"""
+        retry_class = self.classify(error)
+
+        if retry_class == RetryClass.processing:
+            return 0.0
+
+        if retry_class == RetryClass.rate_limited:
+            retry_after = get_retry_after(error)
+            if retry_after is not None:
+                return retry_after
+
+        delay = min(self.max_delay, self.base_delay * self.multiplier**try_num)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        return delay
+
+    def get_deadline_at(self) -> float | None:
+        """Monotonic time the call has to finish by"""
+        if not self.deadline:
+            return None
+
+        return time.monotonic() + self.deadline
+
+    @staticmethod
+    def fits_deadline(deadline_at: float | None, delay: float) -> bool:
+        if deadline_at is None:
+            return True
+
+        return time.monotonic() + delay < deadline_at
+
+    @staticmethod
+    def time_left(deadline_at: float | None) -> float | None:
+        if deadline_at is None:
+            return None
+
+        return max(0.0, deadline_at - time.monotonic())
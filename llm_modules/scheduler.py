@@ -0,0 +1,184 @@
+import asyncio
+from collections import deque
+import time
+
+from logging import debug
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough local token count, ~4 characters per token for English text"""
+    return len(text) // 4 + 4
+
+
+class ModelBudget:
+    """Rolling requests-per-minute and tokens-per-minute budget of one model.
+
+    Requests are released in arrival order as soon as both budgets of the last
+    `window` seconds allow them.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+
+        # [timestamp, tokens] of the requests released during the last window
+        self._released: deque[list] = deque()
+        self._lock = asyncio.Lock()
+
+        self.queued = 0
+        self.queued_tokens = 0
+
+    def _purge(self, now: float):
+        while self._released and self._released[0][0] <= now - self.window:
+            self._released.popleft()
+
+    def used_tokens(self) -> int:
+        return sum(tokens for _, tokens in self._released)
+
+    def get_wait(self, tokens: int, now: float) -> float:
+        """Seconds until a request of `tokens` tokens fits both budgets"""
+        self._purge(now)
+        wait = 0.0
+
+        if self.rpm and len(self._released) >= self.rpm:
+            oldest_to_expire = self._released[len(self._released) - self.rpm]
+            wait = max(wait, oldest_to_expire[0] + self.window - now)
+
+        if self.tpm:
+            # A request bigger than the whole budget waits for an empty window
+            tokens = min(tokens, self.tpm)
+            excess = self.used_tokens() + tokens - self.tpm
+            for timestamp, released_tokens in self._released:
+                if excess <= 0:
+                    break
+                excess -= released_tokens
+                wait = max(wait, timestamp + self.window - now)
+
+        return wait
+
+    async def acquire(self, tokens: int) -> list:
+        """Wait until the request fits the budget and return its reservation"""
+        self.queued += 1
+        self.queued_tokens += tokens
+        try:
+            # asyncio.Lock wakes up waiters in FIFO order
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    wait = self.get_wait(tokens, now)
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+
+                reservation = [now, tokens]
+                self._released.append(reservation)
+        finally:
+            self.queued -= 1
+            self.queued_tokens -= tokens
+
+        return reservation
+
+    def predict_drain_time(self) -> float:
+        """Seconds until every queued request is released at the current limits"""
+        now = time.monotonic()
+        self._purge(now)
+
+        drain_time = 0.0
+        if self.rpm:
+            requests_left = self.queued - (self.rpm - len(self._released))
+            drain_time = max(drain_time, requests_left / self.rpm * self.window)
+        if self.tpm:
+            tokens_left = self.queued_tokens - (self.tpm - self.used_tokens())
+            drain_time = max(drain_time, tokens_left / self.tpm * self.window)
+
+        return max(0.0, drain_time)
+
+
+class RateScheduler:
+    """Keeps the requests of every model under its configured RPM/TPM limits.
+
+    Prompt tokens are estimated locally before the request is sent and replaced
+    with the real usage reported by the provider when the answer arrives, so the
+    budget is used up to the ceiling but not over it.
+    """
+
+    def __init__(self, rate_limits: dict[str, dict] | None = None, expected_completion_tokens: int = 400):
+        self.rate_limits: dict[str, dict] = {}
+        self.expected_completion_tokens = expected_completion_tokens
+        self._budgets: dict[str, ModelBudget] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        self.configure(rate_limits or {})
+
+    def configure(self, rate_limits: dict[str, dict], expected_completion_tokens: int | None = None):
+        if expected_completion_tokens:
+            self.expected_completion_tokens = expected_completion_tokens
+
+        for model, limits in rate_limits.items():
+            rpm = int(limits.get("rpm", 0) or 0)
+            tpm = int(limits.get("tpm", 0) or 0)
+
+            budget = self._budgets.get(model)
+            if budget is None:
+                self._budgets[model] = ModelBudget(rpm=rpm, tpm=tpm)
+            else:
+                budget.rpm = rpm
+                budget.tpm = tpm
+
+        for model in set(self._budgets) - set(rate_limits):
+            del self._budgets[model]
+
+        self.rate_limits = dict(rate_limits)
+
+        return
+
+    def _check_loop(self):
+        # The budgets' locks are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._budgets = {
+                model: ModelBudget(rpm=budget.rpm, tpm=budget.tpm, window=budget.window)
+                for model, budget in self._budgets.items()
+            }
+
+    def estimate_request_tokens(self, prompt: str, max_tokens: int | None = None) -> int:
+        return estimate_tokens(prompt) + (max_tokens or self.expected_completion_tokens)
+
+    async def acquire(self, model: str, tokens: int) -> list | None:
+        """Wait for the model's budget. Returns the reservation, None for models without limits"""
+        self._check_loop()
+        budget = self._budgets.get(model)
+        if budget is None:
+            return None
+
+        reservation = await budget.acquire(tokens)
+        debug(f"Rate budget of {model}: {len(budget._released)} requests, {budget.used_tokens()} tokens in the window")
+
+        return reservation
+
+    @staticmethod
+    def record_usage(reservation: list | None, response):
+        """Replace the estimated tokens of the reservation with the real usage of the response"""
+        if reservation is None:
+            return
+
+        try:
+            reservation[1] = int(response["usage"]["total_tokens"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        return
+
+    def get_status(self) -> dict[str, dict]:
+        return {
+            model: {
+                "rpm": budget.rpm,
+                "tpm": budget.tpm,
+                "queue_depth": budget.queued,
+                "queued_tokens": budget.queued_tokens,
+                "predicted_drain_time": budget.predict_drain_time(),
+            }
+            for model, budget in self._budgets.items()
+        }
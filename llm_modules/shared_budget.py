@@ -0,0 +1,312 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+import threading
+import time
+from llm_modules.scheduler import ModelBudget
+
+from logging import debug
+
+
+# Number of rate leases a shard takes per window at most, the smaller the more evenly
+# the budget is split between the shards but the more calls to the coordinator
+RATE_LEASES_PER_WINDOW = 20
+# Seconds a leased part of the rate budget can be used for, unused it is left to expire
+RATE_LEASE_TTL = 5.0
+
+
+class BudgetCoordinator:
+    """Provider budget shared by the worker processes of a sharded simulation.
+
+    Lives in the manager's server process, each call comes from a worker over a
+    proxy in its own thread. The workers don't call it for every request, they
+    lease the budget in parts and hand it out to their requests locally (see
+    `SharedBudget`):
+
+    - concurrency slots (`max_concurrent_requests`, the same setting the LLM client
+      uses in a single process) are leased up to a fair share of the model's limit
+      per shard, the shards that are finished give theirs back to the others;
+    - the RPM/TPM window is leased in chunks of requests and tokens, each reserved
+      in the window when it is leased.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        max_concurrent_requests: dict[str, int] | None = None,
+        default_max_concurrent_requests: int = 8,
+        rate_limits: dict[str, dict] | None = None,
+    ):
+        self.shards = shards
+        self.max_concurrent_requests = dict(max_concurrent_requests or {})
+        self.default_max_concurrent_requests = default_max_concurrent_requests
+        self.rate_limits = {
+            model: {"rpm": int(limits.get("rpm", 0) or 0), "tpm": int(limits.get("tpm", 0) or 0)}
+            for model, limits in (rate_limits or {}).items()
+        }
+
+        self._budgets = {
+            model: ModelBudget(rpm=limits["rpm"], tpm=limits["tpm"]) for model, limits in self.rate_limits.items()
+        }
+        self._condition = threading.Condition()
+        self._finished_shards: set[int] = set()
+
+        # Slots leased by each shard, per model
+        self.leased: dict[int, dict[str, int]] = {}
+        self.max_leased: dict[str, int] = {}
+        self.slot_leases: dict[str, int] = {}
+        self.rate_leases: dict[str, int] = {}
+
+    def get_limit(self, model: str) -> int:
+        return self.max_concurrent_requests.get(model, self.default_max_concurrent_requests)
+
+    def get_rate_limits(self) -> dict[str, dict]:
+        return self.rate_limits
+
+    def get_shard_share(self, model: str) -> int:
+        """Slots of the model one shard may hold, the limit split between the running shards"""
+        running_shards = max(1, self.shards - len(self._finished_shards))
+
+        return -(-self.get_limit(model) // running_shards)
+
+    def get_leased(self, model: str) -> int:
+        return sum(shard_leased.get(model, 0) for shard_leased in self.leased.values())
+
+    def lease_slots(self, shard: int, model: str, timeout: float = 1.0) -> int:
+        """Lease the shard's free share of the model's slots. 0 if none was free within `timeout`"""
+        shard_leased = self.leased.setdefault(shard, {})
+
+        def get_grantable():
+            if shard in self._finished_shards:
+                return 0
+            free = self.get_limit(model) - self.get_leased(model)
+            return min(free, self.get_shard_share(model) - shard_leased.get(model, 0))
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: get_grantable() > 0, timeout):
+                return 0
+
+            granted = get_grantable()
+            shard_leased[model] = shard_leased.get(model, 0) + granted
+            self.max_leased[model] = max(self.max_leased.get(model, 0), self.get_leased(model))
+            self.slot_leases[model] = self.slot_leases.get(model, 0) + 1
+
+        return granted
+
+    def lease_rate(self, model: str, requests: int, min_tokens: int, tokens: int, timeout: float = 1.0) -> tuple[int, int]:
+        """Reserve up to `requests` requests and `tokens` tokens of the model's rate window,
+        at least one request of `min_tokens`. (0, 0) if they didn't fit within `timeout`"""
+        budget = self._budgets.get(model)
+        if budget is None:
+            return requests, tokens
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = budget.get_wait(min_tokens, now)
+                if wait <= 0:
+                    break
+                if now >= deadline:
+                    return 0, 0
+                self._condition.wait(min(wait, deadline - now))
+
+            free_requests = budget.rpm - len(budget._released) if budget.rpm else requests
+            free_tokens = budget.tpm - budget.used_tokens() if budget.tpm else tokens
+            granted_requests = max(1, min(requests, free_requests))
+            granted_tokens = max(min_tokens, min(tokens, free_tokens))
+
+            # One entry per request for the RPM, the tokens on the first one
+            budget._released.append([now, granted_tokens])
+            if budget.rpm:
+                budget._released.extend([now, 0] for _ in range(granted_requests - 1))
+            self.rate_leases[model] = self.rate_leases.get(model, 0) + 1
+
+        return granted_requests, granted_tokens
+
+    def finish_shard(self, shard: int):
+        """Give back every slot the shard holds, the other shards' shares grow"""
+        with self._condition:
+            self._finished_shards.add(shard)
+            self.leased.pop(shard, None)
+            self._condition.notify_all()
+
+        return
+
+    def get_status(self) -> dict[str, dict]:
+        with self._condition:
+            return {
+                model: {
+                    "leased": self.get_leased(model),
+                    "max_leased": self.max_leased.get(model, 0),
+                    "slot_leases": slot_leases,
+                    "rate_leases": self.rate_leases.get(model, 0),
+                    "limit": self.get_limit(model),
+                }
+                for model, slot_leases in self.slot_leases.items()
+            }
+
+
+class BudgetManager(BaseManager):
+    pass
+
+
+BudgetManager.register("BudgetCoordinator", BudgetCoordinator)
+
+
+class SharedBudget:
+    """Worker side of the `BudgetCoordinator`, used by the LLM client of a worker process.
+
+    The slots and the rate budget leased from the coordinator are handed out to the
+    worker's requests locally, so the coordinator is only called when they run out,
+    not for every request. The slots are kept until the worker is closed. A rate
+    lease is used within `RATE_LEASE_TTL` seconds of being reserved, so the provider
+    sees at most that much of a shift of the requests against the shared window.
+
+    The blocking proxy calls run in threads so the worker's loop keeps running the
+    other worlds meanwhile.
+    """
+
+    def __init__(self, coordinator, shard: int, shards: int, poll_timeout: float = 1.0):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.shards = shards
+        self.poll_timeout = poll_timeout
+        self.rate_limits: dict[str, dict] = coordinator.get_rate_limits()
+
+        self._executor = ThreadPoolExecutor(4, thread_name_prefix="budget-lease")
+
+        self.slots_leased: dict[str, int] = {}
+        self.slots_used: dict[str, int] = {}
+        self._slot_leasing: set[str] = set()
+        self._slot_waiters: dict[str, deque[asyncio.Future]] = {}
+
+        # [leased at, requests, tokens] left of the last rate lease, per model
+        self._rate_credits: dict[str, list] = {}
+        self._rate_locks: dict[str, asyncio.Lock] = {}
+
+        self.requests: dict[str, int] = {}
+        self.max_in_flight: dict[str, int] = {}
+
+    async def _call(self, function, *args):
+        """Call the coordinator in a thread. A call cancelled here still completes there"""
+        loop = asyncio.get_running_loop()
+
+        return await asyncio.shield(loop.run_in_executor(self._executor, function, *args))
+
+    async def _lease_slots(self, model: str):
+        try:
+            granted = await self._call(self.coordinator.lease_slots, self.shard, model, self.poll_timeout)
+        finally:
+            self._slot_leasing.discard(model)
+
+        if granted:
+            self.slots_leased[model] = self.slots_leased.get(model, 0) + granted
+            debug(f"Leased {granted} slots of {model}, {self.slots_leased[model]} in total")
+        else:
+            debug(f"Waiting for the shared budget of {model}")
+        # The waiters check again, one of them leases more if they still don't fit
+        for waiter in self._slot_waiters.get(model, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+        return
+
+    async def acquire_slot(self, model: str):
+        loop = asyncio.get_running_loop()
+        waiters = self._slot_waiters.setdefault(model, deque())
+        while self.slots_used.get(model, 0) >= self.slots_leased.get(model, 0):
+            if model not in self._slot_leasing:
+                self._slot_leasing.add(model)
+                loop.create_task(self._lease_slots(model))
+
+            waiter = loop.create_future()
+            waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken up for a freed slot but cancelled before taking it, pass it on
+                if waiter.done() and not waiter.cancelled():
+                    waiters.remove(waiter)
+                    self.wake_slot_waiter(model)
+                    raise
+                waiters.remove(waiter)
+                raise
+            waiters.remove(waiter)
+
+        self.slots_used[model] = self.slots_used.get(model, 0) + 1
+        self.requests[model] = self.requests.get(model, 0) + 1
+        self.max_in_flight[model] = max(self.max_in_flight.get(model, 0), self.slots_used[model])
+
+        return
+
+    def release_slot(self, model: str):
+        """Doesn't wait, so it can be called while the request is being cancelled"""
+        self.slots_used[model] -= 1
+        self.wake_slot_waiter(model)
+
+        return
+
+    def wake_slot_waiter(self, model: str):
+        for waiter in self._slot_waiters.get(model, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+        return
+
+    def get_rate_chunk(self, model: str, tokens: int) -> tuple[int, int]:
+        """Requests and tokens to lease at once: the shard's share of the window in `RATE_LEASES_PER_WINDOW` parts"""
+        limits = self.rate_limits[model]
+        parts = self.shards * RATE_LEASES_PER_WINDOW
+        requests = max(1, limits["rpm"] // parts) if limits["rpm"] else 2**31
+        chunk_tokens = max(tokens, limits["tpm"] // parts) if limits["tpm"] else 2**31
+
+        return requests, chunk_tokens
+
+    async def acquire_rate(self, model: str, tokens: int):
+        if model not in self.rate_limits:
+            return
+
+        lock = self._rate_locks.setdefault(model, asyncio.Lock())
+        # asyncio.Lock wakes up waiters in FIFO order
+        async with lock:
+            while True:
+                credit = self._rate_credits.get(model)
+                if (
+                    credit is not None
+                    and time.monotonic() - credit[0] < RATE_LEASE_TTL
+                    and credit[1] >= 1
+                    and credit[2] >= tokens
+                ):
+                    credit[1] -= 1
+                    credit[2] -= tokens
+                    return
+
+                requests, chunk_tokens = self.get_rate_chunk(model, tokens)
+                leased_at = time.monotonic()
+                granted_requests, granted_tokens = await self._call(
+                    self.coordinator.lease_rate, model, requests, tokens, chunk_tokens, self.poll_timeout
+                )
+                if granted_requests:
+                    self._rate_credits[model] = [leased_at, granted_requests, granted_tokens]
+                else:
+                    debug(f"Waiting for the shared rate budget of {model}")
+
+    def get_status(self) -> dict[str, dict]:
+        return {
+            model: {
+                "requests": requests,
+                "max_in_flight": self.max_in_flight.get(model, 0),
+                "leased": self.slots_leased.get(model, 0),
+            }
+            for model, requests in self.requests.items()
+        }
+
+    def close(self):
+        """Give the leased slots back to the other shards"""
+        self.coordinator.finish_shard(self.shard)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        return
@@ -0,0 +1,97 @@
+import re
+import typing
+import yaml
+
+
+def strip_code_block(text: str) -> str:
+    """Remove the ```yaml fence from a (possibly unfinished) answer"""
+    text = text.lstrip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+    fence_end = text.rfind("```")
+    if fence_end != -1:
+        text = text[:fence_end]
+
+    return text
+
+
+def extract_partial_yaml(text: str) -> dict:
+    """Extract the top-level fields of an unfinished YAML mapping.
+
+    Every field before the last one is complete and parsed as YAML. The last one is
+    parsed from its complete lines if possible, a string that is still being
+    generated is returned as the text received so far.
+    """
+    text = strip_code_block(text)
+
+    keys = list(re.finditer(r"^([A-Za-z_]\w*):", text, re.MULTILINE))
+    if not keys:
+        return {}
+
+    fields = {}
+    last_key = keys[-1]
+
+    head = text[: last_key.start()]
+    try:
+        parsed = yaml.safe_load(head) if head.strip() else None
+    except yaml.YAMLError:
+        parsed = None
+    if isinstance(parsed, dict):
+        fields.update(parsed)
+
+    key = last_key.group(1)
+    tail = text[last_key.start():]
+    complete_tail = tail.rpartition("\n")[0]
+    try:
+        parsed = yaml.safe_load(complete_tail) if complete_tail.strip() else None
+    except yaml.YAMLError:
+        parsed = None
+
+    if isinstance(parsed, dict) and parsed.get(key) is not None:
+        fields[key] = parsed[key]
+    else:
+        value = tail[last_key.end():].strip()
+        # Mappings and lists are reported only once they can be parsed
+        if value and value[0] not in "{[-":
+            if value[0] in "\"'":
+                value = value[1:]
+            if value[-1:] in "\"'":
+                value = value[:-1]
+            fields[key] = " ".join(value.split())
+
+    return fields
+
+
+class StreamingYamlExtractor:
+    """Accumulates streamed text deltas and reports the fields extracted so far
+    to `on_partial` every time they change"""
+
+    def __init__(self, on_partial: typing.Callable[[dict], typing.Any] | None = None):
+        self.on_partial = on_partial
+        self.text = ""
+        self.fields: dict = {}
+
+    def feed(self, delta: str) -> dict:
+        self.text += delta
+        fields = extract_partial_yaml(self.text)
+
+        if fields != self.fields:
+            self.fields = fields
+            if self.on_partial:
+                self.on_partial(dict(fields))
+
+        return self.fields
+
+
+async def consume_stream(deltas: typing.AsyncIterator[str], on_partial=None) -> dict:
+    """Read the whole stream reporting the partial fields on the way and return
+    the answer shaped as a regular chat completion response"""
+    extractor = StreamingYamlExtractor(on_partial)
+    async for delta in deltas:
+        extractor.feed(delta)
+
+    return {
+        "choices": [
+            {"message": {"role": "assistant", "content": extractor.text}, "finish_reason": "stop"}
+        ],
+    }
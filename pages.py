@@ -70,11 +70,11 @@ from nearby castle.",
             ui.column(
                 3,
                 add_tooltip(
-                    ui.input_select(
+                    ui.input_numeric(
                         "new_world_npc_num",
                         "# NPCs",
-                        [*range(1, 16)],
-                        selected=2,
+                        value=2,
+                        min=1,
                         width="80%",
                     ),
                     "The number of NPCs in the world",
@@ -253,6 +253,7 @@ PAGE_WORLD_UPDATING = ui.TagList(
                 src="img/loading.svg",
                 class_="loading_world_image",
             ),
+            ui.output_ui(id="updating_world_partial_states"),
             ui.div(
                 ui.span(
                     "The process of updating the world relies on ChatGPT. It typically takes between 1 to 2 minutes to complete, and the time it takes depends on the number of NPCs",
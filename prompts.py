@@ -53,6 +53,8 @@ create_social_connections = load_prompt(
     "data/prompts/npc/create_social_connections_request.yaml"
 )
 npc_new_state = load_prompt("data/prompts/npc/new_state_request.yaml")
+npc_new_states = load_prompt("data/prompts/npc/new_states_request.yaml")
+history_summaries = load_prompt("data/prompts/npc/history_summaries_request.yaml")
 generate_npc_image = load_prompt("data/prompts/npc/generate_npc_image.yaml")
 
 if __name__ == "__main__":
@@ -134,6 +136,7 @@ if __name__ == "__main__":
 
     world_new_state_request = world_new_state.format(
         init_state=world.current_state_prompt,
+        history_summary=world.history_summary,
         previous_state=world.current_state_prompt,
         current_state=world.current_state_prompt,
         attributes=world.attributes,
@@ -0,0 +1,205 @@
+"""Headless world simulation, e.g. to pre-simulate days of world history overnight.
+
+Advances an existing game (or a new one created from a world template) by a number
+of ticks, saving the states only every few ticks, and prints the timing and the
+tokens spent per tick.
+
+With --worlds N, N new worlds are created from the template and run concurrently
+in this process, sharing the LLM client, and the aggregate throughput is printed.
+With --shards K the worlds are split between K worker processes sharing one
+provider budget.
+
+Usage: python simulate.py --game my_game --ticks 100 --checkpoint-every 10
+       python simulate.py --new-game my_game --world-template test_world.yaml --ticks 24
+       python simulate.py --new-game batch --worlds 50 --max-active-worlds 10 --ticks 24
+       python simulate.py --new-game batch --worlds 1000 --shards 8 --max-active-worlds 64 --ticks 24
+"""
+import argparse
+import asyncio
+from dataclasses import asdict
+import json
+import logging
+
+import yaml
+
+from classes import Game
+from game_modules.world_scheduler import WorldScheduler
+from game_modules.world_shards import ShardedWorldRunner
+from resources_paths import DATA_PATH, GAMES_PATH, YAML_TEMPLATES_PATH, INIT_WORLDS_PATH
+from utils import ensure_dirs_exist
+
+
+async def load_or_create_game(args) -> Game:
+    game = Game()
+    if args.settings:
+        game.settings.load(path=args.settings)
+    elif args.game and (GAMES_PATH / args.game / "settings.yaml").exists():
+        # Settings the game was created with in the app
+        game.settings.load(path=GAMES_PATH / args.game / "settings.yaml")
+
+    if args.new_game:
+        with open(INIT_WORLDS_PATH / args.world_template) as f:
+            world_data = yaml.safe_load(f)
+
+        game.new_game(args.new_game)
+        await game.init_world(world_data)
+    else:
+        game.game_name = args.game
+        game.load_game()
+        await game.init_world()
+
+    return game
+
+
+def print_worlds_stats(stats: dict, jobs_stats: list[dict]):
+    print(f"{'world':<24} {'ticks':>6} {'time':>9}")
+    for job_stats in jobs_stats:
+        print(
+            f"{job_stats['game_name']:<24} {job_stats['ticks_done']:>6} {job_stats['seconds']:>8.2f}s"
+            f"{'  failed: ' + job_stats['error'] if job_stats['error'] else ''}"
+        )
+    print(
+        f"{stats['ticks_done']} ticks of {stats['worlds']} worlds in {stats['elapsed']:.2f}s "
+        f"({stats['ticks_per_minute']:.1f} ticks/min), {stats['spills']} spills, {stats['loads']} loads"
+    )
+
+    return
+
+
+async def run_worlds(args, world_data: dict):
+    scheduler = WorldScheduler(
+        max_active_worlds=args.max_active_worlds,
+        max_resident_worlds=args.max_resident_worlds,
+        checkpoint_every=args.checkpoint_every,
+        generate_images=args.images,
+    )
+    for i in range(args.worlds):
+        scheduler.add_world(
+            f"{args.new_game}-{i}", ticks=args.ticks, world_data=world_data, settings_path=args.settings
+        )
+
+    try:
+        stats = await scheduler.run()
+    finally:
+        await scheduler.llm_client.close()
+
+    print_worlds_stats(stats, scheduler.get_jobs_stats())
+
+    return stats
+
+
+def run_sharded_worlds(args, world_data: dict):
+    runner = ShardedWorldRunner(
+        shards=args.shards,
+        settings_path=args.settings or "./settings.yaml",
+        max_active_worlds=args.max_active_worlds,
+        max_resident_worlds=args.max_resident_worlds,
+        checkpoint_every=args.checkpoint_every,
+        generate_images=args.images,
+        log_level=logging.DEBUG if args.verbose else logging.WARNING,
+    )
+    for i in range(args.worlds):
+        runner.add_world(f"{args.new_game}-{i}", ticks=args.ticks, world_data=world_data)
+
+    stats = runner.run()
+    jobs_stats = stats.pop("jobs")
+    print_worlds_stats(stats, jobs_stats)
+    print(f"{stats['shards']} shards, at most {stats['max_requests_in_flight']} requests in flight")
+
+    return stats
+
+
+def run_many(args):
+    ensure_dirs_exist([DATA_PATH, GAMES_PATH, YAML_TEMPLATES_PATH, INIT_WORLDS_PATH])
+
+    if not args.new_game:
+        raise SystemExit("--worlds and --shards need --new-game as the prefix of the world names")
+
+    with open(INIT_WORLDS_PATH / args.world_template) as f:
+        world_data = yaml.safe_load(f)
+
+    if args.shards > 1:
+        stats = run_sharded_worlds(args, world_data)
+    else:
+        stats = asyncio.run(run_worlds(args, world_data))
+
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(stats, f, indent=2)
+
+    return
+
+
+async def run(args):
+    ensure_dirs_exist([DATA_PATH, GAMES_PATH, YAML_TEMPLATES_PATH, INIT_WORLDS_PATH])
+
+    game = await load_or_create_game(args)
+    try:
+        ticks_stats = await game.advance(
+            ticks=args.ticks,
+            checkpoint_every=args.checkpoint_every,
+            generate_images=args.images,
+        )
+    finally:
+        await game.llm_client.close()
+        game.close_storage()
+        await game.flush()
+
+    if args.export_yaml:
+        print(f"States exported to {game.export_yaml()}")
+
+    print(f"{'tick':>6} {'time':>9} {'requests':>9} {'prompt tokens':>14} {'completion tokens':>18} {'stale NPCs':>11}")
+    for tick_stats in ticks_stats:
+        print(
+            f"{tick_stats.tick:>6} {tick_stats.seconds:>8.2f}s {tick_stats.requests:>9} "
+            f"{tick_stats.prompt_tokens:>14} {tick_stats.completion_tokens:>18} {tick_stats.stale_npcs:>11}"
+            f"{'  saved' if tick_stats.checkpoint else ''}"
+        )
+
+    total_seconds = sum(tick_stats.seconds for tick_stats in ticks_stats)
+    total_tokens = sum(
+        tick_stats.prompt_tokens + tick_stats.completion_tokens for tick_stats in ticks_stats
+    )
+    print(
+        f"{len(ticks_stats)} ticks in {total_seconds:.2f}s "
+        f"({total_seconds / max(1, len(ticks_stats)):.2f}s per tick), {total_tokens} tokens"
+    )
+    attributes_stats = game.get_npcs_attributes_stats()
+    if attributes_stats:
+        print(
+            "NPCs' mean attributes: "
+            + ", ".join(f"{name} {stats['mean']:.1f}" for name, stats in attributes_stats.items())
+        )
+
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump([asdict(tick_stats) for tick_stats in ticks_stats], f, indent=2)
+
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Advance a world by many ticks without the UI")
+    game_group = parser.add_mutually_exclusive_group(required=True)
+    game_group.add_argument("--game", help="name of an existing game in data/games")
+    game_group.add_argument("--new-game", help="name of a new game to create from --world-template")
+    parser.add_argument("--world-template", default="test_world.yaml", help="world template in data/init_worlds")
+    parser.add_argument("--ticks", type=int, required=True, help="number of ticks to run")
+    parser.add_argument("--checkpoint-every", type=int, default=1, help="save the states every K ticks, 0 saves only the last tick")
+    parser.add_argument("--images", action="store_true", help="generate the images of the saved ticks")
+    parser.add_argument("--worlds", type=int, default=1, help="number of new worlds to run concurrently")
+    parser.add_argument("--shards", type=int, default=1, help="number of worker processes to split the worlds between")
+    parser.add_argument("--max-active-worlds", type=int, default=32, help="worlds running a tick at once")
+    parser.add_argument("--max-resident-worlds", type=int, default=64, help="worlds kept in memory, the others are spilled to disk")
+    parser.add_argument("--settings", help="settings file to use instead of ./settings.yaml")
+    parser.add_argument("--export-yaml", action="store_true", help="also write the saved states in the YAML layout (with the log storage)")
+    parser.add_argument("--stats-json", help="write the per-tick stats to this json file")
+    parser.add_argument("--verbose", action="store_true", help="print the debug log")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.worlds > 1 or args.shards > 1:
+        run_many(args)
+    else:
+        asyncio.run(run(args))
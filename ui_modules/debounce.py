@@ -0,0 +1,50 @@
+import copy
+import time
+from shiny import reactive
+
+
+def debounce(delay_secs: float):
+    """Delay the invalidation of a reactive calc until its value hasn't changed
+    for `delay_secs` seconds, e.g. to react to a text input only once the user
+    has stopped typing"""
+
+    def wrapper(f):
+        when = reactive.Value(None)
+        trigger = reactive.Value(0)
+
+        @reactive.Calc
+        def cached():
+            return copy.deepcopy(f())
+
+        # Restart the timer every time the value changes
+        @reactive.Effect(priority=102)
+        def primer():
+            try:
+                cached()
+            except Exception:
+                pass
+            finally:
+                when.set(time.time() + delay_secs)
+
+        @reactive.Effect(priority=101)
+        def timer():
+            deadline = when.get()
+            if deadline is None:
+                return
+
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger.get() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_none=False)
+        def debounced():
+            return cached()
+
+        return debounced
+
+    return wrapper
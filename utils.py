@@ -5,10 +5,8 @@ from pathlib import Path
 import ast
 from yamldataclassconfig.config import YamlDataClassConfig
 import yaml
-import openai
-import itertools
 import numpy as np
-from dataclasses import fields
+from dataclasses import dataclass, fields
 import typing
 import logging
 from logging import debug
@@ -18,6 +16,11 @@ import aiohttp
 import os
 import zipfile
 import shutil
+from llm_modules.client import LLMClient, get_llm_client
+from llm_modules.retry import RetryPolicy, ResponseProcessingError, RequestFailedError
+from llm_modules.cache import ResponseCache
+from llm_modules.streaming import consume_stream, extract_partial_yaml
+from llm_modules.deadline import DeadlineExceededError, check_deadline, earliest, get_deadline
 
 
 class bcolors:
@@ -140,8 +143,32 @@ def code_block_to_var(code_block: str):
 
 def save_yaml_from_data(save_path: Path, data: YamlDataClassConfig | typing.Any):
     yaml.emitter.Emitter.process_tag = lambda self, *args, **kw: None
-    with open(save_path, "w") as savefile:
+    # Written next to it and swapped in, so the file is never left half written. Made durable
+    # by the caller with fsync_file() and fsync_dir(), e.g. once for all the files of a checkpoint
+    save_path = Path(save_path)
+    temp_path = save_path.with_name(save_path.name + ".tmp")
+    with open(temp_path, "w") as savefile:
         yaml.dump(data, savefile, sort_keys=False)
+    os.replace(temp_path, save_path)
+
+
+def fsync_file(path: Path):
+    """Make the content of the written file durable"""
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path: Path):
+    """Make the files created or replaced in the directory durable. Not possible on Windows, where
+    the replaced files are durable already"""
+    if os.name == "nt":
+        return
+
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
 def yaml_from_str(data_str: str) -> dict:
@@ -167,6 +194,16 @@ def load_yaml_to_dataclass(yaml_dataclass: YamlDataClassConfig, yaml_path: Path)
     return
 
 
+def load_dict_to_dataclass(yaml_dataclass: YamlDataClassConfig, data: dict | None):
+    """Same as `load_yaml_to_dataclass` for a state that is already parsed"""
+    if data:
+        yaml_dataclass.__dict__.update(yaml_dataclass.from_dict(data).__dict__)
+    else:
+        debug(f"Can't load {type(yaml_dataclass).__name__} from an empty state")
+
+    return
+
+
 def check_yaml_update_npc(data_yaml: dict):
     debug("check_yaml_update_npc")
     if not data_yaml.get("npc_new_state"):
@@ -208,56 +245,135 @@ async def request_openai(
     verbose=False,
     api_key: str = None,
     model_type: str = "chat",
+    client: LLMClient = None,
+    retry_policy: RetryPolicy = None,
+    cache: ResponseCache = None,
+    stream: bool = False,
+    on_partial: typing.Callable[[dict], typing.Any] = None,
+    hedge: bool = False,
     **params
 ):
     processed_response = None
 
-    if tries_num == -1:
-        tries_range = itertools.count()
-    else:
-        tries_range = range(tries_num)
+    if client is None:
+        client = get_llm_client()
 
-    for i in tries_range:
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_tries=tries_num)
+
+    # The request's own deadline or the deadline of the tick it belongs to, whichever is earlier
+    scope_deadline_at = get_deadline()
+    deadline_at = earliest(retry_policy.get_deadline_at(), scope_deadline_at)
+
+    # Try the cached response first. If it doesn't pass the response processors,
+    # the next tries go to the model and overwrite it
+    cache_key = None
+    use_cache = cache is not None
+    if use_cache:
+        cache_key = cache.make_key(model, prompt, model_type, params)
+
+    for i in retry_policy.tries():
         try:
             debug(f"{bcolors.OKBLUE}OpenAI request try {i+1}...{bcolors.ENDC}")
+            check_deadline()
+
+            response = await cache.get(cache_key) if use_cache else None
+            from_cache = response is not None
+            use_cache = False
 
             if model_type == "chat":
-                response = await openai.ChatCompletion.acreate(
-                    api_key=api_key,
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}],
-                )
+                if not from_cache and stream:
+                    # Fields of the answer are reported to `on_partial` as soon as they are parsed
+                    response = await asyncio.wait_for(
+                        consume_stream(
+                            client.stream_chat_completion(
+                                model=model,
+                                prompt=prompt,
+                                api_key=api_key,
+                            ),
+                            on_partial=on_partial,
+                        ),
+                        timeout=retry_policy.time_left(deadline_at),
+                    )
+                elif not from_cache:
+                    response = await asyncio.wait_for(
+                        client.chat_completion(
+                            model=model,
+                            prompt=prompt,
+                            api_key=api_key,
+                            hedge=hedge,
+                        ),
+                        timeout=retry_policy.time_left(deadline_at),
+                    )
 
                 # get the response
                 response_content = response["choices"][0]["message"]["content"]
+                if on_partial and (from_cache or not stream):
+                    on_partial(extract_partial_yaml(response_content))
                 if verbose:
                     debug(response_content)
                 if response_processors:
                     processed_response = response_content
-                    for response_processor in response_processors:
-                        if verbose:
-                            debug(processed_response)
-                        processed_response = response_processor(processed_response)
+                    try:
+                        for response_processor in response_processors:
+                            if verbose:
+                                debug(processed_response)
+                            processed_response = response_processor(processed_response)
+                    except Exception as e:
+                        raise ResponseProcessingError(e) from e
                 else:
                     processed_response = response_content
 
             elif model_type == "image":
-                response = await openai.Image.acreate(
-                    api_key=api_key,
-                    prompt=prompt,
-                    model=model, # Adjust if OpenAI has specified a different name for the DALL·E 3 model
-                    size=params['img_size'],
-                    quality=params['img_quality'],
-                    n=params['img_n'],
-                    response_format=params['response_format'],
-                )
+                if not from_cache:
+                    response = await asyncio.wait_for(
+                        client.image_generation(
+                            model=model, # Adjust if OpenAI has specified a different name for the DALL·E 3 model
+                            prompt=prompt,
+                            api_key=api_key,
+                            img_size=params['img_size'],
+                            img_quality=params['img_quality'],
+                            img_n=params['img_n'],
+                            response_format=params['response_format'],
+                        ),
+                        timeout=retry_policy.time_left(deadline_at),
+                    )
 
                 processed_response = response
                 if verbose:
                     debug(processed_response)
 
+            if cache is not None and not from_cache:
+                await cache.put(cache_key, response)
+
         except Exception as e:
             processed_response = None
+
+            # The client doesn't see the requests cancelled by the timeout, a hung provider
+            # has to open the circuit breaker too
+            if isinstance(e, asyncio.TimeoutError):
+                client.record_failure(api_key, e)
+
+            if not retry_policy.is_retryable(e):
+                debug(f"{bcolors.FAIL}OpenAI request failed with non-retryable error: {e}{bcolors.ENDC}")
+                raise
+
+            if retry_policy.is_last_try(i):
+                debug(f"{bcolors.FAIL}OpenAI request try {i+1} failed ({retry_policy.classify(e)}: {e}){bcolors.ENDC}")
+                break
+
+            delay = retry_policy.get_delay(i, e)
+            if not retry_policy.fits_deadline(deadline_at, delay):
+                debug(f"{bcolors.FAIL}OpenAI request deadline is exceeded{bcolors.ENDC}")
+                if deadline_at == scope_deadline_at:
+                    raise DeadlineExceededError("The deadline is exceeded before the request succeeded") from e
+                break
+
+            debug(
+                f"{bcolors.WARNING}OpenAI request try {i+1} failed ({retry_policy.classify(e)}: {e}), "
+                f"retrying in {delay:.1f}s{bcolors.ENDC}"
+            )
+            await asyncio.sleep(delay)
             continue
         else:
             break
@@ -543,10 +659,13 @@ async def generate_and_save_image(file_path: Path, prompt: str, **kwargs) -> str
         model=kwargs["model_name"],
         prompt=prompt,
         tries_num=kwargs["tries_num"],
+        retry_policy=kwargs.get("retry_policy"),
+        cache=kwargs.get("cache"),
         response_processors=kwargs["response_processors"],
         verbose=kwargs["verbose"],
         api_key=kwargs["API_key"],
         model_type="image",
+        client=kwargs.get("client"),
         img_size=kwargs["img_size"],
         img_quality=kwargs["img_quality"],
         img_n=kwargs["img_n"],
@@ -576,25 +695,80 @@ async def batch_image_generation(file_paths: typing.List[str],
 
     await asyncio.gather(*tasks, return_exceptions=True)
 
+@dataclass
+class BatchOutcome:
+    """Result of one prompt of `batch_completion`"""
+
+    index: int
+    prompt: str
+    value: typing.Any = None
+    error: BaseException | None = None
+    attempts: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 async def batch_completion(prompts: typing.List[str],
-                           openai_kwargs: dict) -> typing.List[str]:
-    """Generate completions from prompts in parallel
+                           openai_kwargs: dict,
+                           on_partials: typing.List[typing.Callable] = None,
+                           retry_rounds: int = 1,
+                           hedge: bool = True) -> typing.List[BatchOutcome]:
+    """Generate completions from prompts in parallel. The number of requests
+    actually sent at once is limited by the shared LLM client. Only the prompts
+    that failed are sent again, up to `retry_rounds` times
 
     Args:
         prompts (typing.List[str]): List of prompts
         openai_kwargs (dict): Kwargs for openai request
+        on_partials (typing.List[typing.Callable], optional): Callback for each prompt receiving
+            the fields of its answer extracted so far. Defaults to None.
+        retry_rounds (int, optional): How many times the failed prompts are sent again. Defaults to 1.
+        hedge (bool, optional): Send a duplicate of the requests that are slower than usual,
+            if hedging is enabled in the LLM client. Defaults to True.
 
     Returns:
-        List[str]: List of completions
+        List[BatchOutcome]: Outcome of each prompt, in the order of prompts
     """
-    tasks = []
-
-    for prompt in prompts:
-        tasks.append(request_openai(prompt=prompt, **openai_kwargs))
+    if on_partials is None:
+        on_partials = [None] * len(prompts)
+
+    retry_policy = openai_kwargs.get("retry_policy") or RetryPolicy()
+    outcomes = [BatchOutcome(index=i, prompt=prompt) for i, prompt in enumerate(prompts)]
+    pending = outcomes
+
+    for round_num in range(retry_rounds + 1):
+        tasks = [
+            request_openai(
+                prompt=outcome.prompt, on_partial=on_partials[outcome.index], hedge=hedge, **openai_kwargs
+            )
+            for outcome in pending
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for outcome, result in zip(pending, results):
+            outcome.attempts += 1
+            if isinstance(result, BaseException):
+                outcome.value, outcome.error = None, result
+            elif result is None:
+                outcome.value, outcome.error = None, RequestFailedError("All tries of the request failed")
+            else:
+                outcome.value, outcome.error = result, None
+
+        pending = [
+            outcome
+            for outcome in pending
+            if not outcome.ok and retry_policy.is_retryable(outcome.error)
+        ]
+        if not pending or round_num == retry_rounds:
+            break
 
-    completions = await asyncio.gather(*tasks, return_exceptions=True)
+        debug(
+            f"{bcolors.WARNING}{len(pending)}/{len(prompts)} batch requests failed, retrying them{bcolors.ENDC}"
+        )
 
-    return completions
+    return outcomes
 
 
 async def zip_files(path, zip_file):
@@ -623,20 +797,9 @@ async def unzip_files(zip_file: Path, path: Path):
 
 
 async def is_openai_api_key_valid(api_key, model="gpt-4-1106-preview"):
-    try:
-        response = await openai.ChatCompletion.acreate(
-                    api_key=api_key,
-                    model=model,
-                    messages=[{"role": "user", "content": "This is a test."}],
-                    max_tokens=5,
-        )
-        # openai.Model.list(api_key=api_key)
-    except openai.OpenAIError as e:
-        return e
-    except Exception as e:
-        return e
-    else:
-        return True
+    """Return True if the key is valid, otherwise the error. The check is done by
+    the provider of the shared LLM client, fake and replay providers accept any key"""
+    return await get_llm_client().validate_api_key(api_key, model)
 
 if __name__ == "__main__":
     from classes import World, Npc, Settings